@@ -1,20 +1,29 @@
+# when importing the app began - see startup.py
+import time
+import_started = time.time()
+
 # Flask class allows creation of Flask objects
 from flask import Flask
-# sqlalchemy - for working w/ db
-from flask.ext.sqlalchemy import SQLAlchemy
+# sqlalchemy - for working w/ db - w/ reads routed to any replicas
+from app.routing import RoutingSQLAlchemy
 
 # Flask object of name __name__ (the name of this file)
 app = Flask(__name__)
 # import configuration from config module
 app.config.from_object('config')
+
+# deferred extensions, precompiled templates and startup timings
+from app.startup import StartupTimer, LazyOpenID, template_bytecode_cache, precompile_templates
+startup_timer = StartupTimer(import_started)
+# compiled templates can be cached on disk w/ TEMPLATE_CACHE_DIR -
+# set before anything (like a template filter) creates app.jinja_env
+app.jinja_options = dict(app.jinja_options, bytecode_cache=template_bytecode_cache(app))
 # initalize database w/ sqlalchemy
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
 
 import os
 # handle the users' logged in state
 from flask.ext.login import LoginManager
-# provide authentication
-from flask.ext.openid import OpenID
 # base directory of the project
 from config import basedir, ADMINS, MAIL_SERVER, MAIL_PORT, MAIL_USERNAME, MAIL_PASSWORD
 
@@ -25,7 +34,8 @@ lm.init_app(app)
 # let flask-login know what view logs users in
 lm.login_view = 'login'
 # initialize openid object - requires a path to a temp folder where files can be stored
-oid = OpenID(app, os.path.join(basedir, 'tmp'))
+# Flask-OpenID itself is only imported once a login needs it
+oid = LazyOpenID(app, os.path.join(basedir, 'tmp'))
 
 # Sending logging to e-mail
 # if not app.debug:
@@ -54,8 +64,28 @@ if not app.debug:
 	app.logger.addHandler(file_handler)
 	app.logger.info('microblog startup')
 
+# SQLite pragmas and connection pre-ping from the config
+from app import engine
+
+# opt-in per-request SQL/render timing, logged to the same log
+if app.config.get('PROFILING_ENABLED', False):
+	from app.profiling import profiler
+	profiler.init_app(app)
+
+# logs each process's first request time - registered ahead of the views'
+# request hooks so it's timed from the start
+startup_timer.init_app(app)
+
 
 
 # from the app module - app.py - import views (which will be created by us)
 # import models for dbs - this is created by us
-from app import views, models
\ No newline at end of file
+from app import views, models, api
+
+# compile every template now rather than on first use - in gunicorn's
+# master (see wsgi.py) this is done once for all the workers
+if app.config.get('TEMPLATE_PRECOMPILE', False):
+	templates_started = time.time()
+	precompile_templates(app)
+	startup_timer.record(app, 'templates', time.time() - templates_started)
+startup_timer.imported(app)
\ No newline at end of file
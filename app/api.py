@@ -0,0 +1,189 @@
+# JSON API for the feeds, w/ each page's queries run concurrently on a thread pool.
+import threading
+from functools import wraps
+
+from concurrent.futures import ThreadPoolExecutor
+from flask import g, request, jsonify, abort
+
+from app import app, db
+from app.models import User, Post, followers, avatar_url, hash_email
+from app.user_cache import user_cache, snapshot
+from app.search import cached_search
+from app.views import before_cursor
+
+class QueryPool(object):
+	"""Pool of API_DB_THREADS threads that run db work for the API. Each
+	   job gets its own app context and so its own session, which is
+	   removed when it's done - jobs return plain data, not rows. Waiting
+	   on a pool lets independent queries for a page run side by side,
+	   and under an async (gevent) worker it frees the worker meanwhile."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._executor = None
+
+	def executor(self):
+		# Made on first use, so each forked worker gets its own threads.
+		with self._lock:
+			if self._executor is None:
+				self._executor = ThreadPoolExecutor(app.config.get('API_DB_THREADS', 4))
+			return self._executor
+
+	def _call(self, function, args):
+		with app.app_context():
+			try:
+				return function(*args)
+			finally:
+				db.session.remove()
+
+	def run(self, function, *args):
+		"""Runs one job on the pool and returns its result."""
+		return self.gather((function,) + args)[0]
+
+	def gather(self, *calls):
+		"""Input: (function, arg, ...) tuples
+		   Output: The functions' results, in order. They all run at once."""
+		futures = [self.executor().submit(self._call, call[0], call[1:]) for call in calls]
+		return [future.result() for future in futures]
+
+query_pool = QueryPool()
+
+def api_login_required(view):
+	"""Like login_required, but answers a 401 instead of redirecting."""
+	@wraps(view)
+	def wrapper(*args, **kwargs):
+		if not g.user.is_authenticated():
+			abort(401)
+		return view(*args, **kwargs)
+	return wrapper
+
+def post_fields(post):
+	return {'id': post.id, 'body': post.body, 'timestamp': post.timestamp.isoformat(), 'author_id': post.user_id}
+
+def page_fields(page):
+	"""Posts and cursors of a KeysetPagination."""
+	return {'posts': [post_fields(post) for post in page.items],
+			'next': page.next_cursor, 'prev': page.prev_cursor}
+
+### Jobs run on the pool ###
+
+def find_user_id(nickname):
+	return db.session.query(User.id).filter_by(nickname=nickname).scalar()
+
+def timeline_page(viewer_id, before, per_page):
+	return page_fields(User.query.get(viewer_id).followed_posts_page(before, per_page))
+
+def user_page(user_id, before, per_page):
+	return page_fields(User.query.get(user_id).posts_page(before, per_page))
+
+def search_page(query, page, per_page, limit):
+	"""The search's total hits and the posts on the given page, in rank order."""
+	ids = cached_search(query, limit)
+	visible = ids[(page - 1) * per_page:page * per_page]
+	posts = {}
+	if visible:
+		posts = dict((post.id, post) for post in Post.query.filter(Post.id.in_(visible)))
+	return {'total': len(ids), 'posts': [post_fields(posts[id]) for id in visible if id in posts]}
+
+def authors(ids):
+	"""Input: user ids
+	   Output: Dict of id -> public fields of the user. Served from the
+	   user cache, w/ the misses loaded in one query."""
+	found = {}
+	missing = []
+	for id in set(ids):
+		fields = user_cache.get(id)
+		if fields is None:
+			missing.append(id)
+		else:
+			found[id] = fields
+	if missing:
+		for user in User.query.filter(User.id.in_(missing)):
+			found[user.id] = snapshot(user)
+			user_cache.put(user.id, found[user.id])
+	return dict((id, {'id': id, 'nickname': fields['nickname'], 'about_me': fields['about_me'],
+					  'avatar': avatar_url(fields['email_hash'] or hash_email(fields['email']), 50),
+					  'followers_count': fields['followers_count'], 'posts_count': fields['posts_count']})
+				for id, fields in found.items())
+
+def following(viewer_id, ids):
+	"""Input: viewer id, user ids
+	   Output: Set of the ids in the list that the viewer follows.
+	   Same as User.is_following_many, w/o loading the viewer's row."""
+	ids = set(ids)
+	if not ids:
+		return set()
+	return set(row.followed_id for row in db.session.query(followers.c.followed_id).filter(
+		followers.c.follower_id == viewer_id,
+		followers.c.followed_id.in_(ids)))
+
+def follow_state(viewer_id, nicknames):
+	"""Input: viewer id, nicknames
+	   Output: Dict of nickname -> whether the viewer follows them.
+	   Unknown nicknames are left out."""
+	if not nicknames:
+		return {}
+	ids = dict(db.session.query(User.nickname, User.id).filter(User.nickname.in_(nicknames)))
+	followed_ids = following(viewer_id, ids.values())
+	return dict((nickname, id in followed_ids) for nickname, id in ids.items())
+
+### Routes ###
+
+def with_authors(page, viewer_id, followed=False):
+	"""Adds each post's author - and whether the viewer follows them -
+	   to a page of posts, looking both up at once. followed=True skips
+	   the follow lookup when every author is known to be followed."""
+	ids = [post['author_id'] for post in page['posts']]
+	if followed:
+		found, followed_ids = query_pool.run(authors, ids), set(ids)
+	else:
+		found, followed_ids = query_pool.gather((authors, ids), (following, viewer_id, ids))
+	for post in page['posts']:
+		post['author'] = dict(found[post['author_id']], following=post['author_id'] in followed_ids)
+	return page
+
+def per_page():
+	return app.config.get('POSTS_PER_PAGE', 20)
+
+@app.route('/api/timeline')
+@api_login_required
+def api_timeline():
+	"""The viewer's home timeline as json. Page by the ?before= cursor."""
+	page = query_pool.run(timeline_page, g.user.id, before_cursor(), per_page())
+	# The timeline only has followed users' posts.
+	return jsonify(with_authors(page, g.user.id, followed=True))
+
+@app.route('/api/users/<nickname>/posts')
+@api_login_required
+def api_user_posts(nickname):
+	"""A user, whether the viewer follows them, and their posts as json."""
+	user_id = query_pool.run(find_user_id, nickname)
+	if user_id is None:
+		abort(404)
+	page, found, followed_ids = query_pool.gather(
+		(user_page, user_id, before_cursor(), per_page()),
+		(authors, [user_id]),
+		(following, g.user.id, [user_id]))
+	page['user'] = dict(found[user_id], following=user_id in followed_ids)
+	for post in page['posts']:
+		post['author'] = page['user']
+	return jsonify(page)
+
+@app.route('/api/following')
+@api_login_required
+def api_following():
+	"""Follow state of the viewer for ?users=nickname,nickname,..."""
+	nicknames = [nickname for nickname in request.args.get('users', '').split(',') if nickname]
+	return jsonify(following=query_pool.run(follow_state, g.user.id, nicknames))
+
+@app.route('/api/search/<query>')
+@api_login_required
+def api_search(query):
+	"""Ranked search results as json. Page by ?page=n."""
+	page_number = request.args.get('page', 1, type=int)
+	if page_number < 1:
+		abort(404)
+	page = query_pool.run(search_page, query, page_number, per_page(),
+						  app.config.get('MAX_SEARCH_RESULTS', 50))
+	page['page'] = page_number
+	return jsonify(with_authors(page, g.user.id))
@@ -0,0 +1,147 @@
+# Streaming bulk import and export of users, follows and posts as NDJSON or CSV.
+import csv
+import json
+from collections import OrderedDict
+from datetime import datetime
+
+from app import db
+from app.models import User, Post, followers, hash_email, reconcile_counters, \
+	rebuild_timelines, timeline_enabled
+from app.search import backend_name, search_backend
+from app.graph import follow_graph_index
+
+# kind -> (table, columns in file order)
+KINDS = {
+	'users': (User.__table__, ['id', 'nickname', 'email', 'about_me', 'last_seen']),
+	'follows': (followers, ['follower_id', 'followed_id']),
+	'posts': (Post.__table__, ['id', 'body', 'timestamp', 'user_id']),
+}
+FORMATS = ('ndjson', 'csv')
+
+# SQLite's default cap on bound parameters per statement.
+MAX_VARIABLES = 999
+
+TIMESTAMP_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+
+def parse_timestamp(value):
+	for format in TIMESTAMP_FORMATS:
+		try:
+			return datetime.strptime(value, format)
+		except ValueError:
+			pass
+	raise ValueError('unknown timestamp format: %r' % value)
+
+def to_row(table, columns, record):
+	"""Input: table, columns, record read from a file
+	   Output: Dict of column -> value w/ the values converted from
+	   their file form. Missing and empty values are None."""
+	row = {}
+	for name in columns:
+		value = record.get(name)
+		if value is None or value == '':
+			row[name] = None
+		elif isinstance(table.c[name].type, db.Integer):
+			row[name] = int(value)
+		elif isinstance(table.c[name].type, db.DateTime):
+			row[name] = parse_timestamp(value)
+		else:
+			row[name] = value
+	return row
+
+def from_row(row):
+	"""Inverse of to_row - dates as ISO 8601, everything else as is."""
+	return OrderedDict((name, value.isoformat() if isinstance(value, datetime) else value)
+					   for name, value in row.items())
+
+### Import ###
+
+def read_records(file, format):
+	"""Yields the records in an NDJSON or CSV (w/ a header row) file as dicts."""
+	if format == 'ndjson':
+		for line in file:
+			if line.strip():
+				yield json.loads(line)
+	else:
+		for record in csv.DictReader(file):
+			# A short row's missing fields are None, left missing; a long
+			# row's extra fields are listed under None, and aren't columns.
+			yield dict((name, value.decode('utf-8') if isinstance(value, str) else value)
+					   for name, value in record.items() if name is not None)
+
+def insert_batch(table, rows, per_statement):
+	"""Inserts the rows w/ multi-row INSERT ... VALUES statements."""
+	for start in range(0, len(rows), per_statement):
+		db.session.execute(table.insert().values(rows[start:start + per_statement]))
+
+def import_records(kind, records, batch_size=10000):
+	"""Input: 'users', 'follows' or 'posts', iterable of records, rows per commit
+	   Output: Inserts the records w/ Core multi-row inserts, committing
+	   every batch_size rows so memory stays flat and a failure only loses
+	   the current batch. Returns the number of rows inserted."""
+	table, columns = KINDS[kind]
+	if kind == 'users':
+		columns = columns + ['email_hash']
+	# Multi-row inserts only apply column defaults (e.g. the user
+	# counters) to the first row, so every row carries them itself.
+	defaults = dict((column.name, column.default.arg) for column in table.columns
+					if column.default is not None and column.default.is_scalar and column.name not in columns)
+	# Each row binds one parameter per column.
+	per_statement = max(1, MAX_VARIABLES // (len(columns) + len(defaults)))
+	count = 0
+	rows = []
+	for record in records:
+		row = to_row(table, columns, record)
+		row.update(defaults)
+		if kind == 'users':
+			row['email_hash'] = hash_email(row['email']) if row['email'] else None
+		rows.append(row)
+		if len(rows) >= batch_size:
+			insert_batch(table, rows, per_statement)
+			db.session.commit()
+			count += len(rows)
+			rows = []
+	if rows:
+		insert_batch(table, rows, per_statement)
+		db.session.commit()
+		count += len(rows)
+	return count
+
+def finish_import():
+	"""Core inserts skip the model hooks, so bring the derived data - counters,
+	   timelines, the follow graph and the Whoosh index (FTS5 has triggers) -
+	   up to date."""
+	reconcile_counters()
+	follow_graph_index.reset()
+	if timeline_enabled():
+		rebuild_timelines()
+	if backend_name() == 'whoosh':
+		search_backend().setup()
+
+### Export ###
+
+def export_records(kind, batch_size=10000):
+	"""Yields every row of a kind as a dict, in primary key order. Rows
+	   are fetched batch_size at a time w/ yield_per, so memory stays
+	   constant however big the table is."""
+	table, columns = KINDS[kind]
+	# followers has no primary key, but its columns are unique together.
+	key = list(table.primary_key.columns) or [table.c[name] for name in columns]
+	query = db.session.query(*[table.c[name] for name in columns]).order_by(*key)
+	for row in query.yield_per(batch_size):
+		yield from_row(OrderedDict(zip(columns, row)))
+
+def write_records(file, format, columns, records):
+	"""Writes records as NDJSON or CSV w/ a header row. Returns the count."""
+	count = 0
+	if format == 'ndjson':
+		for record in records:
+			file.write(json.dumps(record) + '\n')
+			count += 1
+	else:
+		writer = csv.writer(file)
+		writer.writerow(columns)
+		for record in records:
+			writer.writerow(['' if record[name] is None else unicode(record[name]).encode('utf-8')
+							 for name in columns])
+			count += 1
+	return count
@@ -0,0 +1,57 @@
+# Database connection settings for production - SQLite pragmas, pre-ping and forking.
+import sqlite3
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+
+from app import app, db
+
+# Pool size, timeout and recycle come from Flask-SQLAlchemy's own
+# SQLALCHEMY_POOL_SIZE/_TIMEOUT/_RECYCLE settings and apply to server
+# databases (MySQL, Postgres). File SQLite dbs always use a NullPool -
+# opening one is cheap - so leave those unset for SQLite.
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+	"""'connect' listener - applies SQLITE_JOURNAL_MODE (e.g. 'WAL', so
+	   readers don't block the writer), SQLITE_SYNCHRONOUS (e.g. 'NORMAL')
+	   and SQLITE_BUSY_TIMEOUT (ms to wait on a locked db) to each new
+	   SQLite connection. Unset settings are left at SQLite's defaults."""
+	if not isinstance(dbapi_connection, sqlite3.Connection):
+		return
+	pragmas = [('journal_mode', app.config.get('SQLITE_JOURNAL_MODE')),
+			   ('synchronous', app.config.get('SQLITE_SYNCHRONOUS')),
+			   ('busy_timeout', app.config.get('SQLITE_BUSY_TIMEOUT'))]
+	cursor = dbapi_connection.cursor()
+	for name, value in pragmas:
+		if value is not None:
+			cursor.execute('PRAGMA %s = %s' % (name, value))
+	cursor.close()
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+	"""'checkout' listener - w/ DATABASE_PRE_PING, tests each connection
+	   as it leaves the pool so ones the server dropped (restarts, idle
+	   timeouts) are replaced instead of failing the request."""
+	if not app.config.get('DATABASE_PRE_PING', False):
+		return
+	cursor = dbapi_connection.cursor()
+	try:
+		cursor.execute('SELECT 1')
+	except Exception:
+		# The pool retries the checkout w/ a new connection.
+		raise exc.DisconnectionError()
+	finally:
+		cursor.close()
+
+# Listen on every engine so the db can be configured later (e.g. in tests).
+event.listen(Engine, 'connect', set_sqlite_pragmas)
+event.listen(Engine, 'checkout', ping_connection)
+
+def after_fork():
+	"""Call in each worker process after it's forked. Drops the pooled
+	   connections inherited from the parent - the primary's and every
+	   SQLALCHEMY_BINDS engine's, replicas included - so workers never
+	   share a socket or SQLite handle; each opens its own on first use."""
+	with app.app_context():
+		db.engine.dispose()
+		for bind in app.config.get('SQLALCHEMY_BINDS') or ():
+			db.get_engine(app, bind=bind).dispose()
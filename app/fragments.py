@@ -0,0 +1,95 @@
+# Caches the rendered html of post.html for each post.
+import threading
+from collections import OrderedDict
+
+from flask import render_template, Markup
+
+from app import app
+
+class FragmentBackend(object):
+	"""Storage interface for rendered fragments. Subclass it to keep
+	   fragments somewhere shared, e.g. memcached or redis."""
+
+	def get(self, key):
+		"""Returns the value stored for the key, or None."""
+		raise NotImplementedError
+
+	def set(self, key, value):
+		raise NotImplementedError
+
+	def delete(self, key):
+		raise NotImplementedError
+
+class LRUBackend(FragmentBackend):
+	"""In-process backend holding the FRAGMENT_CACHE_SIZE most recently used values."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._values = OrderedDict()
+
+	def get(self, key):
+		with self._lock:
+			value = self._values.pop(key, None)
+			if value is not None:
+				# Re-inserting moves the key to the most recently used end.
+				self._values[key] = value
+			return value
+
+	def set(self, key, value):
+		with self._lock:
+			self._values.pop(key, None)
+			self._values[key] = value
+			while len(self._values) > app.config.get('FRAGMENT_CACHE_SIZE', 10000):
+				self._values.popitem(last=False)
+
+	def delete(self, key):
+		with self._lock:
+			self._values.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self._values.clear()
+
+class PostFragmentCache(object):
+	"""Rendered post.html per post. A post's markup only changes when its
+	   author's nickname or avatar does, so entries are keyed by (post id,
+	   author version): the author's nickname and email plus a generation
+	   that invalidate_author bumps to drop the old entries. Generations
+	   are kept apart from the fragments, in a dict that's never evicted -
+	   evicted w/ them, a generation would start over and entries cached
+	   under its old values could be served again. Having the nickname and
+	   email in the key means a worker that missed the bump still never
+	   serves a stale name or avatar."""
+
+	def __init__(self, backend=None):
+		self.backend = backend or LRUBackend()
+		self._lock = threading.Lock()
+		# author id -> generation, for the authors invalidated so far
+		self._generations = {}
+
+	def author_version(self, author):
+		return '%s:%s:%d' % (author.nickname, author.email_hash or author.email,
+							 self._generations.get(author.id, 0))
+
+	def render(self, post):
+		"""Returns the html for the post, rendering it on a miss."""
+		if not app.config.get('FRAGMENT_CACHE_ENABLED', True):
+			return Markup(render_template('post.html', post=post))
+		key = ('post', post.id, self.author_version(post.author))
+		html = self.backend.get(key)
+		if html is None:
+			html = render_template('post.html', post=post)
+			self.backend.set(key, html)
+		return Markup(html)
+
+	def invalidate_author(self, author):
+		"""Drops the cached posts of an author whose nickname changed."""
+		with self._lock:
+			self._generations[author.id] = self._generations.get(author.id, 0) + 1
+
+post_fragments = PostFragmentCache()
+
+@app.template_global()
+def render_post(post):
+	"""Template function used in place of {% include "post.html" %}."""
+	return post_fragments.render(post)
@@ -0,0 +1,331 @@
+# In-process index of the follower graph, kept in compact integer arrays.
+import threading
+import time
+from array import array
+from bisect import bisect_left
+try:
+	from itertools import izip
+except ImportError:
+	# Python 3, where zip and range are already lazy
+	izip = zip
+	xrange = range
+
+from sqlalchemy.orm import Session
+
+from app import app, db
+
+def follow_graph_enabled():
+	"""True if follow checks should be answered from the in-process graph.
+	   Off by default - the followers table is queried instead."""
+	return app.config.get('FOLLOW_GRAPH_ENABLED', False)
+
+class Adjacency(object):
+	"""One direction of the graph in CSR form - the neighbours of id are
+	   targets[offsets[id]:offsets[id + 1]], sorted, so a user's list is
+	   one slice and an edge check a binary search. Ids are dense, so the
+	   offsets are indexed by id directly. Edges changed since the last
+	   compaction are kept in per-id added/removed sets on top."""
+
+	def __init__(self, offsets, targets):
+		self.offsets = offsets
+		self.targets = targets
+		# id -> set of neighbour ids added/removed since the arrays were built
+		self.added = {}
+		self.removed = {}
+		self.changes = 0
+
+	@classmethod
+	def build(cls, sources, targets):
+		"""Input: arrays of edge sources and targets, in any order
+		   Output: Adjacency of the edges, built w/ a counting sort."""
+		size = max(sources) + 1 if sources else 0
+		offsets = array('l', [0]) * (size + 1)
+		for source in sources:
+			offsets[source + 1] += 1
+		for id in xrange(size):
+			offsets[id + 1] += offsets[id]
+		position = array('l', offsets)
+		sorted_targets = array('i', [0]) * len(targets)
+		for source, target in izip(sources, targets):
+			sorted_targets[position[source]] = target
+			position[source] += 1
+		for id in xrange(size):
+			lo, hi = offsets[id], offsets[id + 1]
+			if hi - lo > 1:
+				sorted_targets[lo:hi] = array('i', sorted(sorted_targets[lo:hi]))
+		return cls(offsets, sorted_targets)
+
+	def _span(self, id):
+		if 0 <= id < len(self.offsets) - 1:
+			return self.offsets[id], self.offsets[id + 1]
+		return 0, 0
+
+	def _stored(self, id, other):
+		lo, hi = self._span(id)
+		i = bisect_left(self.targets, other, lo, hi)
+		return i < hi and self.targets[i] == other
+
+	def contains(self, id, other):
+		if other in self.added.get(id, ()):
+			return True
+		if other in self.removed.get(id, ()):
+			return False
+		return self._stored(id, other)
+
+	def neighbours(self, id):
+		"""Sorted array of the ids adjacent to id."""
+		lo, hi = self._span(id)
+		stored = self.targets[lo:hi]
+		added, removed = self.added.get(id), self.removed.get(id)
+		if not added and not removed:
+			return stored
+		return array('i', sorted(set(stored).difference(removed or ()).union(added or ())))
+
+	def add(self, id, other):
+		if self.contains(id, other):
+			return
+		if other in self.removed.get(id, ()):
+			self.removed[id].discard(other)
+		else:
+			self.added.setdefault(id, set()).add(other)
+		self.changes += 1
+
+	def remove(self, id, other):
+		if not self.contains(id, other):
+			return
+		if other in self.added.get(id, ()):
+			self.added[id].discard(other)
+		else:
+			self.removed.setdefault(id, set()).add(other)
+		self.changes += 1
+
+	def compact(self):
+		"""Folds the added and removed edges back into the arrays."""
+		size = max([len(self.offsets) - 1] + [id + 1 for id in self.added])
+		offsets, targets = array('l'), array('i')
+		for id in xrange(size):
+			offsets.append(len(targets))
+			targets.extend(self.neighbours(id))
+		offsets.append(len(targets))
+		self.offsets, self.targets = offsets, targets
+		self.added, self.removed, self.changes = {}, {}, 0
+
+	def edges(self):
+		return len(self.targets) + sum(len(ids) for ids in self.added.values()) - \
+			sum(len(ids) for ids in self.removed.values())
+
+	def nbytes(self):
+		"""Bytes held by the arrays - the change sets are left out."""
+		return sum(a.buffer_info()[1] * a.itemsize for a in (self.offsets, self.targets))
+
+class FollowGraph(object):
+	"""The follower graph in both directions - who a user follows and who
+	   follows them - as Adjacency arrays: 4 bytes per edge per direction
+	   plus 8 per user, vs. well over 100 for a dict of sets. Follows and
+	   unfollows are applied as they're committed and folded into the
+	   arrays every FOLLOW_GRAPH_COMPACT_AT changes."""
+
+	def __init__(self, sources, targets, compact_at=10000):
+		"""Input: arrays of follower ids and the ids they follow, changes between compactions"""
+		self._lock = threading.Lock()
+		self._followed = Adjacency.build(sources, targets)
+		self._followers = Adjacency.build(targets, sources)
+		self.compact_at = compact_at
+
+	def is_following(self, follower_id, followed_id):
+		with self._lock:
+			return self._followed.contains(follower_id, followed_id)
+
+	def following_many(self, follower_id, ids, pending=None):
+		"""Input: user id, iterable of user ids, optional dict of
+		   (follower id, followed id) -> following for uncommitted changes
+		   Output: Set of the ids the user is following."""
+		ids = set(ids)
+		with self._lock:
+			following = set(id for id in ids if self._followed.contains(follower_id, id))
+		for (follower, followed), state in (pending or {}).items():
+			if follower == follower_id and followed in ids:
+				if state:
+					following.add(followed)
+				else:
+					following.discard(followed)
+		return following
+
+	def followed(self, id):
+		"""Sorted array of the ids the user follows."""
+		with self._lock:
+			return self._followed.neighbours(id)
+
+	def followers(self, id):
+		"""Sorted array of the ids of the user's followers."""
+		with self._lock:
+			return self._followers.neighbours(id)
+
+	def followed_who_follow(self, viewer_id, id):
+		"""Input: viewer id, user id
+		   Output: Sorted list of the users the viewer follows who follow
+		   the given user - "followed by people you follow"."""
+		with self._lock:
+			return sorted(set(self._followed.neighbours(viewer_id)).intersection(
+				self._followers.neighbours(id)))
+
+	def common_followed(self, id, other_id):
+		"""Sorted list of the users both users follow."""
+		with self._lock:
+			return sorted(set(self._followed.neighbours(id)).intersection(
+				self._followed.neighbours(other_id)))
+
+	def follow(self, follower_id, followed_id):
+		with self._lock:
+			self._followed.add(follower_id, followed_id)
+			self._followers.add(followed_id, follower_id)
+			self._compact_if_due()
+
+	def unfollow(self, follower_id, followed_id):
+		with self._lock:
+			self._followed.remove(follower_id, followed_id)
+			self._followers.remove(followed_id, follower_id)
+			self._compact_if_due()
+
+	def _compact_if_due(self):
+		if self._followed.changes >= self.compact_at:
+			self._followed.compact()
+			self._followers.compact()
+
+	def edges(self):
+		with self._lock:
+			return self._followed.edges()
+
+	def nbytes(self):
+		with self._lock:
+			return self._followed.nbytes() + self._followers.nbytes()
+
+class GraphIndex(object):
+	"""Holds the process's FollowGraph. It's loaded on first use, then
+	   kept current by applying this process's committed follows. Other
+	   processes' follows aren't seen until it's reloaded from the db,
+	   every FOLLOW_GRAPH_RELOAD_SECONDS (60 by default; None never) - so
+	   reads may lag by that much, and writes check the db instead.
+	   Reloads are built by a background thread while requests keep using
+	   the current graph, then swapped in w/ the follows committed in the
+	   meantime replayed onto them."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._graph = None
+		self._loaded = 0
+		# bumped by reset, so a reload started before it is thrown away
+		self._version = 0
+		self._thread = None
+		# (follower id, followed id, following) applied during a reload
+		self._replay = None
+
+	def graph(self, load):
+		"""Input: function returning arrays of follower and followed ids
+		   Output: The FollowGraph. The first call loads it w/ the function;
+		   once it's due a reload, one is started in the background."""
+		with self._lock:
+			if self._graph is None:
+				self._graph = self._build(load)
+				self._loaded = time.time()
+			elif self._thread is None and self._due():
+				self._replay = []
+				self._thread = threading.Thread(target=self._reload, args=(load, self._version),
+												name='follow-graph-reload')
+				self._thread.daemon = True
+				self._thread.start()
+			return self._graph
+
+	def _due(self):
+		reload_seconds = app.config.get('FOLLOW_GRAPH_RELOAD_SECONDS', 60)
+		return reload_seconds and time.time() - self._loaded >= reload_seconds
+
+	def _build(self, load):
+		sources, targets = load()
+		return FollowGraph(sources, targets, app.config.get('FOLLOW_GRAPH_COMPACT_AT', 10000))
+
+	def _reload(self, load, version):
+		graph = None
+		try:
+			with app.app_context():
+				graph = self._build(load)
+		except Exception:
+			app.logger.exception('reloading the follow graph failed')
+		with self._lock:
+			if graph is not None and version == self._version:
+				# Follows committed since the load began may be missing
+				# from it - applying them again is harmless otherwise.
+				for follower_id, followed_id, following in self._replay:
+					if following:
+						graph.follow(follower_id, followed_id)
+					else:
+						graph.unfollow(follower_id, followed_id)
+				self._graph = graph
+			# Also after a failure, so it's retried only once it's due again.
+			self._loaded = time.time()
+			self._replay = None
+			self._thread = None
+
+	def apply(self, changes):
+		"""Input: dict of (follower id, followed id) -> following
+		   Output: Applies committed follows to the graph, and to the
+		   one being reloaded if there is one."""
+		with self._lock:
+			graph = self._graph
+			if graph is None:
+				return
+			if self._replay is not None:
+				self._replay.extend((follower_id, followed_id, following)
+									for (follower_id, followed_id), following in changes.items())
+		for (follower_id, followed_id), following in changes.items():
+			if following:
+				graph.follow(follower_id, followed_id)
+			else:
+				graph.unfollow(follower_id, followed_id)
+
+	def wait(self):
+		"""Blocks until a reload in progress, if any, has been swapped in."""
+		thread = self._thread
+		if thread is not None:
+			thread.join()
+
+	def loaded(self):
+		"""The graph if it's been loaded, else None."""
+		return self._graph
+
+	def reset(self):
+		"""Drops the graph, e.g. after the followers table was changed in
+		   bulk - it's reloaded on next use."""
+		with self._lock:
+			self._graph = None
+			self._version += 1
+
+follow_graph_index = GraphIndex()
+
+### Follows made in a transaction reach the graph when it commits. ###
+
+def record_follows(follower_id, followed_ids, following):
+	"""Input: follower id, ids followed or unfollowed, True for follows
+	   Output: Notes the changes on the session, for the graph to apply
+	   once they're committed."""
+	changes = db.session.info.setdefault('follow_changes', {})
+	for id in followed_ids:
+		changes[(follower_id, id)] = following
+
+def pending_follows():
+	"""Dict of (follower id, followed id) -> following for the changes in
+	   the current transaction, which the graph doesn't have yet."""
+	return db.session.info.get('follow_changes')
+
+@db.event.listens_for(Session, 'after_commit')
+def apply_follows(session):
+	changes = session.info.pop('follow_changes', None)
+	if changes:
+		follow_graph_index.apply(changes)
+
+@db.event.listens_for(Session, 'after_transaction_end')
+def discard_follows(session, transaction):
+	# Only the outermost transaction leaves no session.transaction behind.
+	# Whatever it didn't commit was rolled back.
+	if session.transaction is None:
+		session.info.pop('follow_changes', None)
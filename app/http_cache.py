@@ -0,0 +1,104 @@
+# Conditional GET (ETag/Last-Modified) and Cache-Control for the feed pages.
+import time
+from functools import wraps
+from hashlib import md5
+
+from flask import g, request, session, make_response
+
+from app import app
+from app.models import User
+from app.search import backend_name, search_backend
+
+# Cache-Control per view, overridable w/ the CACHE_CONTROL config dict.
+# Pages are per user, so they're always private.
+CACHE_CONTROL = {
+	'index': 'private, no-cache',
+	'user': 'private, no-cache',
+	'search_results': 'private, max-age=60',
+}
+
+def conditional(validators):
+	"""Decorator for GET views. validators(**view_args) returns the list of
+	   values the page depends on and its last modified time - None if no
+	   time moves w/ every change - or None to skip caching. If the
+	   request's If-None-Match/If-Modified-Since match, a 304 is returned
+	   before the view runs its queries or renders."""
+	def decorator(view):
+		@wraps(view)
+		def wrapper(*args, **kwargs):
+			# Pages w/ flashed messages are one-offs.
+			if request.method != 'GET' or '_flashes' in session:
+				return view(*args, **kwargs)
+			validated = validators(**kwargs)
+			if validated is None:
+				return view(*args, **kwargs)
+			parts, last_modified = validated
+
+			not_modified = set_validators(app.response_class(), view.__name__, parts, last_modified)
+			not_modified.make_conditional(request)
+			if not_modified.status_code == 304:
+				return not_modified
+
+			response = make_response(view(*args, **kwargs))
+			if response.status_code == 200:
+				set_validators(response, view.__name__, parts, last_modified)
+			return response
+		return wrapper
+	return decorator
+
+def set_validators(response, view, parts, last_modified):
+	"""Sets the ETag, Last-Modified and caching headers on a response."""
+	# Every page embeds the viewer and a CSRF token for the search form.
+	# Tokens are good for WTF_CSRF_TIME_LIMIT seconds, so the ETag rolls
+	# over once per period, which also bounds how long renamed authors
+	# keep their old nickname in a cached feed.
+	period = int(time.time() // app.config.get('WTF_CSRF_TIME_LIMIT', 3600))
+	viewer = [g.user.id, g.user.nickname, g.user.email_hash, g.user.follows_changed]
+	response.set_etag(md5(repr([request.path, period] + viewer + parts)).hexdigest())
+	if last_modified is not None:
+		response.last_modified = last_modified
+	response.headers['Cache-Control'] = app.config.get('CACHE_CONTROL', {}).get(view, CACHE_CONTROL[view])
+	response.vary.add('Cookie')
+	return response
+
+def newest(*times):
+	"""Latest of the given times, ignoring missing ones."""
+	times = [t for t in times if t is not None]
+	return max(times) if times else None
+
+def own_suggestions(user):
+	"""The viewer's who-to-follow suggestions if it's their own page, else [].
+	   Kept on g, as the ETag and the page both need them."""
+	if user.id != g.user.id:
+		return []
+	suggestions = g.get('own_suggestions')
+	if suggestions is None:
+		suggestions = g.own_suggestions = user.suggestions()
+	return suggestions
+
+### Validators for each view ###
+
+def index_validators(page=None):
+	"""The home page changes when a followed user posts or the follows change."""
+	newest_post = g.user.newest_followed_post()
+	return [request.args.get('before'), newest_post], newest(newest_post, g.user.follows_changed)
+
+def user_validators(nickname, page=None):
+	"""A profile changes w/ the user's row, their newest post and whether the viewer follows them.
+	   No Last-Modified - editing the profile leaves no time to go by, so a
+	   client revalidating w/ If-Modified-Since alone would keep the old one."""
+	user = User.query.filter_by(nickname=nickname).first()
+	if user is None:
+		return None
+	newest_post = user.newest_post()
+	parts = [request.args.get('before'), newest_post, user.id, user.nickname, user.email_hash,
+			 user.about_me, user.last_seen, user.followers_count, user.followed_count, user.posts_count]
+	# Your own page lists your suggestions, which change w/ each refresh.
+	parts.append([(suggested.id, mutual_count) for suggested, mutual_count in own_suggestions(user)])
+	return parts, None
+
+def search_validators(query, page=1):
+	"""Search results change whenever the search index does - new posts once
+	   they're indexed, edits and deletes too. No Last-Modified, as posts
+	   indexed late and edits don't move any time forward."""
+	return [query, backend_name(), search_backend().generation()], None
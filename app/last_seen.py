@@ -0,0 +1,105 @@
+# Buffers users' last seen times so page views aren't write transactions.
+import atexit
+import threading
+import time
+from datetime import timedelta
+
+from app import app, db
+from app.models import User
+from app.user_cache import user_cache
+
+class LastSeenTracker(object):
+	"""Per-process buffer of last seen times.
+	   Timestamps are held in memory and written with one bulk UPDATE once
+	   LAST_SEEN_BATCH_SIZE users are pending or LAST_SEEN_FLUSH_INTERVAL
+	   seconds have passed since the last flush - a background thread
+	   checks the interval too, so an idle worker doesn't sit on its
+	   visits. Visits within LAST_SEEN_GRANULARITY seconds of the
+	   recorded time are skipped."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		# user id -> newest unwritten last seen time
+		self._pending = {}
+		self._last_flush = time.time()
+		self._thread = None
+		self.stats = {
+			'touches': 0, # visits reported
+			'skipped': 0, # visits inside the granularity window
+			'flushes': 0, # bulk updates run
+			'rows_flushed': 0, # users written across all flushes
+			'last_flush_rows': 0,
+			'last_flush_seconds': 0.0, # time the last bulk update took
+		}
+
+	def touch(self, user, now):
+		"""Input: user object, time they were seen
+		   Output: Records the visit, flushing if the buffer is due."""
+		granularity = timedelta(seconds=app.config.get('LAST_SEEN_GRANULARITY', 60))
+		with self._lock:
+			self.stats['touches'] += 1
+			recorded = self._pending.get(user.id, user.last_seen)
+			if recorded is not None and now - recorded < granularity:
+				self.stats['skipped'] += 1
+				return
+			self._pending[user.id] = now
+			# Started on first use, so each forked worker gets its own.
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name='last-seen-flusher')
+				self._thread.daemon = True
+				self._thread.start()
+			due = len(self._pending) >= app.config.get('LAST_SEEN_BATCH_SIZE', 100) or \
+				time.time() - self._last_flush >= app.config.get('LAST_SEEN_FLUSH_INTERVAL', 30)
+		if due:
+			self.flush()
+
+	def flush(self):
+		"""Writes every pending last seen time in one bulk UPDATE.
+		   Returns the number of users written."""
+		with self._lock:
+			pending, self._pending = self._pending, {}
+			self._last_flush = time.time()
+		if not pending:
+			return 0
+
+		started = time.time()
+		# Own transaction, so the flush never commits the request's session.
+		with db.engine.begin() as connection:
+			connection.execute(
+				User.__table__.update().where(User.id == db.bindparam('user_id')).values(
+					last_seen=db.bindparam('last_seen')),
+				[{'user_id': id, 'last_seen': seen} for id, seen in pending.items()])
+		# Cached snapshots of these users now have a stale last_seen.
+		for id in pending:
+			user_cache.evict(id)
+
+		with self._lock:
+			self.stats['flushes'] += 1
+			self.stats['rows_flushed'] += len(pending)
+			self.stats['last_flush_rows'] = len(pending)
+			self.stats['last_flush_seconds'] = time.time() - started
+		return len(pending)
+
+	def _run(self):
+		while True:
+			with self._lock:
+				wait = self._last_flush + app.config.get('LAST_SEEN_FLUSH_INTERVAL', 30) - time.time()
+			if wait > 0:
+				time.sleep(wait)
+				continue
+			try:
+				self.flush()
+			except Exception:
+				app.logger.exception('flushing last seen times failed')
+
+	def metrics(self):
+		"""Returns a copy of the flush counters plus the current backlog."""
+		with self._lock:
+			metrics = dict(self.stats)
+			metrics['pending'] = len(self._pending)
+		return metrics
+
+last_seen_tracker = LastSeenTracker()
+
+# Don't lose buffered visits when the process shuts down.
+atexit.register(last_seen_tracker.flush)
@@ -2,21 +2,117 @@
 from app import db, app
 # md5 is a hash function that will hash an email and pass it to gravatar
 from hashlib import md5
+# raised when a unique constraint fails on commit
+from sqlalchemy.exc import IntegrityError
+from app.pagination import KeysetPagination, MergedPagination, keyset_source
+from app.graph import follow_graph_enabled, follow_graph_index, record_follows, pending_follows
+# compact id arrays for loading the follow graph
+from array import array
+# for follow graph versions
+from datetime import datetime
 import sys
 
+# sent w/ the models changed by each commit - for the search index
+from flask.ext.sqlalchemy import models_committed
+
+# Whoosh itself is only imported once it's used - see whoosh_index.
 if sys.version_info >= (3, 0):
 	enable_search = False
 else:
 	enable_search = True
-	import flask.ext.whooshalchemy as whooshalchemy
 
 # Create a followers table.
 # Not a class as it's an association table - the table is only foreign keys.
 followers = db.Table('followers',
     db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+    # One row per pair - also serves follow checks from the index alone.
+    db.Index('ix_followers_follower_followed', 'follower_id', 'followed_id', unique=True)
+)
+
+# Materialized per-user timeline - one row per post per follower, written
+# when a post is made (fan-out on write). The primary key is
+# (follower_id, timestamp, post_id), so a user's home page is a single range
+# scan instead of a join of followers against every followed user's posts.
+# author_id is kept so an unfollow can prune rows without touching post.
+timeline = db.Table('timeline',
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('timestamp', db.DateTime, primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Column('author_id', db.Integer, db.ForeignKey('user.id')),
+    db.Index('ix_timeline_follower_author', 'follower_id', 'author_id')
 )
 
+# Precomputed who-to-follow suggestions - the top SUGGESTIONS_PER_USER users
+# each user doesn't follow yet, ranked by how many of the people they follow
+# follow them. Rewritten in bulk by app/recommend.py; the primary key makes
+# a user's list one range scan.
+suggestion = db.Table('suggestion',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('rank', db.Integer, primary_key=True),
+    db.Column('suggested_id', db.Integer, db.ForeignKey('user.id')),
+    db.Column('mutual_count', db.Integer)
+)
+
+def hash_email(email):
+	"""Returns the gravatar hash of an email address."""
+	return md5(email.encode('utf-8')).hexdigest()
+
+# (email hash, size) -> avatar url
+_avatar_urls = {}
+
+def avatar_url(email_hash, size):
+	"""Returns the gravatar url for an email hash, memoized
+	   since the same few authors show up all over a page."""
+	key = (email_hash, size)
+	url = _avatar_urls.get(key)
+	if url is None:
+		# Keep the cache bounded - it's cheap to refill.
+		if len(_avatar_urls) >= app.config.get('AVATAR_CACHE_SIZE', 10000):
+			_avatar_urls.clear()
+		url = _avatar_urls[key] = 'http://www.gravatar.com/avatar/%s?d=mm&s=%d' % (email_hash, size)
+	return url
+
+def timeline_enabled():
+	"""True if the materialized timeline should be written and read.
+	   Off by default - the followers join in followed_posts is the fallback."""
+	return app.config.get('TIMELINE_ENABLED', False)
+
+def follow_graph():
+	"""The in-process FollowGraph, loaded from the followers table on
+	   first use. Only for when FOLLOW_GRAPH_ENABLED is on."""
+	return follow_graph_index.graph(load_committed_follow_edges)
+
+def load_committed_follow_edges():
+	"""load_follow_edges on a connection of its own, outside the request's
+	   transaction - its uncommitted follows would otherwise be baked into
+	   the graph, and stay there if it rolled back."""
+	with db.engine.connect() as connection:
+		return load_follow_edges(connection=connection)
+
+def load_follow_edges(batch_size=10000, connection=None):
+	"""Returns arrays of the follower and followed ids of every follow,
+	   streamed from the followers table a batch at a time - on the
+	   given connection, or the session's."""
+	sources, targets = array('i'), array('i')
+	result = (connection or db.session).execute(db.select([followers.c.follower_id, followers.c.followed_id]))
+	while True:
+		rows = result.fetchmany(batch_size)
+		if not rows:
+			break
+		for follower_id, followed_id in rows:
+			sources.append(follower_id)
+			targets.append(followed_id)
+	return sources, targets
+
+def fan_out_limit():
+	"""Follower count above which a user's posts aren't copied into their
+	   followers' timelines but pulled in when the timeline is read - the
+	   hybrid mode. None (the default) fans out every post."""
+	if not timeline_enabled():
+		return None
+	return app.config.get('TIMELINE_FANOUT_LIMIT')
+
 # each class represents a table - define a table here
 class User(db.Model):
 	
@@ -29,6 +125,9 @@ class User(db.Model):
 	
 	# or maximum length
 	email = db.Column(db.String(120), index=True, unique=True)
+
+	# md5 of the email for gravatar - kept in step w/ email by set_email_hash
+	email_hash = db.Column(db.String(32))
 	
 	# foreign key - one to many relationship - defined on the 'one' side
 	# first argument - 'many' class of the relationship
@@ -38,6 +137,17 @@ class User(db.Model):
 	about_me = db.Column(db.String(140))
 	last_seen = db.Column(db.DateTime)
 
+	# Denormalized counts so profiles don't run an aggregate for each.
+	# Kept in step by follow/unfollow and by Post inserts/deletes;
+	# reconcile_counters recomputes them if they drift.
+	followers_count = db.Column(db.Integer, default=0)
+	followed_count = db.Column(db.Integer, default=0)
+	posts_count = db.Column(db.Integer, default=0)
+
+	# When the set of users this user follows last changed - a version
+	# of their feed's follow graph for conditional GETs.
+	follows_changed = db.Column(db.DateTime)
+
 	# Declare many-to-many relationship b/w followers/followed.
 	followed = db.relationship('User', # right-side entity (left-side entity is the parent class)
 								secondary=followers, # association table used for the relationship
@@ -68,8 +178,9 @@ class User(db.Model):
 	def avatar(self, size):
 		"""Returns the avatar for the hashed e-mail.
 		   If there's no account, return 'mm' (aka mystery man) avatar."""
-		return 'http://www.gravatar.com/avatar/%s?d=mm&s=%d' % \
-			(md5(self.email.encode('utf-8')).hexdigest(), size)
+		# Rows from before email_hash existed are hashed on the fly.
+		email_hash = self.email_hash or hash_email(self.email)
+		return avatar_url(email_hash, size)
 
 	#### Following methods - add/remove relationships b/w users. ###
 
@@ -78,10 +189,14 @@ class User(db.Model):
 		   Output: If not already following, make the 
 		   given user follow another user by adding an 
 		   entry to the association table."""
-		if not self.is_following(user):
+		if not self.is_following(user, check_db=True):
 
 			# SQLAlchemy handles adding this to the assoc table.
 			self.followed.append(user)
+			self.count_follows([user], 1)
+			self.track_follows([user], True)
+			if timeline_enabled():
+				self.backfill_timeline([user])
 			return self
 
 	def unfollow(self, user):
@@ -89,21 +204,173 @@ class User(db.Model):
 		   Output: If already following, make the 
 		   given user unfollow another user by removing an 
 		   entry from the association table."""
-		if self.is_following(user):
+		if self.is_following(user, check_db=True):
 
 			# SQLAlchemy handles removing this from the assoc table.
 			self.followed.remove(user)
+			self.count_follows([user], -1)
+			self.track_follows([user], False)
+			if timeline_enabled():
+				self.prune_timeline([user])
+				restore_fan_out([user])
 			return self
 
-	def is_following(self, user):
-		"""Input: user object, other user object
+	def is_following(self, user, check_db=False):
+		"""Input: user object, other user object, True to ask the db
+		   even w/ the follow graph on
 		   Output: Boolean; True if the given user 
 		   is following another user."""
 
-		# Because lazy is 'dynamic', filter returns the query object,
-		# not the result of the query. Calling count() executes the 
-		# query and returns the count.
-		return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+		# The graph may not have other processes' latest follows yet, so
+		# follows and unfollows check the db - a stale answer would
+		# insert a duplicate follow or skip an unfollow.
+		if follow_graph_enabled() and not check_db:
+			# Unlike a query the graph doesn't autoflush, so flush
+			# new users to give them ids.
+			if self.id is None or user.id is None:
+				db.session.flush()
+			return user.id in self.is_following_many([user.id])
+		# EXISTS stops at the first matching row of the
+		# (follower_id, followed_id) index rather than counting.
+		return db.session.query(db.exists().where(db.and_(
+			followers.c.follower_id == self.id,
+			followers.c.followed_id == user.id))).scalar()
+
+	def is_following_many(self, ids, check_db=False):
+		"""Input: user object, iterable of user ids, True to ask the db
+		   even w/ the follow graph on (see is_following)
+		   Output: Set of the ids the given user is following,
+		   found w/ one query instead of one per id."""
+		ids = set(ids)
+		if not ids:
+			return set()
+		if follow_graph_enabled() and not check_db:
+			return follow_graph().following_many(self.id, ids, pending_follows())
+		return set(row.followed_id for row in db.session.query(followers.c.followed_id).filter(
+			followers.c.follower_id == self.id,
+			followers.c.followed_id.in_(ids)))
+
+	def suggestions(self):
+		"""Input: user object
+		   Output: List of (user, mutual follow count) pairs of users the
+		   given user might follow, best first. These are precomputed;
+		   anyone followed since is left out."""
+		rows = db.session.query(User, suggestion.c.mutual_count).join(
+			suggestion, suggestion.c.suggested_id == User.id).filter(
+			suggestion.c.user_id == self.id).order_by(suggestion.c.rank).all()
+		following = self.is_following_many(user.id for user, mutual_count in rows)
+		return [(user, mutual_count) for user, mutual_count in rows if user.id not in following]
+
+	def follow_many(self, users):
+		"""Input: user object, list of user objects
+		   Output: Makes the given user follow every user in the list
+		   they aren't already following, w/ one insert for all of them.
+		   Returns the list of users newly followed."""
+		already = self.is_following_many((user.id for user in users), check_db=True)
+		new = []
+		for user in users:
+			if user.id not in already:
+				already.add(user.id)
+				new.append(user)
+		if new:
+			db.session.execute(followers.insert(),
+				[{'follower_id': self.id, 'followed_id': user.id} for user in new])
+			self.count_follows(new, 1)
+			self.track_follows(new, True)
+			if timeline_enabled():
+				self.backfill_timeline(new)
+		return new
+
+	def unfollow_many(self, users):
+		"""Input: user object, list of user objects
+		   Output: Makes the given user unfollow every user in the list
+		   w/ one delete. Returns the list of users unfollowed."""
+		following = self.is_following_many((user.id for user in users), check_db=True)
+		old = []
+		for user in users:
+			# Each once, even if listed twice, or the counts drift.
+			if user.id in following:
+				following.discard(user.id)
+				old.append(user)
+		if old:
+			db.session.execute(followers.delete().where(db.and_(
+				followers.c.follower_id == self.id,
+				followers.c.followed_id.in_([user.id for user in old]))))
+			self.count_follows(old, -1)
+			self.track_follows(old, False)
+			if timeline_enabled():
+				self.prune_timeline(old)
+				restore_fan_out(old)
+		return old
+
+	def count_follows(self, users, delta):
+		"""Input: user object, list of user objects, +1 or -1
+		   Output: Adjusts the given user's followed count and the
+		   users' followers counts in the current transaction."""
+		table = User.__table__
+		# Increment in SQL so concurrent follows don't overwrite each other.
+		db.session.execute(table.update().where(table.c.id == self.id).values(
+			followed_count=db.func.coalesce(table.c.followed_count, 0) + delta * len(users),
+			follows_changed=datetime.utcnow()))
+		db.session.execute(table.update().where(table.c.id.in_([user.id for user in users])).values(
+			followers_count=db.func.coalesce(table.c.followers_count, 0) + delta))
+		# Reload the counts on next access.
+		db.session.expire(self, ['follows_changed'])
+		for user in [self] + users:
+			db.session.expire(user, ['followers_count', 'followed_count'])
+
+	def track_follows(self, users, following):
+		"""Input: user object, list of user objects, True for follows
+		   Output: Passes the changes on to the follow graph, which
+		   applies them once the transaction commits."""
+		if follow_graph_enabled():
+			record_follows(self.id, [user.id for user in users], following)
+
+	### Timeline maintenance ###
+
+	def backfill_timeline(self, users):
+		"""Input: user object, list of followed user objects
+		   Output: Copies the followed users' existing posts
+		   into the given user's timeline. Posts of users over
+		   the fan-out limit are skipped - they're pulled."""
+		ids = [user.id for user in users if user.fans_out()]
+		if not ids:
+			return
+		db.session.execute(timeline.insert().from_select(
+			['follower_id', 'timestamp', 'post_id', 'author_id'],
+			db.select([db.literal(self.id), Post.timestamp, Post.id, Post.user_id]).where(
+				Post.user_id.in_(ids))))
+
+	def fans_out(self):
+		"""Input: User object
+		   Output: Boolean; True if the user's posts are copied into their
+		   followers' timelines, False if they have more followers than
+		   TIMELINE_FANOUT_LIMIT and their posts are pulled at read time."""
+		limit = fan_out_limit()
+		return limit is None or (self.followers_count or 0) <= limit
+
+	def push_posts(self):
+		"""Input: User object
+		   Output: Copies all of the user's posts into their followers'
+		   timelines, skipping the ones already there - for when a user
+		   drops back to the fan-out limit and stops being pulled."""
+		pushed = db.exists().where(db.and_(
+			timeline.c.follower_id == followers.c.follower_id,
+			timeline.c.post_id == Post.id))
+		db.session.execute(timeline.insert().from_select(
+			['follower_id', 'timestamp', 'post_id', 'author_id'],
+			db.select([followers.c.follower_id, Post.timestamp, Post.id, Post.user_id]).where(db.and_(
+				followers.c.followed_id == self.id,
+				Post.user_id == self.id,
+				db.not_(pushed)))))
+
+	def prune_timeline(self, users):
+		"""Input: user object, list of unfollowed user objects
+		   Output: Removes the unfollowed users' posts
+		   from the given user's timeline."""
+		db.session.execute(timeline.delete().where(db.and_(
+			timeline.c.follower_id == self.id,
+			timeline.c.author_id.in_([user.id for user in users]))))
 
 	### Misc. queries ###
 
@@ -111,9 +378,20 @@ class User(db.Model):
 		"""Input: User object
 		   Output: Query for posts of followers of the given user"""
 
+		# Read from the materialized timeline if it's being maintained,
+		# plus the posts of any followed users who are pulled.
+		if timeline_enabled():
+			pulled = self.pulled_authors()
+			if not pulled:
+				return self.timeline_posts()
+			return Post.query.options(db.joinedload('author')).filter(db.or_(
+				Post.id.in_(db.select([timeline.c.post_id]).where(timeline.c.follower_id == self.id)),
+				Post.user_id.in_(pulled))).order_by(Post.timestamp.desc(), Post.id.desc())
+
 		# A query on the Post model/table - returns a query for the posts that 
 		# match the given query (not the temp table created by the join/filter).
-		return Post.query.join(
+		# Authors are loaded in the same query - post.html shows each one.
+		return Post.query.options(db.joinedload('author')).join(
 			# Join the Post table (left) w/ the followers table (right)
 			# given the condition that the followed_id is the user_id of the Post.
 			# i.e., if a user isn't followed, they won't show up.
@@ -121,8 +399,79 @@ class User(db.Model):
 				# Filter the returned (joined) subtable for only those
 				# users the given user is following.
 			 	followers.c.follower_id == self.id).order_by(
-			  		# Order that filtered table by the Post timestamp.
-			  		Post.timestamp.desc())
+			  		# Order that filtered table by the Post timestamp,
+			  		# newest id first for posts made at the same time.
+			  		Post.timestamp.desc(), Post.id.desc())
+
+	def timeline_posts(self):
+		"""Input: User object
+		   Output: Query for the posts in the given user's materialized timeline"""
+
+		# Only the user's own timeline rows are touched - a range scan
+		# on the (follower_id, timestamp, post_id) primary key.
+		return Post.query.options(db.joinedload('author')).join(
+			timeline, (timeline.c.post_id == Post.id)).filter(
+				timeline.c.follower_id == self.id).order_by(
+					timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+
+	def pulled_authors(self):
+		"""Input: User object
+		   Output: ids of the users the given user follows who are over
+		   the fan-out limit, so their posts aren't in the timeline."""
+		limit = fan_out_limit()
+		if limit is None:
+			return []
+		return [id for id, in db.session.query(followers.c.followed_id).join(
+			User, User.id == followers.c.followed_id).filter(
+				followers.c.follower_id == self.id, User.followers_count > limit)]
+
+	def followed_posts_page(self, before, per_page):
+		"""Input: User object, decoded (timestamp, id) cursor or None, page size
+		   Output: KeysetPagination of the posts of followers of the given user"""
+
+		# Key on the timeline's own columns so the scan stays on its primary key.
+		# In hybrid mode the pulled authors' page is merged w/ the timeline's.
+		if timeline_enabled():
+			pulled = self.pulled_authors()
+			if not pulled:
+				return KeysetPagination(self.timeline_posts(), timeline.c.timestamp,
+										timeline.c.post_id, before, per_page)
+			return MergedPagination([
+				keyset_source(self.timeline_posts(), timeline.c.timestamp, timeline.c.post_id),
+				pulled_source(pulled)], before, per_page)
+		return KeysetPagination(self.followed_posts(), Post.timestamp, Post.id, before, per_page)
+
+	def posts_page(self, before, per_page):
+		"""Input: User object, decoded (timestamp, id) cursor or None, page size
+		   Output: KeysetPagination of the given user's own posts"""
+		return KeysetPagination(self.posts.options(db.joinedload('author')),
+								Post.timestamp, Post.id, before, per_page)
+
+	def newest_followed_post(self):
+		"""Input: User object
+		   Output: Timestamp of the newest post of the users the given
+		   user follows, or None. Looks up the newest post of each
+		   followed user on the (user_id, timestamp) index rather
+		   than scanning all of their posts."""
+		if timeline_enabled():
+			times = [db.session.query(db.func.max(timeline.c.timestamp)).filter(
+				timeline.c.follower_id == self.id).scalar()]
+			pulled = self.pulled_authors()
+			if pulled:
+				times.append(db.session.query(db.func.max(Post.timestamp)).filter(
+					Post.user_id.in_(pulled)).scalar())
+			times = [time for time in times if time is not None]
+			return max(times) if times else None
+		newest = db.select([db.func.max(Post.timestamp)]).where(
+			Post.user_id == followers.c.followed_id).as_scalar()
+		return db.session.query(db.func.max(newest)).filter(
+			followers.c.follower_id == self.id).scalar()
+
+	def newest_post(self):
+		"""Input: User object
+		   Output: Timestamp of the given user's newest post, or None."""
+		return db.session.query(db.func.max(Post.timestamp)).filter(
+			Post.user_id == self.id).scalar()
 
 	# tell python how to print the objects of this class
 	def __repr__(self):
@@ -134,15 +483,68 @@ class User(db.Model):
 		"""Given a nickname, check if it's already been taken.
 		   If it has, find the next available number for that nickname
 		   and return the nickname plus that new number."""
-		if User.query.filter_by(nickname=nickname).first() is None:
+
+		if db.session.query(User.id).filter_by(nickname=nickname).first() is None:
 			return nickname
-		version = 2
-		while True:
-			new_nickname = nickname + str(version)
-			if User.query.filter_by(nickname=new_nickname).first() is None:
-				break
-			version += 1
-		return new_nickname
+
+		# The highest number in use, found by the db - one row back rather
+		# than every nickname that starts w/ this one.
+		prefixed = db.and_(User.nickname > nickname, User.nickname < nickname + u'\uffff')
+		suffix = db.func.substr(User.nickname, len(nickname) + 1)
+		digits = all_digits(suffix)
+		if digits is not None:
+			highest = db.session.query(db.func.max(db.cast(suffix, db.Integer))).filter(
+				prefixed, digits).scalar()
+		else:
+			# No way to ask this db, so look at each of them here.
+			suffixes = [int(row.nickname[len(nickname):]) for row in
+						db.session.query(User.nickname).filter(prefixed)
+						if row.nickname[len(nickname):].isdigit()]
+			highest = max(suffixes) if suffixes else None
+		return nickname + str(max(highest or 1, 1) + 1)
+
+	@staticmethod
+	def create_with_unique_nickname(nickname, email, retries=5):
+		"""Adds and commits a new user w/ a unique version of the nickname.
+		   If a concurrent sign-up takes the same nickname first, the unique
+		   constraint fails the commit and the next free nickname is tried;
+		   any other failure (a taken email, say) is raised right away."""
+		for attempt in range(retries):
+			user = User(nickname=User.make_unique_nickname(nickname), email=email)
+			db.session.add(user)
+			try:
+				db.session.commit()
+				return user
+			except IntegrityError:
+				db.session.rollback()
+				# Only worth another try if the nickname is what was taken.
+				taken = db.session.query(User.id).filter_by(nickname=user.nickname).first() is not None
+				if attempt == retries - 1 or not taken:
+					raise
+
+def all_digits(expression):
+	"""Input: string sql expression
+	   Output: sql condition that it's made of digits only, or None
+	   if the db in use has no pattern match to say so"""
+	dialect = db.engine.dialect.name
+	if dialect == 'sqlite':
+		return db.and_(expression != u'', ~expression.op('GLOB')(u'*[^0-9]*'))
+	if dialect == 'postgresql':
+		return expression.op('~')(u'^[0-9]+$')
+	if dialect == 'mysql':
+		return expression.op('REGEXP')(u'^[0-9]+$')
+	return None
+
+@db.event.listens_for(User.email, 'set')
+def set_email_hash(user, email, old_email, initiator):
+	"""Recomputes the stored email hash whenever a user's email is set."""
+	user.email_hash = hash_email(email) if email is not None else None
+
+def count_posts(connection, user_id, delta):
+	"""Adjusts a user's post count in the flush's transaction."""
+	table = User.__table__
+	connection.execute(table.update().where(table.c.id == user_id).values(
+		posts_count=db.func.coalesce(table.c.posts_count, 0) + delta))
 
 class Post(db.Model):
 	"""Represents a post in the db."""
@@ -150,14 +552,174 @@ class Post(db.Model):
 	# Designates which fields will be searchable/indexed.
 	__searchable__ = ['body']
 
+	# Composite index for paging through a user's posts by timestamp.
+	__table_args__ = (db.Index('ix_post_user_timestamp', 'user_id', 'timestamp'),)
+
 	id = db.Column(db.Integer, primary_key=True)
 	body = db.Column(db.String(140))
 	timestamp = db.Column(db.DateTime)
 	user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
+	def fan_out(self):
+		"""Copies the post into the timeline of every follower of its author,
+		   unless the author is over the fan-out limit and is pulled instead.
+		   The post must have been flushed so it has an id."""
+		if not self.author.fans_out():
+			return
+		db.session.execute(timeline.insert().from_select(
+			['follower_id', 'timestamp', 'post_id', 'author_id'],
+			db.select([followers.c.follower_id,
+					   db.literal(self.timestamp, db.DateTime),
+					   db.literal(self.id),
+					   db.literal(self.user_id)]).where(
+				followers.c.followed_id == self.user_id)))
+
 	def __repr__(self):
 		return '<Post %r>' % (self.body)
 
+@db.event.listens_for(Post, 'after_insert')
+def count_inserted_post(mapper, connection, post):
+	count_posts(connection, post.user_id, 1)
+
+@db.event.listens_for(Post, 'after_delete')
+def count_deleted_post(mapper, connection, post):
+	count_posts(connection, post.user_id, -1)
+
+def rebuild_timelines():
+	"""Throws away every materialized timeline and rebuilds them
+	   from the followers table, leaving out the users over the
+	   fan-out limit. Returns the number of rows written."""
+	pushed = followers.c.followed_id == Post.user_id
+	limit = fan_out_limit()
+	if limit is not None:
+		pushed = db.and_(pushed, Post.user_id.in_(
+			db.select([User.id]).where(db.func.coalesce(User.followers_count, 0) <= limit)))
+	db.session.execute(timeline.delete())
+	db.session.execute(timeline.insert().from_select(
+		['follower_id', 'timestamp', 'post_id', 'author_id'],
+		db.select([followers.c.follower_id, Post.timestamp, Post.id, Post.user_id]).where(pushed)))
+	db.session.commit()
+	return db.session.execute(db.select([db.func.count()]).select_from(timeline)).scalar()
+
+# SQLite's cap on the SELECTs in one UNION.
+MAX_COMPOUND_SELECT = 500
+
+def pulled_source(ids):
+	"""Input: ids of pulled authors
+	   Output: A MergedPagination source for their posts. Each author's
+	   page is its own range scan of the (user_id, timestamp) index - a
+	   single IN query would sort every post they've made - UNION ALL'd
+	   into one statement, and only the winning page is loaded. The SQL
+	   is written out since compiling a union per author per page costs
+	   more than running it."""
+	def fetch(before, older, limit):
+		if before is None:
+			cursor = ''
+		else:
+			cursor = ' AND %s(timestamp < :timestamp OR (timestamp = :timestamp AND id < :id))' % (
+				'' if older else 'NOT ')
+		direction = 'DESC' if older else 'ASC'
+		order = 'ORDER BY timestamp %s, id %s LIMIT :limit' % (direction, direction)
+		params = {'limit': limit}
+		if before is not None:
+			params['timestamp'], params['id'] = before
+		keys = []
+		for start in range(0, len(ids), MAX_COMPOUND_SELECT):
+			pages = []
+			for index, id in enumerate(ids[start:start + MAX_COMPOUND_SELECT]):
+				# SQLite only takes ORDER BY/LIMIT on a union member as a
+				# subquery - aliased, as Postgres and MySQL want every one named.
+				pages.append('SELECT * FROM (SELECT id, timestamp FROM post WHERE user_id = :user%d%s %s) AS page%d' % (
+					index, cursor, order, index))
+				params['user%d' % index] = id
+			query = db.text('SELECT id, timestamp FROM (%s) AS pages %s' % (' UNION ALL '.join(pages), order),
+							typemap={'timestamp': db.DateTime})
+			if before is not None:
+				query = query.bindparams(db.bindparam('timestamp', type_=db.DateTime))
+			keys.extend(db.session.execute(query, params))
+		keys.sort(key=lambda key: (key.timestamp, key.id), reverse=older)
+		ids_on_page = [key.id for key in keys[:limit]]
+		if not ids_on_page:
+			return []
+		posts = dict((post.id, post) for post in Post.query.options(
+			db.joinedload('author')).filter(Post.id.in_(ids_on_page)))
+		return [posts[id] for id in ids_on_page if id in posts]
+	return fetch
+
+def restore_fan_out(users):
+	"""Input: list of just unfollowed user objects
+	   Output: Pushes the posts of any of the users who dropped back to
+	   the fan-out limit, which were pulled until now."""
+	limit = fan_out_limit()
+	if limit is None:
+		return
+	for user in users:
+		if user.followers_count == limit:
+			user.push_posts()
+
+def backfill_email_hashes(batch_size=1000):
+	"""Fills in email_hash for users created before the column existed.
+	   Commits every batch_size users. Returns the number of users updated."""
+	updated = 0
+	while True:
+		users = User.query.filter(User.email_hash == None, User.email != None).limit(batch_size).all()
+		if not users:
+			return updated
+		for user in users:
+			user.email_hash = hash_email(user.email)
+		db.session.commit()
+		updated += len(users)
+
+def reconcile_counters():
+	"""Recomputes every user's follower, followed and post counts
+	   w/ one bulk UPDATE per counter. Returns the drift found as a
+	   list of (user id, counter, stored value, actual value)."""
+	table = User.__table__
+	# counter -> count it should equal, correlated to each user row
+	actual_counts = [
+		('followers_count', db.select([db.func.count()]).where(
+			followers.c.followed_id == table.c.id).as_scalar()),
+		('followed_count', db.select([db.func.count()]).where(
+			followers.c.follower_id == table.c.id).as_scalar()),
+		('posts_count', db.select([db.func.count()]).where(
+			Post.__table__.c.user_id == table.c.id).as_scalar()),
+	]
+	drift = []
+	for name, actual in actual_counts:
+		stored = table.c[name]
+		wrong = db.or_(stored == None, stored != actual)
+		for id, value, count in db.session.execute(
+				db.select([table.c.id, stored, actual]).where(wrong).order_by(table.c.id)):
+			drift.append((id, name, value, count))
+		db.session.execute(table.update().where(wrong).values({name: actual}))
+	db.session.commit()
+	return drift
+
+def whoosh_index(reopen=False):
+	"""Returns the Whoosh index of posts, opening (or creating) it on
+	   first use, so importing the app doesn't load Whoosh. reopen=True
+	   opens it again, e.g. after WHOOSH_BASE was changed."""
+	import flask.ext.whooshalchemy as whooshalchemy
+	# whooshalchemy indexes every commit once it's imported;
+	# index_committed_posts decides when to instead.
+	models_committed.disconnect(whooshalchemy._after_flush)
+	indexes = getattr(app, 'whoosh_indexes', {})
+	if reopen or Post.__name__ not in indexes:
+		return whooshalchemy.whoosh_index(app, Post)
+	return indexes[Post.__name__]
+
 if enable_search:
-	# Initializes the full-text index.
-	whooshalchemy.whoosh_index(app, Post)
\ No newline at end of file
+	@models_committed.connect
+	def index_committed_posts(sender, changes):
+		"""Indexes committed posts in Whoosh when it's the search backend -
+		   during the commit, or in the background w/ SEARCH_INDEX_ASYNC."""
+		from app.search import backend_name
+		if backend_name() != 'whoosh' or not any(isinstance(model, Post) for model, operation in changes):
+			return
+		if app.config.get('SEARCH_INDEX_ASYNC', False):
+			from app.search_index import index_queue
+			index_queue.on_commit(sender, changes)
+		else:
+			whoosh_index()
+			import flask.ext.whooshalchemy as whooshalchemy
+			whooshalchemy._after_flush(app, changes)
@@ -0,0 +1,137 @@
+# for decoding cursors back into timestamps
+from datetime import datetime
+# for merging pages from several queries
+import heapq
+
+from app import db
+
+# Cursors are '<timestamp>_<id>' of the last post on a page,
+# e.g. '20150128103000123456_42'.
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+def encode_cursor(post):
+	"""Returns the cursor pointing just past the given post."""
+	return '%s_%d' % (post.timestamp.strftime(CURSOR_FORMAT), post.id)
+
+def decode_cursor(cursor):
+	"""Returns the (timestamp, id) pair for a cursor,
+	   or None if the cursor is malformed."""
+	try:
+		timestamp, id = cursor.split('_')
+		return datetime.strptime(timestamp, CURSOR_FORMAT), int(id)
+	except ValueError:
+		return None
+
+class KeysetPagination(object):
+	"""A page of posts fetched by (timestamp, id) cursor rather than OFFSET,
+	   so deep pages cost the same as the first one.
+	   Has the items/has_prev/has_next parts of flask-sqlalchemy's Pagination
+	   that the templates use, with prev_cursor/next_cursor in place of page numbers."""
+
+	def __init__(self, query, timestamp_column, id_column, before, per_page):
+		"""Input: query for the posts, the columns to order by,
+		   the decoded (timestamp, id) cursor or None for the first page,
+		   and the number of posts per page."""
+		self.per_page = per_page
+		self.sources = [keyset_source(query, timestamp_column, id_column)]
+		self._paginate(before)
+
+	def _paginate(self, before):
+		# One extra row tells us whether there's another page.
+		items = self._fetch(before, older=True)
+		self.items = items[:self.per_page]
+		self.has_next = len(items) > self.per_page
+		self.next_cursor = encode_cursor(self.items[-1]) if self.has_next else None
+
+		# The previous page ends with the post the cursor points past, so its
+		# cursor is the post a page above that one. If there's no such post
+		# the previous page is the first page (no cursor).
+		self.has_prev = before is not None
+		self.prev_cursor = None
+		if self.has_prev:
+			newer = self._fetch(before, older=False)
+			if len(newer) > self.per_page:
+				self.prev_cursor = encode_cursor(newer[-1])
+
+	def _fetch(self, before, older):
+		return self.sources[0](before, older, self.per_page + 1)
+
+def keyset_order(timestamp_column, id_column, before, older):
+	"""Input: the columns to order by, decoded cursor or None, direction
+	   Output: (filter or None, order_by columns) for the posts older than
+	   the cursor newest first, or not older than it (older=False) oldest first."""
+	if older:
+		criterion = older_than(timestamp_column, id_column, before) if before is not None else None
+		return criterion, [timestamp_column.desc(), id_column.desc()]
+	return db.not_(older_than(timestamp_column, id_column, before)), [timestamp_column.asc(), id_column.asc()]
+
+def older_than(timestamp_column, id_column, cursor):
+	"""Row comparison (timestamp, id) < cursor, spelled
+	   out since SQLite doesn't support row values."""
+	timestamp, id = cursor
+	return db.or_(timestamp_column < timestamp,
+				  db.and_(timestamp_column == timestamp, id_column < id))
+
+def keyset_source(query, timestamp_column, id_column):
+	"""Returns a fetch(before, older, limit) function giving up to limit
+	   posts from the query on either side of a cursor (see keyset_order)."""
+	# Ordering is done here - newest first for this page,
+	# oldest first when looking back for the previous one.
+	query = query.order_by(None)
+	def fetch(before, older, limit):
+		criterion, order = keyset_order(timestamp_column, id_column, before, older)
+		page = query if criterion is None else query.filter(criterion)
+		return page.order_by(*order).limit(limit).all()
+	return fetch
+
+class _Newest(object):
+	"""Heap entry ordering posts newest first."""
+	__slots__ = ('key', 'post')
+
+	def __init__(self, post):
+		self.key = (post.timestamp, post.id)
+		self.post = post
+
+	def __lt__(self, other):
+		return self.key > other.key
+
+class _Oldest(_Newest):
+	"""Heap entry ordering posts oldest first."""
+	__slots__ = ()
+
+	def __lt__(self, other):
+		return self.key < other.key
+
+def merge_posts(sources, newest_first, limit):
+	"""Input: lists of posts each sorted by (timestamp, id), the direction
+	   they're sorted in, and the max number of posts to return
+	   Output: Up to limit posts from all the lists in the same order,
+	   merged w/ a heap. A post in more than one list appears once."""
+	entry = _Newest if newest_first else _Oldest
+	merged = []
+	last = None
+	for item in heapq.merge(*[[entry(post) for post in posts] for posts in sources]):
+		# Copies of a post have the same key, so they come out together.
+		if item.key != last:
+			merged.append(item.post)
+			last = item.key
+			if len(merged) == limit:
+				break
+	return merged
+
+class MergedPagination(KeysetPagination):
+	"""KeysetPagination over several sources at once, e.g. a user's
+	   timeline plus the posts of the accounts it doesn't hold. Each source
+	   fetches one page's worth around the cursor and the pages are merged,
+	   so the cost is per source, not per post in them."""
+
+	def __init__(self, sources, before, per_page):
+		"""Input: list of fetch functions (see keyset_source), the decoded
+		   cursor or None for the first page, and the number of posts per page."""
+		self.per_page = per_page
+		self.sources = sources
+		self._paginate(before)
+
+	def _fetch(self, before, older):
+		limit = self.per_page + 1
+		return merge_posts([fetch(before, older, limit) for fetch in self.sources], older, limit)
@@ -0,0 +1,130 @@
+# Group commit for new posts - many requests' posts share one transaction.
+import threading
+import time
+try:
+	from queue import Queue, Empty
+except ImportError:
+	# Python 2
+	from Queue import Queue, Empty
+
+from concurrent.futures import Future
+
+from app import app, db
+from app.models import Post, timeline_enabled
+from app.user_cache import user_cache
+
+def post_writer_enabled():
+	"""True if new posts should go through the group-commit writer.
+	   Off by default - each request commits its own post."""
+	return app.config.get('POST_WRITER_ENABLED', False)
+
+class PostWriter(object):
+	"""Queue of new posts, written by one background thread. Once a post
+	   arrives the thread waits up to POST_WRITER_DELAY seconds (a few ms)
+	   for more, up to POST_WRITER_BATCH_SIZE, then inserts them, fans them
+	   out and commits them together - one fsync, and one search index
+	   commit, for the lot. Each submitter waits on its post's future."""
+
+	def __init__(self):
+		self._queue = Queue()
+		self._lock = threading.Lock()
+		self._thread = None
+		self.stats = {
+			'submitted': 0,
+			'written': 0, # posts committed
+			'failed': 0, # posts that couldn't be written, even on their own
+			'batches': 0, # transactions committed
+			'last_batch_size': 0,
+			'last_batch_seconds': 0.0, # time the last transaction took
+		}
+
+	def submit(self, user_id, body, timestamp):
+		"""Input: author id, post body, post time
+		   Output: Future for the new post's id. Starts the writer
+		   thread on first use, so each forked worker gets its own."""
+		future = Future()
+		with self._lock:
+			self.stats['submitted'] += 1
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name='post-writer')
+				self._thread.daemon = True
+				self._thread.start()
+		self._queue.put((user_id, body, timestamp, future))
+		return future
+
+	def status(self):
+		with self._lock:
+			status = dict(self.stats)
+		status['pending'] = self._queue.qsize()
+		return status
+
+	def _run(self):
+		while True:
+			batch = [self._queue.get()]
+			deadline = time.time() + app.config.get('POST_WRITER_DELAY', 0.005)
+			while len(batch) < app.config.get('POST_WRITER_BATCH_SIZE', 100):
+				try:
+					batch.append(self._queue.get(timeout=max(0, deadline - time.time())))
+				except Empty:
+					break
+			try:
+				self._write(batch)
+			except Exception:
+				# A bad post fails the whole transaction, so give each
+				# its own and only fail the ones that fail alone.
+				app.logger.exception('writing %d posts failed, retrying one by one', len(batch))
+				for entry in batch:
+					try:
+						self._write([entry])
+					except Exception as e:
+						entry[3].set_exception(e)
+						with self._lock:
+							self.stats['failed'] += 1
+
+	def _write(self, batch):
+		"""Writes a batch of (user id, body, timestamp, future) in one
+		   transaction, then resolves the futures w/ the post ids."""
+		started = time.time()
+		ids = None
+		with app.app_context():
+			try:
+				posts = [Post(user_id=user_id, body=body, timestamp=timestamp)
+						 for user_id, body, timestamp, future in batch]
+				db.session.add_all(posts)
+				# Flush for the ids - the posts are expired by the commit.
+				db.session.flush()
+				ids = [post.id for post in posts]
+				if timeline_enabled():
+					for post in posts:
+						post.fan_out()
+				db.session.commit()
+			except Exception:
+				# A models_committed receiver (like the synchronous search
+				# index hook) can raise after the posts were committed -
+				# then they're written, and retrying would duplicate them.
+				# A new session, as the old one's transaction may be over.
+				db.session.remove()
+				if ids is None or not self._committed(batch, ids):
+					raise
+				app.logger.exception('committed %d posts, but a commit hook failed', len(batch))
+			finally:
+				db.session.remove()
+		with self._lock:
+			self.stats['written'] += len(batch)
+			self.stats['batches'] += 1
+			self.stats['last_batch_size'] = len(batch)
+			self.stats['last_batch_seconds'] = time.time() - started
+		# The authors' cached copies have stale post counts.
+		for user_id in set(entry[0] for entry in batch):
+			user_cache.evict(user_id)
+		for entry, id in zip(batch, ids):
+			entry[3].set_result(id)
+
+	def _committed(self, batch, ids):
+		"""True if the batch's posts, flushed w/ the given ids, are in the db.
+		   The user and body are checked too, in case the ids of a rolled
+		   back batch were taken by other posts since."""
+		rows = set(db.session.query(Post.id, Post.user_id, Post.body).filter(Post.id.in_(ids)))
+		return rows == set((id, user_id, body) for id, (user_id, body, timestamp, future) in zip(ids, batch))
+
+post_writer = PostWriter()
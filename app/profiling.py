@@ -0,0 +1,120 @@
+# Opt-in per-request profiling - SQL, template and wall time.
+import cProfile
+import os
+import random
+import time
+from datetime import datetime
+
+from flask import g, request, has_request_context
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+class TimedTemplate(Template):
+	"""Template that adds its render time to the request's profile.
+	   Includes and templates rendered from inside a template (e.g. post
+	   fragments) are part of the outermost render, so only that is timed."""
+
+	def render(self, *args, **kwargs):
+		profile = has_request_context() and g.get('profile')
+		if not profile or profile['rendering']:
+			return Template.render(self, *args, **kwargs)
+		profile['rendering'] = True
+		started = time.time()
+		try:
+			return Template.render(self, *args, **kwargs)
+		finally:
+			profile['render_time'] += time.time() - started
+			profile['rendering'] = False
+
+class RequestProfiler(object):
+	"""Records each request's SQL statement count and db time, template
+	   render time and total wall time. Requests slower than
+	   PROFILING_SLOW_REQUEST seconds are logged to the app's log, and a
+	   PROFILING_SAMPLE_RATE fraction of requests are run under cProfile,
+	   w/ the stats dumped to PROFILING_DIR."""
+
+	def __init__(self, app=None):
+		self.app = None
+		self._template_class = None
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.app = app
+		# Run before the other before_request functions so they're timed too.
+		app.before_request_funcs.setdefault(None, []).insert(0, self.start)
+		app.after_request(self.finish)
+		self._template_class = app.jinja_env.template_class
+		app.jinja_env.template_class = TimedTemplate
+		# Templates loaded before now are plain Templates.
+		if app.jinja_env.cache is not None:
+			app.jinja_env.cache.clear()
+		# Listen on every engine so the db can be configured later (e.g. in tests).
+		event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+		event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+
+	def remove(self):
+		"""Undoes init_app - the request hooks, engine listeners and template class."""
+		app = self.app
+		app.before_request_funcs[None].remove(self.start)
+		app.after_request_funcs[None].remove(self.finish)
+		app.jinja_env.template_class = self._template_class
+		if app.jinja_env.cache is not None:
+			app.jinja_env.cache.clear()
+		event.remove(Engine, 'before_cursor_execute', self.before_cursor_execute)
+		event.remove(Engine, 'after_cursor_execute', self.after_cursor_execute)
+		self.app = None
+
+	### Request hooks ###
+
+	def start(self):
+		g.profile = {'queries': 0, 'db_time': 0.0, 'render_time': 0.0,
+					 'rendering': False, 'started': time.time()}
+		if random.random() < self.app.config.get('PROFILING_SAMPLE_RATE', 0.0):
+			g.profiler = cProfile.Profile()
+			g.profiler.enable()
+
+	def finish(self, response):
+		profile = g.get('profile')
+		if profile is None:
+			return response
+		profile['total_time'] = time.time() - profile['started']
+
+		profiler = g.get('profiler')
+		if profiler is not None:
+			profiler.disable()
+			self.dump(profiler)
+
+		if profile['total_time'] >= self.app.config.get('PROFILING_SLOW_REQUEST', 0.5):
+			self.app.logger.warning(
+				'slow request: %s %s %.3fs total, %d queries in %.3fs, %.3fs rendering',
+				request.method, request.path, profile['total_time'],
+				profile['queries'], profile['db_time'], profile['render_time'])
+		return response
+
+	def dump(self, profiler):
+		"""Writes cProfile stats for the request, named by time and endpoint."""
+		directory = self.app.config.get('PROFILING_DIR') or os.path.join(self.app.root_path, '..', 'tmp', 'profiles')
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		name = '%s-%s.prof' % (datetime.utcnow().strftime('%Y%m%d%H%M%S%f'), request.endpoint)
+		profiler.dump_stats(os.path.join(directory, name))
+
+	### Engine hooks ###
+
+	def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+		conn.info.setdefault('profiling_started', []).append(time.time())
+
+	def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+		started = conn.info.get('profiling_started')
+		# Nothing recorded if the statement began before the listeners were added.
+		if not started:
+			return
+		started = started.pop()
+		profile = has_request_context() and g.get('profile')
+		if profile:
+			profile['queries'] += 1
+			profile['db_time'] += time.time() - started
+
+profiler = RequestProfiler()
@@ -0,0 +1,156 @@
+# Who-to-follow suggestions, ranked by mutual follows w/ sparse matrix products.
+import threading
+import time
+
+import numpy
+from scipy import sparse
+
+from app import app, db
+from app.models import suggestion, load_follow_edges
+
+def id_array(ids):
+	"""A numpy view of an array('i') of ids - no copy."""
+	# frombuffer refuses empty buffers.
+	return numpy.frombuffer(ids, dtype=numpy.int32) if ids else numpy.zeros(0, dtype=numpy.int32)
+
+def follow_matrix(sources, targets):
+	"""Input: arrays of follower and followed ids
+	   Output: users x users CSR matrix w/ a 1 where the row's user
+	   follows the column's. Self-follows are left out."""
+	sources, targets = id_array(sources), id_array(targets)
+	keep = sources != targets
+	sources, targets = sources[keep], targets[keep]
+	size = int(max(sources.max(), targets.max())) + 1 if len(sources) else 1
+	follows = sparse.csr_matrix((numpy.ones(len(sources), dtype=numpy.int32), (sources, targets)),
+								shape=(size, size))
+	# Duplicate follows are summed on the way in - count them once.
+	follows.data[:] = 1
+	return follows
+
+def rank_batch(follows, start, end, k, popularity):
+	"""Input: follow matrix, first and last + 1 user of the batch, suggestions
+	   per user, int64 array of each user's follower count
+	   Output: Arrays of user ids, ranks, suggested ids and mutual counts
+	   of the top k suggestions of each user in the batch."""
+	batch = follows[start:end]
+	# Row u of batch x follows counts, for each user c, the users u
+	# follows who follow c - the friend-of-friend candidates.
+	mutual = batch * follows
+	# Take out the user themself and anyone they already follow.
+	users = numpy.arange(end - start)
+	known = batch + sparse.csr_matrix((numpy.ones(end - start, dtype=numpy.int32), (users, users + start)),
+									  shape=batch.shape)
+	mutual = mutual - mutual.multiply(known)
+	mutual.eliminate_zeros()
+	# Sorted columns, so the stable sort below breaks ties by lowest id.
+	mutual.sort_indices()
+	mutual = mutual.tocoo()
+	rows, cols, counts = mutual.row.astype(numpy.int64), mutual.col, mutual.data.astype(numpy.int64)
+	# Best first - most mutual follows, then most followers. Both go in one
+	# int64 key w/ the row, since one sort on it beats a lexsort of three.
+	score = counts * (len(popularity) + 1) + popularity[cols]
+	scores = score.max() + 1 if len(score) else 1
+	order = numpy.argsort(rows * scores + (scores - 1 - score), kind='mergesort')
+	rows, cols, counts = rows[order], cols[order], counts[order]
+	# Each row's candidates are now a sorted run; rank is the place in it.
+	ranks = numpy.arange(len(rows)) - numpy.searchsorted(rows, rows)
+	top = ranks < k
+	return rows[top] + start, ranks[top], cols[top], counts[top]
+
+def suggestion_batches(sources, targets, k=10, batch_size=1000):
+	"""Input: arrays of follower and followed ids, suggestions per user, users per batch
+	   Output: Yields (first user, last user + 1, rank_batch's arrays) for
+	   batch_size users at a time, which bounds the size of the
+	   intermediate product."""
+	follows = follow_matrix(sources, targets)
+	popularity = numpy.asarray(follows.sum(axis=0)).ravel().astype(numpy.int64)
+	users = follows.shape[0]
+	for start in xrange(0, users, batch_size):
+		end = min(start + batch_size, users)
+		yield start, end, rank_batch(follows, start, end, k, popularity)
+
+def compute_suggestions(sources, targets, k=10, batch_size=1000):
+	"""Like suggestion_batches, but yields only rank_batch's arrays."""
+	for start, end, batch in suggestion_batches(sources, targets, k, batch_size):
+		yield batch
+
+def refresh_suggestions(k=None, batch_size=None):
+	"""Recomputes every user's suggestions from the followers table and
+	   replaces the stored ones a batch of users at a time, each batch in
+	   its own short transaction. One transaction for the lot would hold
+	   SQLite's write lock for the whole run, and posts and follows made
+	   meanwhile would time out waiting for it. Returns the number of
+	   rows written."""
+	k = k or app.config.get('SUGGESTIONS_PER_USER', 10)
+	batch_size = batch_size or app.config.get('SUGGESTIONS_BATCH_SIZE', 1000)
+	sources, targets = load_follow_edges()
+	# Don't keep the read transaction open while ranking.
+	db.session.commit()
+	count = 0
+	users = 0
+	for start, end, (user_ids, ranks, suggested, counts) in suggestion_batches(sources, targets, k, batch_size):
+		# tolist() turns numpy's ints into ones the db driver takes.
+		rows = [{'user_id': user_id, 'rank': rank, 'suggested_id': suggested_id, 'mutual_count': mutual_count}
+				for user_id, rank, suggested_id, mutual_count in
+				zip(user_ids.tolist(), ranks.tolist(), suggested.tolist(), counts.tolist())]
+		# The whole id range, so users left w/o suggestions lose their old ones.
+		db.session.execute(suggestion.delete().where(suggestion.c.user_id.between(start, end - 1)))
+		if rows:
+			db.session.execute(suggestion.insert(), rows)
+			count += len(rows)
+		db.session.commit()
+		users = end
+	# Users past the last one in the graph, e.g. deleted ones.
+	db.session.execute(suggestion.delete().where(suggestion.c.user_id >= users))
+	db.session.commit()
+	return count
+
+class SuggestionJob(object):
+	"""Refreshes the suggestions every SUGGESTIONS_INTERVAL seconds, so
+	   pages only look them up. Run it in a process of its own - see
+	   db_suggestions.py --loop - not in gunicorn's master, which forks
+	   new workers while the refresh may hold the logging, pool or
+	   SQLite locks."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.stats = {
+			'runs': 0,
+			'failures': 0,
+			'last_rows': 0, # suggestions written by the last run
+			'last_run_seconds': 0.0,
+			'last_run': None, # time the last run finished
+		}
+
+	def status(self):
+		with self._lock:
+			return dict(self.stats)
+
+	def run_forever(self):
+		while True:
+			self.run_once()
+			time.sleep(app.config.get('SUGGESTIONS_INTERVAL', 3600))
+
+	def run_once(self):
+		"""Refreshes the suggestions now. Returns the rows written, or None on failure."""
+		started = time.time()
+		rows = None
+		with app.app_context():
+			try:
+				rows = refresh_suggestions()
+			except Exception:
+				app.logger.exception('refreshing suggestions failed')
+				db.session.rollback()
+			finally:
+				db.session.remove()
+		with self._lock:
+			self.stats['runs'] += 1
+			if rows is None:
+				self.stats['failures'] += 1
+			else:
+				self.stats['last_rows'] = rows
+				self.stats['last_run_seconds'] = time.time() - started
+				self.stats['last_run'] = time.time()
+		return rows
+
+suggestion_job = SuggestionJob()
@@ -0,0 +1,80 @@
+# Read/write routing - reads from read-only views go to replicas, the rest to the primary.
+import random
+import time
+
+from flask import request, session, has_request_context
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy.sql.expression import Select, TextClause
+
+def replica_reads(view):
+	"""View decorator - GET/HEAD requests to the view may read from a
+	   replica. Put it right under @app.route, so it marks the function
+	   that's registered."""
+	view.replica_reads = True
+	return view
+
+def stick_to_primary(app):
+	"""Sends the user's reads to the primary for REPLICA_STICKY_SECONDS,
+	   after a write made for their request."""
+	if has_request_context() and app.config.get('DATABASE_REPLICAS'):
+		session['_primary_until'] = time.time() + app.config.get('REPLICA_STICKY_SECONDS', 5)
+
+class RoutingSession(SignallingSession):
+	"""Session that sends SELECTs to one of the DATABASE_REPLICAS binds
+	   (keys of SQLALCHEMY_BINDS) when serving a GET to a @replica_reads
+	   view, and everything else to the primary. Once the session writes,
+	   its reads go to the primary too, so it sees its own changes. After
+	   a commit w/ writes, the user's requests stick to the primary for
+	   REPLICA_STICKY_SECONDS, long enough for the replicas to catch up -
+	   e.g. the feed shown after posting includes the new post."""
+
+	def __init__(self, db, **options):
+		SignallingSession.__init__(self, db, **options)
+		self._db = db
+		self._replica = None
+		self._wrote = False
+		self._sticky = False
+
+	def get_bind(self, mapper=None, clause=None):
+		if self._flushing or not self.is_read(clause):
+			self._wrote = True
+		elif self.use_replica():
+			if self._replica is None:
+				# One replica per session, so its reads are consistent.
+				self._replica = random.choice(self.app.config['DATABASE_REPLICAS'])
+			return self._db.get_engine(self.app, bind=self._replica)
+		return SignallingSession.get_bind(self, mapper, clause)
+
+	def is_read(self, clause):
+		"""ORM queries and SELECTs read. Text is taken at its first word;
+		   a bare connection() could be for anything, so it isn't a read."""
+		if isinstance(clause, TextClause):
+			return clause.text.lstrip()[:6].upper() == 'SELECT'
+		return isinstance(clause, Select)
+
+	def use_replica(self):
+		if self._wrote or self._sticky or not self.app.config.get('DATABASE_REPLICAS'):
+			return False
+		if not has_request_context() or request.method not in ('GET', 'HEAD'):
+			return False
+		if session.get('_primary_until', 0) > time.time():
+			return False
+		view = self.app.view_functions.get(request.endpoint)
+		return getattr(view, 'replica_reads', False)
+
+	def commit(self):
+		SignallingSession.commit(self)
+		if self._wrote:
+			self._sticky = True
+			stick_to_primary(self.app)
+
+	def rollback(self):
+		SignallingSession.rollback(self)
+		# Rolled back writes don't need to be read back.
+		self._wrote = False
+
+class RoutingSQLAlchemy(SQLAlchemy):
+	"""Flask-SQLAlchemy whose sessions route reads to the replicas."""
+
+	def create_session(self, options):
+		return RoutingSession(self, **options)
@@ -0,0 +1,181 @@
+# Pluggable full-text search over posts.
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import DDL
+
+from app import app, db
+from app.models import Post, enable_search, whoosh_index
+
+class SearchBackend(object):
+	"""Full-text search over post bodies. search() returns ranked post
+	   ids, best match first; the caller loads the posts it needs."""
+
+	def setup(self):
+		"""Creates whatever the backend needs and indexes existing posts.
+		   Returns the number of posts indexed."""
+		raise NotImplementedError
+
+	def search(self, query, limit):
+		"""Returns up to limit post ids matching the query, best first."""
+		raise NotImplementedError
+
+	def generation(self):
+		"""A value that changes whenever the index does. It's read from
+		   the index itself, so every process sees the same one."""
+		raise NotImplementedError
+
+class WhooshBackend(SearchBackend):
+	"""The Flask-WhooshAlchemy index (Python 2 only). Posts are indexed
+	   on commit (see models.index_committed_posts), or by the background
+	   IndexQueue. Whoosh is loaded by the first search or indexed post."""
+
+	def setup(self):
+		from app.search_index import reindex_all
+		return reindex_all()
+
+	def search(self, query, limit):
+		if not isinstance(query, unicode):
+			query = unicode(query)
+		whoosh_index()
+		return [int(hit['id']) for hit in Post.pure_whoosh(query, limit)]
+
+	def generation(self):
+		# Every commit to the index makes a new generation - the commit
+		# hook's, the IndexQueue's and reindex_all's alike - so searches
+		# made before a queued post is indexed don't outlive it.
+		return whoosh_index().latest_generation()
+
+class FTS5Backend(SearchBackend):
+	"""SQLite FTS5 index over post.body, stored in the app's own database
+	   as an external-content table so bodies aren't stored twice. Triggers
+	   on post keep it in step w/ every insert, update and delete - bulk
+	   Core inserts included. Ranked by bm25 w/ porter stemming."""
+
+	STATEMENTS = [
+		"CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5("
+			"body, content='post', content_rowid='id', tokenize='porter unicode61')",
+		"CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post BEGIN "
+			"INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); END",
+		"CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post BEGIN "
+			"INSERT INTO post_fts(post_fts, rowid, body) VALUES ('delete', old.id, old.body); END",
+		"CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF body ON post BEGIN "
+			"INSERT INTO post_fts(post_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+			"INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); END",
+		# A counter bumped by every change to the index, for generation().
+		"CREATE TABLE IF NOT EXISTS post_fts_generation (generation INTEGER NOT NULL)",
+		"INSERT INTO post_fts_generation SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM post_fts_generation)",
+	] + [
+		"CREATE TRIGGER IF NOT EXISTS post_fts_generation_%s AFTER %s ON post BEGIN "
+			"UPDATE post_fts_generation SET generation = generation + 1; END" % (name, event)
+		for name, event in (('insert', 'INSERT'), ('delete', 'DELETE'), ('update', 'UPDATE OF body'))
+	]
+
+	def create(self, connection):
+		for statement in self.STATEMENTS:
+			connection.execute(statement)
+
+	def setup(self):
+		with db.engine.begin() as connection:
+			self.create(connection)
+			# Reindex everything from the post table.
+			connection.execute("INSERT INTO post_fts(post_fts) VALUES ('rebuild')")
+			connection.execute("UPDATE post_fts_generation SET generation = generation + 1")
+			return connection.execute("SELECT count(*) FROM post").scalar()
+
+	def search(self, query, limit):
+		# Quote each word so FTS5 operators in user input are taken literally;
+		# the words are ANDed together.
+		words = query.split()
+		if not words:
+			return []
+		match = u' '.join(u'"%s"' % word.replace(u'"', u'""') for word in words)
+		return [row[0] for row in db.session.execute(
+			'SELECT rowid FROM post_fts WHERE post_fts MATCH :match ORDER BY rank LIMIT :limit',
+			{'match': match, 'limit': limit})]
+
+	def generation(self):
+		return db.session.execute('SELECT generation FROM post_fts_generation').scalar()
+
+# SEARCH_BACKEND config value -> backend class
+SEARCH_BACKENDS = {
+	'whoosh': WhooshBackend,
+	'fts5': FTS5Backend,
+}
+
+_backends = {}
+
+def backend_name():
+	"""The configured backend - Whoosh where it runs, FTS5 otherwise."""
+	return app.config.get('SEARCH_BACKEND') or ('whoosh' if enable_search else 'fts5')
+
+def search_backend():
+	"""Returns the configured SearchBackend."""
+	name = backend_name()
+	if name not in _backends:
+		_backends[name] = SEARCH_BACKENDS[name]()
+	return _backends[name]
+
+class SearchCache(object):
+	"""Cross-request LRU cache of ranked result ids, keyed by query.
+	   Each entry remembers the index generation it was searched at and
+	   only counts as a hit while the index is still at it, so any change
+	   to the index - a new, edited or deleted post, from any process -
+	   invalidates it. Holds at most SEARCH_CACHE_SIZE queries, each for
+	   SEARCH_CACHE_TTL seconds."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		# key -> (time cached, index generation, ids), least recently used first
+		self._entries = OrderedDict()
+
+	def get(self, key, generation):
+		"""Returns the cached ids for the key, or None."""
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is None or entry[1] != generation:
+				return None
+			if time.time() - entry[0] >= app.config.get('SEARCH_CACHE_TTL', 300):
+				return None
+			# Re-inserting moves the key to the most recently used end.
+			self._entries[key] = entry
+			return entry[2]
+
+	def put(self, key, generation, ids):
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = (time.time(), generation, ids)
+			while len(self._entries) > app.config.get('SEARCH_CACHE_SIZE', 1000):
+				self._entries.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+search_cache = SearchCache()
+
+def cached_search(query, limit):
+	"""Input: query, max number of results
+	   Output: The ranked post ids for the query, from the
+	   search cache if the index hasn't changed since."""
+	backend = search_backend()
+	generation = backend.generation()
+	key = (backend_name(), query, limit)
+	ids = search_cache.get(key, generation)
+	if ids is None:
+		ids = backend.search(query, limit)
+		search_cache.put(key, generation, ids)
+	return ids
+
+# Create the FTS5 table and triggers w/ the post table when FTS5 is in use,
+# and always drop the index w/ the table so it never outlives its rows.
+@db.event.listens_for(Post.__table__, 'after_create')
+def create_fts5(target, connection, **kwargs):
+	if backend_name() == 'fts5' and connection.dialect.name == 'sqlite':
+		FTS5Backend().create(connection)
+
+db.event.listen(Post.__table__, 'before_drop',
+	DDL('DROP TABLE IF EXISTS post_fts').execute_if(dialect='sqlite'))
+db.event.listen(Post.__table__, 'before_drop',
+	DDL('DROP TABLE IF EXISTS post_fts_generation').execute_if(dialect='sqlite'))
@@ -0,0 +1,127 @@
+# Background indexing of posts into Whoosh, off the request's commit.
+import threading
+import time
+from collections import deque
+try:
+	from queue import Queue, Empty
+except ImportError:
+	# Python 2
+	from Queue import Queue, Empty
+
+from whoosh.writing import CLEAR
+
+from app import app, db
+from app.models import Post, whoosh_index
+
+def post_index():
+	return whoosh_index()
+
+class IndexQueue(object):
+	"""Queue of changed Post ids, written to the Whoosh index by one
+	   background thread. The thread waits up to SEARCH_INDEX_BATCH_DELAY
+	   seconds for more changes once one arrives, then loads the batch of
+	   posts w/ one query and commits them in one index writer - so posting
+	   no longer waits on index writes or the index's writer lock."""
+
+	def __init__(self):
+		self._queue = Queue()
+		self._lock = threading.Lock()
+		self._thread = None
+		# enqueue times of the changes not yet indexed, oldest first
+		self._pending = deque()
+		self.stats = {
+			'enqueued': 0,
+			'indexed': 0, # changes written to the index
+			'batches': 0,
+			'last_batch_size': 0,
+			'last_batch_seconds': 0.0, # time the last index commit took
+		}
+
+	def enqueue(self, operation, id):
+		"""Input: 'insert', 'update' or 'delete', post id
+		   Output: Queues the change, starting the indexing thread if needed."""
+		with self._lock:
+			self.stats['enqueued'] += 1
+			self._pending.append(time.time())
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name='search-indexer')
+				self._thread.daemon = True
+				self._thread.start()
+		self._queue.put((operation, id))
+
+	def on_commit(self, sender, changes):
+		"""models_committed receiver - queues the committed posts."""
+		for model, operation in changes:
+			if isinstance(model, Post):
+				self.enqueue(operation, model.id)
+
+	def wait(self):
+		"""Blocks until every queued change has been indexed."""
+		self._queue.join()
+
+	def status(self):
+		"""Returns the counters plus the current backlog and its lag in seconds."""
+		with self._lock:
+			status = dict(self.stats)
+			status['pending'] = len(self._pending)
+			status['lag_seconds'] = time.time() - self._pending[0] if self._pending else 0.0
+		return status
+
+	def _run(self):
+		while True:
+			batch = [self._queue.get()]
+			deadline = time.time() + app.config.get('SEARCH_INDEX_BATCH_DELAY', 0.5)
+			while len(batch) < app.config.get('SEARCH_INDEX_BATCH_SIZE', 500):
+				try:
+					batch.append(self._queue.get(timeout=max(0, deadline - time.time())))
+				except Empty:
+					break
+			try:
+				self._index(batch)
+			except Exception:
+				app.logger.exception('search indexing failed for %d posts', len(batch))
+			finally:
+				with self._lock:
+					for change in batch:
+						self._pending.popleft()
+				for change in batch:
+					self._queue.task_done()
+
+	def _index(self, batch):
+		"""Writes a batch of (operation, id) changes in one index commit."""
+		started = time.time()
+		# The last change to each post wins.
+		latest = dict((id, operation) for operation, id in batch)
+		with app.app_context():
+			ids = [id for id, operation in latest.items() if operation != 'delete']
+			posts = db.session.query(Post.id, Post.body).filter(Post.id.in_(ids)).all() if ids else []
+			db.session.remove()
+		with post_index().writer() as writer:
+			for id, body in posts:
+				writer.update_document(id=unicode(id), body=unicode(body))
+			for id, operation in latest.items():
+				if operation == 'delete':
+					writer.delete_by_term('id', unicode(id))
+		with self._lock:
+			self.stats['indexed'] += len(batch)
+			self.stats['batches'] += 1
+			self.stats['last_batch_size'] = len(batch)
+			self.stats['last_batch_seconds'] = time.time() - started
+
+index_queue = IndexQueue()
+
+def reindex_all(batch_size=10000):
+	"""Rebuilds the post index from scratch w/ a single writer, streaming
+	   the posts in batches. Returns the number of posts indexed."""
+	count = 0
+	writer = post_index().writer(limitmb=256)
+	try:
+		for id, body in db.session.query(Post.id, Post.body).yield_per(batch_size):
+			writer.add_document(id=unicode(id), body=unicode(body))
+			count += 1
+	except Exception:
+		writer.cancel()
+		raise
+	# CLEAR drops the old segments, so the new ones replace them.
+	writer.commit(mergetype=CLEAR)
+	return count
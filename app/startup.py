@@ -0,0 +1,123 @@
+# Startup time - deferred extensions, precompiled templates and timings.
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import request, g
+
+class LazyOpenID(object):
+	"""Stands in for Flask-OpenID's OpenID object, which pulls in
+	   python-openid and its crypto, until a login needs it - a new
+	   worker only pays for that on its first OpenID login, not on
+	   import. Everything but the two decorators is passed through
+	   to the real object, loading it on first use."""
+
+	def __init__(self, app, fs_store_path=None):
+		self._app = app
+		self._fs_store_path = fs_store_path
+		self._oid = None
+		self._after_login = None
+		self._lock = threading.Lock()
+		# what OpenID.init_app does
+		app.config.setdefault('OPENID_FS_STORE_PATH', None)
+
+	def loaded(self):
+		"""True once Flask-OpenID has been imported."""
+		return self._oid is not None
+
+	def _load(self):
+		with self._lock:
+			if self._oid is None:
+				from flask.ext.openid import OpenID
+				oid = OpenID(self._app, self._fs_store_path)
+				if self._after_login is not None:
+					oid.after_login(self._after_login)
+				self._oid = oid
+			return self._oid
+
+	def after_login(self, f):
+		self._after_login = f
+		if self._oid is not None:
+			self._oid.after_login(f)
+		return f
+
+	def loginhandler(self, f):
+		@wraps(f)
+		def decorated(*args, **kwargs):
+			# Only the provider's redirect back needs OpenID itself -
+			# the login form and its POST (which calls try_login) don't.
+			if request.args.get('openid_complete') != u'yes':
+				return f(*args, **kwargs)
+			return self._load().loginhandler(f)(*args, **kwargs)
+		return decorated
+
+	def __getattr__(self, name):
+		return getattr(self._load(), name)
+
+def template_bytecode_cache(app):
+	"""Input: app
+	   Output: Jinja bytecode cache in TEMPLATE_CACHE_DIR, or None to
+	   keep compiled templates in memory only. W/ it, a process loads
+	   templates another process compiled instead of compiling them."""
+	directory = app.config.get('TEMPLATE_CACHE_DIR')
+	if not directory:
+		return None
+	from jinja2 import FileSystemBytecodeCache
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	return FileSystemBytecodeCache(directory)
+
+def precompile_templates(app):
+	"""Compiles every template under app/templates now, rather than on
+	   the first request to render it. Done in gunicorn's master before
+	   forking (see wsgi.py), the workers start w/ them compiled; w/
+	   TEMPLATE_CACHE_DIR, the bytecode is written there as well.
+	   Returns the names of the templates compiled."""
+	names = list(app.jinja_env.list_templates(extensions=['html']))
+	# Keep them all, not just the default 50 most recently used.
+	if app.jinja_env.cache is not None and app.jinja_env.cache.capacity < len(names):
+		app.jinja_env.cache.capacity = len(names)
+	for name in names:
+		app.jinja_env.get_template(name)
+	return names
+
+class StartupTimer(object):
+	"""Times importing the app and each process's first request, and logs
+	   both - a freshly started worker's first request pays for whatever
+	   was left until then (templates, deferred imports, connections)."""
+
+	def __init__(self, started=None):
+		"""Input: time the import began (app/__init__.py's first line)"""
+		self.started = started or time.time()
+		self.timings = {}
+		self._lock = threading.Lock()
+		# pid whose first request has been timed - forked workers get their own
+		self._timed_pid = None
+
+	def imported(self, app):
+		"""Call once the app is imported."""
+		self.record(app, 'import', time.time() - self.started)
+
+	def record(self, app, name, seconds, detail=''):
+		with self._lock:
+			self.timings[name] = seconds
+		app.logger.info('startup: %s%s took %.3fs in pid %d', name, detail, seconds, os.getpid())
+
+	def init_app(self, app):
+		"""Registers the request hooks timing the first request."""
+		@app.before_request
+		def start_first_request():
+			if self._timed_pid != os.getpid():
+				g.startup_request_started = time.time()
+
+		@app.after_request
+		def time_first_request(response):
+			started = g.get('startup_request_started')
+			if started is not None:
+				with self._lock:
+					first = self._timed_pid != os.getpid()
+					self._timed_pid = os.getpid()
+				if first:
+					self.record(app, 'first_request', time.time() - started, ' (%s)' % request.path)
+			return response
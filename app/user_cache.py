@@ -0,0 +1,130 @@
+# Caches User rows for lm.user_loader so GET pages don't reload the user.
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g
+
+from app import app
+from app.models import User
+
+class UserCache(object):
+	"""Cross-request LRU cache of User column snapshots, keyed by id.
+	   Holds at most USER_CACHE_SIZE users, each for USER_CACHE_TTL seconds,
+	   so changes made by other processes show up within the TTL."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		# user id -> (time cached, column values), least recently used first
+		self._entries = OrderedDict()
+
+	def get(self, id):
+		"""Returns the cached column values for a user, or None."""
+		with self._lock:
+			entry = self._entries.pop(id, None)
+			if entry is None:
+				return None
+			if time.time() - entry[0] >= app.config.get('USER_CACHE_TTL', 60):
+				return None
+			# Re-inserting moves the user to the most recently used end.
+			self._entries[id] = entry
+			return entry[1]
+
+	def put(self, id, fields):
+		with self._lock:
+			self._entries.pop(id, None)
+			self._entries[id] = (time.time(), fields)
+			while len(self._entries) > app.config.get('USER_CACHE_SIZE', 1000):
+				self._entries.popitem(last=False)
+
+	def evict(self, id):
+		"""Drops a user whose row has changed."""
+		with self._lock:
+			self._entries.pop(id, None)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+user_cache = UserCache()
+
+class SessionUser(object):
+	"""Read-only snapshot of a User row that isn't attached to the db session.
+	   Columns are served from the snapshot. Anything else - relationships,
+	   follow methods, feed queries - loads the real row on first use and
+	   is handed off to it, so views can treat it like a User."""
+
+	def __init__(self, fields):
+		# Bypass __setattr__, which refuses writes.
+		object.__setattr__(self, '_fields', fields)
+		object.__setattr__(self, '_row', None)
+
+	def __getattr__(self, name):
+		fields = self._fields
+		if name in fields:
+			return fields[name]
+		return getattr(self.row(), name)
+
+	def __setattr__(self, name, value):
+		raise AttributeError('SessionUser is read-only; change the User row instead')
+
+	def row(self):
+		"""Returns the User row for this snapshot, loading it if needed."""
+		if self._row is None:
+			object.__setattr__(self, '_row', User.query.get(self._fields['id']))
+		return self._row
+
+	# Same Flask-Login methods as User.
+	def is_authenticated(self):
+		return True
+
+	def is_active(self):
+		return True
+
+	def is_anonymous(self):
+		return False
+
+	def get_id(self):
+		return unicode(self._fields['id'])
+
+	# Only needs the email, so it runs off the snapshot.
+	avatar = User.__dict__['avatar']
+
+	# Compare equal to the User row it was taken from.
+	def __eq__(self, other):
+		return isinstance(other, (User, SessionUser)) and other.id == self.id
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return hash(self._fields['id'])
+
+	def __repr__(self):
+		return '<SessionUser %r>' % (self._fields['nickname'])
+
+def snapshot(user):
+	"""Returns the column values of a User row as a dict."""
+	return dict((column.key, getattr(user, column.key)) for column in User.__table__.columns)
+
+def session_user(id):
+	"""Input: user id
+	   Output: SessionUser for that id, or None if there's no such user.
+	   Looks in this request's identity map, then the cross-request
+	   cache, and only then the database."""
+	identity_map = g.get('_session_users')
+	if identity_map is None:
+		identity_map = g._session_users = {}
+	if id in identity_map:
+		return identity_map[id]
+
+	fields = user_cache.get(id)
+	if fields is None:
+		user = User.query.get(id)
+		if user is None:
+			return None
+		fields = snapshot(user)
+		user_cache.put(id, fields)
+
+	identity_map[id] = SessionUser(fields)
+	return identity_map[id]
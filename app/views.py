@@ -5,11 +5,17 @@ from flask import (
 	session, # object for current session
 	url_for, # gets the url for a particular view function
 	request, # http request object
+	jsonify, # turns a dict into a json response
+	abort, # stops the request with an http error code
 	g # used to store whatever you want - globally - for the life of the request
 )
 
 # flask-login-specific methods
 from flask.ext.login import login_user, logout_user, current_user, login_required
+# marks views whose reads can go to a read replica
+from routing import replica_reads, stick_to_primary
+# page object for the search results' cached id lists
+from flask.ext.sqlalchemy import Pagination
 
 # import the app variable - aka the Flask object - from the app module
 from app import app, db, lm, oid
@@ -18,7 +24,29 @@ from app import app, db, lm, oid
 from forms import LoginForm, EditForm, PostForm, SearchForm
 
 # User class
-from models import User, Post
+from models import User, Post, timeline_enabled, enable_search
+
+# for cursor pagination
+from pagination import decode_cursor
+
+# buffered last_seen writes
+from last_seen import last_seen_tracker
+
+# cached users for the user loader
+from user_cache import user_cache, session_user
+
+# cached post.html fragments - also registers render_post for the templates
+from fragments import post_fragments
+
+# group commit for new posts
+from post_writer import post_writer, post_writer_enabled
+from concurrent.futures import TimeoutError
+
+# conditional GETs for the feed pages
+from http_cache import conditional, index_validators, user_validators, search_validators, own_suggestions
+
+# full-text search backends
+from search import cached_search
 
 # for last_seen
 from datetime import datetime
@@ -36,11 +64,15 @@ from config import POSTS_PER_PAGE, MAX_SEARCH_RESULTS
 @app.route('/index', methods=['GET', 'POST'])
 # for pagination - force arg into an int
 @app.route('/index/<int:page>', methods=['GET', 'POST'])
+# GETs may read from a replica - POSTs always use the primary
+@replica_reads
 # flask-login decorator - tells it where a login is required
 @login_required
+# answer w/ a 304 if the feed hasn't changed since the browser's copy
+@conditional(index_validators)
 # the routing function - when you go to the above urls,
 # the below function returns what will be rendered as html
-def index(page=1):
+def index(page=None):
 	# the global user - set w/ the before_request method
 	user = g.user
 
@@ -48,9 +80,34 @@ def index(page=1):
 	form = PostForm()
 
 	if form.validate_on_submit():
-		post = Post(body=form.post.data, timestamp=datetime.utcnow(), author=g.user)
-		db.session.add(post)
-		db.session.commit()
+		if post_writer_enabled():
+			# Queue the post to be committed w/ others being made now,
+			# and wait until it has been.
+			future = post_writer.submit(g.user.id, form.post.data, datetime.utcnow())
+			try:
+				future.result(app.config.get('POST_WRITER_TIMEOUT', 10))
+			except TimeoutError:
+				# Still queued, so it'll be committed - asking them to
+				# post it again would make a duplicate.
+				stick_to_primary(app)
+				flash('Your post is still being saved - it will show up shortly.')
+				return redirect(url_for('index'))
+			except Exception:
+				app.logger.exception('writing post failed')
+				flash('Your post could not be saved - please try again.')
+				return redirect(url_for('index'))
+			stick_to_primary(app)
+		else:
+			post = Post(body=form.post.data, timestamp=datetime.utcnow(), author=g.user)
+			db.session.add(post)
+			if timeline_enabled():
+				# Flush to give the post an id, then copy it into
+				# the timelines of the author's followers.
+				db.session.flush()
+				post.fan_out()
+			db.session.commit()
+			# The cached copy has a stale post count.
+			user_cache.evict(g.user.id)
 		flash('Your post is now live!')
 
 		# Redirect ensures that the last request is not a POST.
@@ -59,8 +116,12 @@ def index(page=1):
 		return redirect(url_for('index'))
 
 	# Gets paginated posts from a user's followers.
-	# Page determined by url, posts per page by the config.
-	posts = g.user.followed_posts().paginate(page, POSTS_PER_PAGE, False)
+	# Page determined by the ?before= cursor, posts per page by the config.
+	# Old /index/<page> urls still page by OFFSET.
+	if page is None:
+		posts = g.user.followed_posts_page(before_cursor(), POSTS_PER_PAGE)
+	else:
+		posts = g.user.followed_posts().paginate(page, POSTS_PER_PAGE, False)
 
 	# render_template will take the page specified and
 	# plug the variable blocks in the template w/ the data passed
@@ -113,8 +174,10 @@ def logout():
 # routing decorator with argument 'nickname'
 @app.route('/user/<nickname>')
 @app.route('/user/<nickname>/<int:page>')
+@replica_reads
 @login_required
-def user(nickname, page=1):
+@conditional(user_validators)
+def user(nickname, page=None):
 	
 	# sqlalchemy query
 	user = User.query.filter_by(nickname=nickname).first()
@@ -125,11 +188,19 @@ def user(nickname, page=1):
 		return redirect(url_for('index'))
 	
 	# otherwise get user's posts and render the user template
-	posts = user.posts.paginate(page, POSTS_PER_PAGE, False)
+	if page is None:
+		posts = user.posts_page(before_cursor(), POSTS_PER_PAGE)
+	else:
+		posts = user.posts.options(db.joinedload('author')).order_by(
+			Post.timestamp.desc(), Post.id.desc()).paginate(page, POSTS_PER_PAGE, False)
+
+	# Who-to-follow suggestions are only shown on your own page.
+	suggestions = own_suggestions(user)
 
 	return render_template('user.html', 
 							user=user,
-							posts=posts)
+							posts=posts,
+							suggestions=suggestions)
 
 @app.route('/edit', methods=['GET', 'POST'])
 @login_required
@@ -143,6 +214,10 @@ def edit():
 		g.user.about_me = form.about_me.data
 		db.session.add(g.user)
 		db.session.commit()
+		# The cached copy of the user has the old nickname and about_me,
+		# and their cached posts have the old nickname.
+		user_cache.evict(g.user.id)
+		post_fragments.invalidate_author(g.user)
 		flash('Your changes have been saved.')
 		return redirect(url_for('edit'))
 	else:
@@ -181,6 +256,9 @@ def follow(nickname):
 	# Otherwise, add follow to the database.
 	db.session.add(u)
 	db.session.commit()
+	# Both users' cached copies have stale counts.
+	user_cache.evict(u.id)
+	user_cache.evict(user.id)
 
 	# Let user know.
 	flash('You are now following %s!' % (nickname))
@@ -215,6 +293,9 @@ def unfollow(nickname):
 	# Otherwise, add unfollow to the database.
 	db.session.add(u)
 	db.session.commit()
+	# Both users' cached copies have stale counts.
+	user_cache.evict(u.id)
+	user_cache.evict(user.id)
 
 	# Let user know.
 	flash('You\'ve stopped following %s.' % (nickname))
@@ -230,13 +311,48 @@ def search():
 	return redirect(url_for('search_results', query=g.search_form.search.data))
 
 @app.route('/search_results/<query>')
+@app.route('/search_results/<query>/<int:page>')
+@replica_reads
 @login_required
-def search_results(query):
-	results = Post.query.whoosh_search(query, MAX_SEARCH_RESULTS).all()
+@conditional(search_validators)
+def search_results(query, page=1):
+	# The ranked ids for the query come from the search cache when
+	# no post has been added since; only the ids on this page are
+	# loaded, w/ their authors in one query, then put back in rank order.
+	ids = cached_search(query, MAX_SEARCH_RESULTS)
+	visible = ids[(page - 1) * POSTS_PER_PAGE:page * POSTS_PER_PAGE]
+	if not visible and page != 1:
+		abort(404)
+	posts = {}
+	if visible:
+		posts = dict((post.id, post) for post in Post.query.options(
+			db.joinedload('author')).filter(Post.id.in_(visible)))
+	results = Pagination(None, page, POSTS_PER_PAGE, len(ids),
+						 [posts[id] for id in visible if id in posts])
 	return render_template('search_results.html',
 							query=query,
 							results=results)
 
+@app.route('/search/status')
+@login_required
+def search_status():
+	"""Reports the background search indexer's backlog and lag as json."""
+
+	if not enable_search:
+		abort(404)
+	# imported here as it loads Whoosh
+	from search_index import index_queue
+	status = index_queue.status()
+	status['async'] = app.config.get('SEARCH_INDEX_ASYNC', False)
+	return jsonify(status)
+
+@app.route('/last_seen/status')
+@login_required
+def last_seen_status():
+	"""Reports the last seen buffer's flush counters and backlog as json."""
+
+	return jsonify(last_seen_tracker.metrics())
+
 ### Custom error handlers ###
 
 @app.errorhandler(404)
@@ -256,6 +372,17 @@ def internal_error(error):
 
 ### Utility functions ###
 
+def before_cursor():
+	"""Decodes the ?before= cursor from the url.
+	   None means the first page; a malformed cursor is a 404."""
+	before = request.args.get('before')
+	if before is None:
+		return None
+	cursor = decode_cursor(before)
+	if cursor is None:
+		abort(404)
+	return cursor
+
 @oid.after_login
 def after_login(resp):
 	# if there's no email, return to login screen w/ an error
@@ -269,14 +396,9 @@ def after_login(resp):
 		# if they don't give a nickname, force it from the email
 		if nickname is None or nickname == '':
 			nickname = resp.email.split('@')[0]
-		# Make sure it's unique.
-		nickname = User.make_unique_nickname(nickname)
-		user = User(nickname=nickname, email=resp.email)
-		
-		# if the user isn't in the db,
-		# add the current user to the db session
-		db.session.add(user)
-		db.session.commit()
+		# if the user isn't in the db, add them w/ a unique
+		# version of the nickname and commit it to the db
+		user = User.create_with_unique_nickname(nickname, resp.email)
 		
 		# Make the user follow themself.
 		db.session.add(user.follow(user))
@@ -301,15 +423,21 @@ def after_login(resp):
 def before_request():
 	g.user = current_user
 	if g.user.is_authenticated():
-		# set the last seen entry in the db to right now
-		g.user.last_seen = datetime.utcnow()
-		# add this entry and commit it to the db
-		db.session.add(g.user)
-		db.session.commit()
+		# record that the user was seen right now - the tracker
+		# buffers it and writes last_seen in bulk later
+		last_seen_tracker.touch(g.user, datetime.utcnow())
 		g.search_form = SearchForm()
 
+# endpoints that change the user on a GET
+WRITING_GETS = frozenset(['follow', 'unfollow'])
+
 # registered w/ flask-login through this decorator
 @lm.user_loader
 # loads a user from the database
 def load_user(id):
+	# Pages that only read get a cached, read-only snapshot of the user
+	# that isn't attached to the db session. Anything that may write
+	# gets the real row - POSTs, and the follow links, which are GETs.
+	if request.method in ('GET', 'HEAD') and request.endpoint not in WRITING_GETS:
+		return session_user(int(id))
 	return User.query.get(int(id))
\ No newline at end of file
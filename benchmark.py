@@ -0,0 +1,246 @@
+#!flask/bin/python
+
+### Benchmark the microblog against a synthetic data set. ###
+# Builds N users, a power-law follower graph and M posts in a separate
+# database, then drives the app through the Flask test client and reports
+# latency percentiles, queries per request and throughput per page.
+#
+# ./benchmark.py --users 1000 --posts 20000 --save tmp/baseline.json
+# ./benchmark.py --users 1000 --posts 20000 --compare tmp/baseline.json
+
+import argparse
+import bisect
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+from timeit import default_timer
+
+from config import basedir
+from app import app, db
+from app.models import User, Post, followers, hash_email, enable_search, \
+	reconcile_counters, rebuild_timelines, timeline_enabled
+from app.search import search_backend
+
+# Words the synthetic posts are made of - also used as search terms.
+WORDS = ('flask python database query index cache timeline follow post user '
+		 'search page template session request server worker latency graph').split()
+
+### Data generation ###
+
+class WeightedChoice(object):
+	"""Picks items w/ probability proportional to their weights."""
+
+	def __init__(self, items, weights):
+		self.items = items
+		self.cumulative = []
+		total = 0.0
+		for weight in weights:
+			total += weight
+			self.cumulative.append(total)
+		self.total = total
+
+	def __call__(self, rng):
+		return self.items[bisect.bisect(self.cumulative, rng.random() * self.total)]
+
+def power_law(ids, rng, alpha=1.0):
+	"""Returns a WeightedChoice over the ids where the k-th most
+	   popular (in random order) has weight 1 / k^alpha."""
+	ids = list(ids)
+	rng.shuffle(ids)
+	return WeightedChoice(ids, [1.0 / (rank + 1) ** alpha for rank in range(len(ids))])
+
+def insert_chunked(table, rows, chunk_size=10000):
+	"""Bulk inserts rows w/ one executemany per chunk."""
+	for start in range(0, len(rows), chunk_size):
+		db.session.execute(table.insert(), rows[start:start + chunk_size])
+	db.session.commit()
+
+def generate(users, posts, follows, seed=0, days=30):
+	"""Input: number of users, number of posts, mean follows per user, random seed
+	   Output: Fills the database w/ users who each follow themselves plus a
+	   power-law number of others, weighted towards popular users, and posts
+	   also weighted towards popular users. Returns a summary of the data."""
+	rng = random.Random(seed)
+
+	insert_chunked(User.__table__, [
+		{'id': id, 'nickname': u'user%d' % id, 'email': u'user%d@example.com' % id,
+		 'email_hash': hash_email(u'user%d@example.com' % id)}
+		for id in range(1, users + 1)])
+
+	# Out-degrees are Pareto distributed (shape 1.5) w/ the requested mean;
+	# targets are drawn by popularity, so in-degrees follow a power law too.
+	popular = power_law(range(1, users + 1), rng)
+	edges = []
+	for id in range(1, users + 1):
+		degree = min(users // 2, int(rng.paretovariate(1.5) * follows / 3.0))
+		followed = set([id])
+		while len(followed) < degree + 1:
+			followed.add(popular(rng))
+		edges.extend({'follower_id': id, 'followed_id': other} for other in followed)
+	insert_chunked(followers, edges)
+
+	start = datetime.utcnow() - timedelta(days=days)
+	post_rows = []
+	for id in range(1, posts + 1):
+		post_rows.append({
+			'id': id,
+			'user_id': popular(rng),
+			'body': u' '.join(rng.choice(WORDS) for i in range(rng.randint(3, 12))),
+			'timestamp': start + timedelta(seconds=rng.random() * days * 86400)})
+	insert_chunked(Post.__table__, post_rows)
+
+	# The bulk inserts skip the model hooks, so bring the derived data up to date.
+	reconcile_counters()
+	if timeline_enabled():
+		rebuild_timelines()
+
+	in_degrees = sorted(User.query.with_entities(User.followers_count))
+	return {'users': users, 'follows': len(edges), 'posts': posts,
+			'max_followers': in_degrees[-1][0], 'median_followers': in_degrees[len(in_degrees) // 2][0]}
+
+def setup_database():
+	"""Points the app at a scratch database and search index
+	   under tmp/ so benchmarks never touch the real ones."""
+	app.config['TESTING'] = True
+	app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'tmp', 'benchmark.db')
+	db.drop_all()
+	db.create_all()
+	if enable_search:
+		import shutil
+		from app.models import whoosh_index
+		app.config['WHOOSH_BASE'] = os.path.join(basedir, 'tmp', 'benchmark_search.db')
+		shutil.rmtree(app.config['WHOOSH_BASE'], ignore_errors=True)
+		whoosh_index(reopen=True)
+
+### Load generation ###
+
+class QueryCounter(object):
+	"""Counts the SQL statements the app runs."""
+
+	def __init__(self):
+		self.count = 0
+		db.event.listen(db.engine, 'before_cursor_execute', self)
+
+	def __call__(self, conn, cursor, statement, parameters, context, executemany):
+		self.count += 1
+
+	def close(self):
+		db.event.remove(db.engine, 'before_cursor_execute', self)
+
+def scenarios(rng, popular):
+	"""Returns (name, url) pairs for one round of page views by a random user."""
+	target = u'user%d' % popular(rng)
+	return [
+		('index', '/index'),
+		('user', '/user/%s' % target),
+		('follow', '/follow/%s' % target),
+		('unfollow', '/unfollow/%s' % target),
+		('search', '/search_results/%s' % rng.choice(WORDS)),
+	]
+
+def percentile(values, fraction):
+	"""Nearest-rank percentile of a sorted list."""
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def summarize(latencies, queries):
+	latencies = sorted(latencies)
+	total = sum(latencies)
+	return {
+		'requests': len(latencies),
+		'p50_ms': percentile(latencies, 0.50) * 1000,
+		'p90_ms': percentile(latencies, 0.90) * 1000,
+		'p99_ms': percentile(latencies, 0.99) * 1000,
+		'mean_ms': total / len(latencies) * 1000,
+		'queries_per_request': float(sum(queries)) / len(queries),
+		'requests_per_second': len(latencies) / total if total else 0.0,
+	}
+
+def run(rounds, users, seed=0):
+	"""Input: number of rounds, number of users, random seed
+	   Output: Logs in as a random user for each round, requests every
+	   scenario page and returns the summary for each page and overall."""
+	rng = random.Random(seed)
+	popular = power_law(range(1, users + 1), rng)
+	client = app.test_client()
+	counter = QueryCounter()
+	latencies, queries, errors = {}, {}, 0
+	started = default_timer()
+	try:
+		for i in range(rounds):
+			with client.session_transaction() as session:
+				session['user_id'] = unicode(rng.randint(1, users))
+				session['_fresh'] = True
+			for name, url in scenarios(rng, popular):
+				counter.count = 0
+				before = default_timer()
+				response = client.get(url)
+				latencies.setdefault(name, []).append(default_timer() - before)
+				queries.setdefault(name, []).append(counter.count)
+				if response.status_code >= 400:
+					errors += 1
+	finally:
+		counter.close()
+	elapsed = default_timer() - started
+
+	results = dict((name, summarize(latencies[name], queries[name])) for name in latencies)
+	total = sum(result['requests'] for result in results.values())
+	return {'scenarios': results, 'errors': errors,
+			'requests': total, 'requests_per_second': total / elapsed}
+
+### Reporting ###
+
+METRICS = ('p50_ms', 'p90_ms', 'p99_ms', 'queries_per_request', 'requests_per_second')
+
+def report(results, baseline=None):
+	"""Prints the results, w/ the change from the baseline if given."""
+	for name in sorted(results['scenarios']):
+		print name
+		for metric in METRICS:
+			value = results['scenarios'][name][metric]
+			line = '  %-20s %10.2f' % (metric, value)
+			old = baseline and baseline['scenarios'].get(name, {}).get(metric)
+			if old:
+				line += '  (was %.2f, %+.1f%%)' % (old, (value - old) / old * 100)
+			print line
+	print '%d requests, %.1f requests/second, %d errors' % (
+		results['requests'], results['requests_per_second'], results['errors'])
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Benchmark the microblog on synthetic data.')
+	parser.add_argument('--users', type=int, default=1000)
+	parser.add_argument('--posts', type=int, default=20000)
+	parser.add_argument('--follows', type=int, default=20, help='mean follows per user')
+	parser.add_argument('--rounds', type=int, default=200, help='rounds of page views to time')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--save', help='write the results to this JSON file')
+	parser.add_argument('--compare', help='compare against results saved w/ --save')
+	args = parser.parse_args(argv)
+
+	setup_database()
+	print 'generating data'
+	before = default_timer()
+	data = generate(args.users, args.posts, args.follows, args.seed)
+	search_backend().setup()
+	print '%(users)d users, %(follows)d follows, %(posts)d posts, ' \
+		  'max %(max_followers)d / median %(median_followers)d followers' % data
+	print 'generated in %.1fs' % (default_timer() - before)
+
+	results = run(args.rounds, args.users, args.seed)
+	results['data'] = data
+	results['params'] = vars(args)
+	results['created'] = datetime.utcnow().isoformat()
+
+	baseline = None
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+	report(results, baseline)
+	if args.save:
+		with open(args.save, 'w') as f:
+			json.dump(results, f, indent=2, sort_keys=True)
+		print 'saved to %s' % args.save
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
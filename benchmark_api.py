@@ -0,0 +1,96 @@
+#!flask/bin/python
+
+### Load test the json API against the html pages it mirrors. ###
+# Same synthetic data as benchmark.py. --concurrency client threads,
+# each logged in as a random user, hammer one pair of routes at a time
+# - home timeline, user posts, search - and the latency percentiles and
+# throughput of the html and json versions are printed side by side.
+#
+# ./benchmark_api.py --users 1000 --posts 20000 --concurrency 1 8 32
+
+import argparse
+import random
+import sys
+import threading
+from timeit import default_timer
+
+from app import app, db
+from app.search import search_backend
+from benchmark import WORDS, generate, setup_database, power_law, percentile
+
+# name -> (html url, json url), each given the target user and search word
+ROUTES = [
+	('timeline', lambda user, word: '/index', lambda user, word: '/api/timeline'),
+	('user', lambda user, word: '/user/%s' % user, lambda user, word: '/api/users/%s/posts' % user),
+	('search', lambda user, word: '/search_results/%s' % word, lambda user, word: '/api/search/%s' % word),
+]
+
+def client_thread(url, users, popular, seed, count, latencies, errors):
+	"""Makes count requests as random users, appending the latencies."""
+	rng = random.Random(seed)
+	client = app.test_client()
+	for i in range(count):
+		with client.session_transaction() as session:
+			session['user_id'] = unicode(rng.randint(1, users))
+			session['_fresh'] = True
+		target = url(u'user%d' % popular(rng), rng.choice(WORDS))
+		before = default_timer()
+		response = client.get(target)
+		latencies.append(default_timer() - before)
+		if response.status_code >= 400:
+			errors.append(target)
+		db.session.remove()
+
+def load(url, users, concurrency, requests, seed):
+	"""Input: url function, number of users, client threads, requests per thread, seed
+	   Output: Dict of the latency percentiles, throughput and errors."""
+	popular = power_law(range(1, users + 1), random.Random(seed))
+	latencies, errors = [], []
+	threads = [threading.Thread(target=client_thread,
+								args=(url, users, popular, seed + i, requests, latencies, errors))
+			   for i in range(concurrency)]
+	started = default_timer()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	elapsed = default_timer() - started
+	latencies.sort()
+	return {'p50_ms': percentile(latencies, 0.50) * 1000,
+			'p90_ms': percentile(latencies, 0.90) * 1000,
+			'p99_ms': percentile(latencies, 0.99) * 1000,
+			'requests_per_second': len(latencies) / elapsed,
+			'errors': len(errors)}
+
+METRICS = ('p50_ms', 'p90_ms', 'p99_ms', 'requests_per_second', 'errors')
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Compare the json API w/ the html pages under load.')
+	parser.add_argument('--users', type=int, default=1000)
+	parser.add_argument('--posts', type=int, default=20000)
+	parser.add_argument('--follows', type=int, default=20, help='mean follows per user')
+	parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8], help='client threads')
+	parser.add_argument('--requests', type=int, default=100, help='requests per client thread')
+	parser.add_argument('--db-threads', type=int, help='API_DB_THREADS for the json routes')
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args(argv)
+	if args.db_threads:
+		app.config['API_DB_THREADS'] = args.db_threads
+
+	setup_database()
+	print 'generating data'
+	data = generate(args.users, args.posts, args.follows, args.seed)
+	search_backend().setup()
+	print '%(users)d users, %(follows)d follows, %(posts)d posts, ' \
+		  'max %(max_followers)d / median %(median_followers)d followers' % data
+
+	for concurrency in args.concurrency:
+		for name, html, api in ROUTES:
+			print '%s x %d clients' % (name, concurrency)
+			results = [load(url, args.users, concurrency, args.requests, args.seed) for url in (html, api)]
+			print '  %-20s %10s %10s' % ('', 'html', 'json')
+			for metric in METRICS:
+				print '  %-20s %10.2f %10.2f' % (metric, results[0][metric], results[1][metric])
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,110 @@
+#!flask/bin/python
+
+### Memory and speed of the in-memory follow graph. ###
+# Builds a FollowGraph (see app/graph.py) of random follows - followers
+# picked uniformly, the followed by power law, duplicates and all - or of
+# the app's own followers table w/ --from-db, then reports the bytes it
+# takes next to a dict of sets and how long lookups take.
+#
+# ./benchmark_graph.py --users 1000000 --edges 10000000
+# ./benchmark_graph.py --from-db
+
+import argparse
+import gc
+import random
+import sys
+from array import array
+from timeit import default_timer
+
+from app import app
+from app.graph import FollowGraph
+from benchmark import power_law, percentile
+
+def random_edges(users, edges, seed):
+	"""Returns arrays of follower and followed ids for the given number of edges."""
+	rng = random.Random(seed)
+	popular = power_law(xrange(1, users + 1), rng)
+	sources, targets = array('i'), array('i')
+	for i in xrange(edges):
+		sources.append(rng.randint(1, users))
+		targets.append(popular(rng))
+	return sources, targets
+
+def dict_of_sets_bytes(sources, targets, sample):
+	"""Bytes a dict of id -> set of ids would take for each direction of
+	   the graph, measured on every k-th user's edges - about sample of
+	   them - and scaled up."""
+	k = max(1, len(sources) // max(1, sample))
+	nbytes = 0
+	for keys, values in ((sources, targets), (targets, sources)):
+		graph = {}
+		for key, value in zip(keys, values):
+			if key % k == 0:
+				graph.setdefault(key, set()).add(value)
+		nbytes += sys.getsizeof(graph) * k + k * sum(sys.getsizeof(ids) for ids in graph.values())
+		# The ints themselves, apart from the small ones Python shares.
+		nbytes += k * sum(sys.getsizeof(id) for id in graph if id > 256)
+		nbytes += k * sum(sys.getsizeof(id) for ids in graph.values() for id in ids if id > 256)
+	return nbytes
+
+def time_calls(name, function, args_list):
+	"""Prints the latency percentiles of calling the function w/ each args, in microseconds."""
+	latencies = []
+	for args in args_list:
+		before = default_timer()
+		function(*args)
+		latencies.append(default_timer() - before)
+	latencies.sort()
+	print '  %-24s p50 %8.1fus  p99 %8.1fus' % (
+		name, percentile(latencies, 0.50) * 1e6, percentile(latencies, 0.99) * 1e6)
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Report the follow graph index memory and speed.')
+	parser.add_argument('--users', type=int, default=1000000)
+	parser.add_argument('--edges', type=int, default=10000000)
+	parser.add_argument('--from-db', action='store_true', help="load the app db's followers instead")
+	parser.add_argument('--lookups', type=int, default=10000, help='calls to time per lookup')
+	parser.add_argument('--sample', type=int, default=1000000, help='about how many edges to measure the dict of sets on')
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args(argv)
+
+	before = default_timer()
+	if args.from_db:
+		from app.models import load_follow_edges
+		with app.app_context():
+			sources, targets = load_follow_edges()
+		users = max(max(sources), max(targets)) if sources else 0
+	else:
+		sources, targets = random_edges(args.users, args.edges, args.seed)
+		users = args.users
+	print '%d users, %d edges, read in %.1fs' % (users, len(sources), default_timer() - before)
+
+	gc.collect()
+	before = default_timer()
+	graph = FollowGraph(sources, targets)
+	print 'built in %.1fs' % (default_timer() - before)
+
+	nbytes = graph.nbytes()
+	print 'memory'
+	print '  %-24s %10.1f MB' % ('follow graph', nbytes / 1e6)
+	print '  %-24s %10.1f' % ('bytes per edge', float(nbytes) / max(1, len(sources)))
+	print '  %-24s %10.1f MB' % ('dict of sets (est.)', dict_of_sets_bytes(sources, targets, args.sample) / 1e6)
+
+	rng = random.Random(args.seed)
+	pairs = [(rng.randint(1, users), rng.randint(1, users)) for i in range(args.lookups)]
+	# Half the checks are for edges that exist.
+	for i in range(0, args.lookups, 2):
+		edge = rng.randrange(len(sources))
+		pairs[i] = (sources[edge], targets[edge])
+	ids = [(id,) for id, other in pairs]
+	print 'lookups'
+	time_calls('is_following', graph.is_following, pairs)
+	time_calls('following_many (20)', graph.following_many,
+			   [(id, [rng.randint(1, users) for j in range(20)]) for id, other in pairs[:1000]])
+	time_calls('followed', graph.followed, ids)
+	time_calls('followers', graph.followers, ids)
+	time_calls('followed_who_follow', graph.followed_who_follow, pairs)
+	time_calls('follow + unfollow', lambda id, other: (graph.follow(id, other), graph.unfollow(id, other)), pairs)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,64 @@
+#!flask/bin/python
+
+### Benchmark the search backends against each other. ###
+# Fills a scratch database w/ synthetic posts (see benchmark.py), builds
+# each available backend's index from scratch and times random one and
+# two word queries against it.
+#
+# ./benchmark_search.py --posts 1000000 --queries 500
+
+import argparse
+import random
+import sys
+from timeit import default_timer
+
+from app import app
+from app.models import enable_search
+from app.search import SEARCH_BACKENDS
+from benchmark import WORDS, generate, setup_database, percentile
+
+def time_queries(backend, queries, limit):
+	"""Returns the sorted latencies of the queries and the mean hit count."""
+	latencies, hits = [], 0
+	for query in queries:
+		before = default_timer()
+		hits += len(backend.search(query, limit))
+		latencies.append(default_timer() - before)
+	return sorted(latencies), float(hits) / len(queries)
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Compare the search backends on synthetic posts.')
+	parser.add_argument('--users', type=int, default=10000)
+	parser.add_argument('--posts', type=int, default=1000000)
+	parser.add_argument('--queries', type=int, default=500, help='queries to time per backend')
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args(argv)
+
+	# Whoosh only runs on Python 2.
+	names = ['fts5'] + (['whoosh'] if enable_search else [])
+	limit = app.config.get('MAX_SEARCH_RESULTS', 50)
+	rng = random.Random(args.seed)
+	queries = [u' '.join(rng.sample(WORDS, rng.randint(1, 2))) for i in range(args.queries)]
+
+	# Generate w/o the FTS5 triggers so each backend's build starts from nothing.
+	app.config['SEARCH_BACKEND'] = 'whoosh'
+	setup_database()
+	print 'generating %d posts' % args.posts
+	generate(args.users, args.posts, 1, args.seed)
+
+	for name in names:
+		app.config['SEARCH_BACKEND'] = name
+		backend = SEARCH_BACKENDS[name]()
+		before = default_timer()
+		backend.setup()
+		build = default_timer() - before
+		latencies, hits = time_queries(backend, queries, limit)
+		print name
+		print '  %-20s %10.2f' % ('build_s', build)
+		for label, fraction in (('p50_ms', 0.50), ('p90_ms', 0.90), ('p99_ms', 0.99)):
+			print '  %-20s %10.2f' % (label, percentile(latencies, fraction) * 1000)
+		print '  %-20s %10.2f' % ('queries_per_second', len(latencies) / sum(latencies))
+		print '  %-20s %10.2f' % ('mean_hits', hits)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
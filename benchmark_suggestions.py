@@ -0,0 +1,121 @@
+#!flask/bin/python
+
+### Benchmark the who-to-follow suggestions on a synthetic graph. ###
+# Fills a scratch database w/ a power-law follower graph shaped like
+# benchmark.py's (w/o the posts and counters it also builds), then
+# times the batched sparse matrix ranking against counting mutual
+# follows user by user, the full refresh (load, rank and store) and
+# the lookups a user page does.
+#
+# ./benchmark_suggestions.py --users 100000 --follows 20
+
+import argparse
+import random
+import sys
+from collections import Counter
+from timeit import default_timer
+
+from app import app, db
+from app.models import User, followers, load_follow_edges
+from app.recommend import compute_suggestions, refresh_suggestions
+from benchmark import setup_database, power_law, insert_chunked, percentile
+
+def generate_graph(users, follows, seed):
+	"""Inserts users who each follow a Pareto distributed number of others,
+	   picked by popularity, like benchmark.generate. Returns the follow count."""
+	rng = random.Random(seed)
+	insert_chunked(User.__table__, [{'id': id, 'nickname': u'user%d' % id, 'email': u'user%d@example.com' % id}
+									for id in xrange(1, users + 1)])
+	popular = power_law(xrange(1, users + 1), rng)
+	count = 0
+	edges = []
+	for id in xrange(1, users + 1):
+		degree = min(users // 2, int(rng.paretovariate(1.5) * follows / 3.0))
+		followed = set([id])
+		while len(followed) < degree + 1:
+			followed.add(popular(rng))
+		edges.extend({'follower_id': id, 'followed_id': other} for other in followed)
+		# Insert as we go to keep memory down.
+		if len(edges) >= 100000:
+			insert_chunked(followers, edges)
+			count += len(edges)
+			edges = []
+	insert_chunked(followers, edges)
+	return count + len(edges)
+
+def followed_sets(sources, targets):
+	"""Dict of user id -> set of the ids they follow, self-follows left out."""
+	followed = {}
+	for source, target in zip(sources, targets):
+		if source != target:
+			followed.setdefault(source, set()).add(target)
+	return followed
+
+def naive_suggestions(followed, ids, k):
+	"""Ranks the given users' suggestions one user at a time w/ a Counter
+	   over their follows' follows - the straightforward way."""
+	suggestions = {}
+	for id in ids:
+		mine = followed.get(id, set())
+		counts = Counter(other for friend in mine for other in followed.get(friend, ()))
+		suggestions[id] = [other for other, count in counts.most_common()
+						   if other != id and other not in mine][:k]
+	return suggestions
+
+def report_latencies(name, latencies):
+	latencies.sort()
+	print '  %-24s p50 %8.2fms  p99 %8.2fms' % (
+		name, percentile(latencies, 0.50) * 1000, percentile(latencies, 0.99) * 1000)
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Benchmark the who-to-follow suggestions.')
+	parser.add_argument('--users', type=int, default=100000)
+	parser.add_argument('--follows', type=int, default=20, help='mean follows per user')
+	parser.add_argument('--per-user', type=int, default=10, help='suggestions kept per user')
+	parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1000, 5000])
+	parser.add_argument('--naive-sample', type=int, default=2000, help='users to rank the naive way')
+	parser.add_argument('--lookups', type=int, default=1000, help='user page lookups to time')
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args(argv)
+
+	setup_database()
+	print 'generating data'
+	before = default_timer()
+	count = generate_graph(args.users, args.follows, args.seed)
+	print '%d users, %d follows in %.1fs' % (args.users, count, default_timer() - before)
+	sources, targets = load_follow_edges()
+	db.session.remove()
+
+	print 'ranking'
+	for batch_size in args.batch_sizes:
+		before = default_timer()
+		rows = sum(len(batch[0]) for batch in compute_suggestions(sources, targets, args.per_user, batch_size))
+		elapsed = default_timer() - before
+		print '  %-24s %8.1fs  %8.0f users/s  %d suggestions' % (
+			'matrix, batches of %d' % batch_size, elapsed, args.users / elapsed, rows)
+	sample = random.Random(args.seed).sample(range(1, args.users + 1), min(args.naive_sample, args.users))
+	followed = followed_sets(sources, targets)
+	before = default_timer()
+	naive_suggestions(followed, sample, args.per_user)
+	elapsed = default_timer() - before
+	print '  %-24s %8.1fs  %8.0f users/s  (%d users)' % ('naive', elapsed, len(sample) / elapsed, len(sample))
+	del followed
+
+	app.config['SUGGESTIONS_PER_USER'] = args.per_user
+	before = default_timer()
+	count = refresh_suggestions(batch_size=args.batch_sizes[0])
+	print '  %-24s %8.1fs  %d rows' % ('refresh (load+rank+store)', default_timer() - before, count)
+
+	rng = random.Random(args.seed)
+	latencies = []
+	for i in range(args.lookups):
+		user = User.query.get(rng.randint(1, args.users))
+		before = default_timer()
+		user.suggestions()
+		latencies.append(default_timer() - before)
+		db.session.remove()
+	print 'lookups'
+	report_latencies('user.suggestions()', latencies)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
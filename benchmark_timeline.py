@@ -0,0 +1,102 @@
+#!flask/bin/python
+
+### Benchmark the three home timeline strategies against each other. ###
+# pull   - the followers join at read time (TIMELINE_ENABLED off)
+# push   - every post fanned out to the materialized timeline
+# hybrid - fan-out, except for users over TIMELINE_FANOUT_LIMIT
+#          followers, whose posts are merged in at read time
+# Each strategy gets the same synthetic data (see benchmark.py), then
+# times building the timelines, writing posts by authors drawn by
+# popularity and reading the first two home pages of random users.
+#
+# ./benchmark_timeline.py --users 10000 --posts 200000 --fanout-limit 500
+
+import argparse
+import random
+import sys
+from datetime import datetime
+from timeit import default_timer
+
+from app import app, db
+from app.models import User, Post, timeline, rebuild_timelines
+from app.pagination import decode_cursor
+from benchmark import generate, setup_database, power_law, percentile
+
+STRATEGIES = ('pull', 'push', 'hybrid')
+
+def configure(strategy, limit):
+	app.config['TIMELINE_ENABLED'] = strategy != 'pull'
+	app.config['TIMELINE_FANOUT_LIMIT'] = limit if strategy == 'hybrid' else None
+
+def time_writes(authors, rng, count):
+	"""Makes count posts, each fanned out and committed like the index
+	   view does. Returns the sorted latencies."""
+	latencies = []
+	for i in range(count):
+		before = default_timer()
+		post = Post(body=u'benchmark post %d' % i, timestamp=datetime.utcnow(),
+					author=User.query.get(authors(rng)))
+		db.session.add(post)
+		if app.config['TIMELINE_ENABLED']:
+			db.session.flush()
+			post.fan_out()
+		db.session.commit()
+		latencies.append(default_timer() - before)
+	return sorted(latencies)
+
+def time_reads(users, rng, count, per_page):
+	"""Reads the first two home pages of count random users.
+	   Returns the sorted latencies of the page loads."""
+	latencies = []
+	for i in range(count):
+		user = User.query.get(rng.randint(1, users))
+		before = default_timer()
+		page = user.followed_posts_page(None, per_page)
+		if page.has_next:
+			user.followed_posts_page(decode_cursor(page.next_cursor), per_page)
+		latencies.append((default_timer() - before) / 2)
+		db.session.remove()
+	return sorted(latencies)
+
+def report(name, latencies):
+	for label, fraction in (('p50_ms', 0.50), ('p90_ms', 0.90), ('p99_ms', 0.99)):
+		print '  %-20s %10.2f' % ('%s_%s' % (name, label), percentile(latencies, fraction) * 1000)
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Compare the pull, push and hybrid timelines.')
+	parser.add_argument('--users', type=int, default=10000)
+	parser.add_argument('--posts', type=int, default=200000)
+	parser.add_argument('--follows', type=int, default=20, help='mean follows per user')
+	parser.add_argument('--fanout-limit', type=int, default=500, help='hybrid follower threshold')
+	parser.add_argument('--writes', type=int, default=200, help='posts to time per strategy')
+	parser.add_argument('--reads', type=int, default=500, help='home page reads to time per strategy')
+	parser.add_argument('--per-page', type=int, default=app.config.get('POSTS_PER_PAGE', 20))
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--strategies', nargs='+', choices=STRATEGIES, default=list(STRATEGIES))
+	args = parser.parse_args(argv)
+
+	for strategy in args.strategies:
+		# Fresh data for each strategy so the writes don't carry over.
+		configure('pull', None)
+		setup_database()
+		data = generate(args.users, args.posts, args.follows, args.seed)
+		configure(strategy, args.fanout_limit)
+		print '%s (%d posts, max %d followers)' % (strategy, data['posts'], data['max_followers'])
+
+		before = default_timer()
+		if strategy != 'pull':
+			rebuild_timelines()
+		print '  %-20s %10.2f' % ('build_s', default_timer() - before)
+		rows = db.session.execute(db.select([db.func.count()]).select_from(timeline)).scalar()
+		print '  %-20s %10d' % ('timeline_rows', rows)
+		if strategy == 'hybrid':
+			pulled = User.query.filter(User.followers_count > args.fanout_limit).count()
+			print '  %-20s %10d' % ('pulled_users', pulled)
+
+		rng = random.Random(args.seed)
+		authors = power_law(range(1, args.users + 1), random.Random(args.seed))
+		report('write', time_writes(authors, rng, args.writes))
+		report('read', time_reads(args.users, rng, args.reads, args.per_page))
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,21 @@
+#!flask/bin/python
+
+### Add columns the models declare to an existing database. ###
+# db.create_all() only creates missing tables, not missing columns.
+# New columns start out NULL - see db_backfill_email_hash.py and
+# db_reconcile_counters.py for filling them in.
+
+from sqlalchemy import inspect
+from app import db
+
+inspector = inspect(db.engine)
+tables = set(inspector.get_table_names())
+for table in db.metadata.sorted_tables:
+	if table.name not in tables:
+		continue
+	existing = set(column['name'] for column in inspector.get_columns(table.name))
+	for column in table.columns:
+		if column.name not in existing:
+			print "adding %s.%s" % (table.name, column.name)
+			db.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+				table.name, column.name, column.type.compile(db.engine.dialect)))
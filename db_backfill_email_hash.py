@@ -0,0 +1,10 @@
+#!flask/bin/python
+
+### Fill in user.email_hash for users created before it existed. ###
+# Run db_add_columns.py first to add the column to an existing database.
+
+from app.models import backfill_email_hashes
+
+print "backfilling email hashes"
+count = backfill_email_hashes()
+print "%d users updated" % count
@@ -0,0 +1,66 @@
+#!flask/bin/python
+
+### Bulk import or export users, follows and posts as NDJSON or CSV. ###
+# Files are streamed, so memory stays flat on any size of data. Import
+# users before their follows and posts; counters, timelines and the
+# search index are brought up to date once everything's in.
+#
+# ./db_bulk.py import users users.ndjson follows follows.csv posts posts.ndjson
+# ./db_bulk.py export posts posts.csv
+# ./db_bulk.py export users - > users.ndjson
+
+import argparse
+import sys
+from timeit import default_timer
+
+from app.bulk import KINDS, FORMATS, read_records, import_records, finish_import, \
+	export_records, write_records
+
+def file_format(path, format):
+	"""The --format given, or the file's extension (ndjson for stdin/stdout)."""
+	if format:
+		return format
+	return 'csv' if path.lower().endswith('.csv') else 'ndjson'
+
+def pairs(values):
+	"""Checks the kind/path arguments come in pairs and returns them as such."""
+	if len(values) % 2 or not values:
+		raise argparse.ArgumentTypeError('expected kind and file pairs')
+	files = zip(values[0::2], values[1::2])
+	for kind, path in files:
+		if kind not in KINDS:
+			raise argparse.ArgumentTypeError('unknown kind %r - use %s' % (kind, ', '.join(sorted(KINDS))))
+	return files
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Bulk import or export microblog data.')
+	parser.add_argument('command', choices=['import', 'export'])
+	parser.add_argument('files', nargs='+', help='kind (users, follows or posts) and file pairs; - is stdin/stdout')
+	parser.add_argument('--format', choices=FORMATS, help='default: from the file extension')
+	parser.add_argument('--batch-size', type=int, default=10000, help='rows per commit or fetch')
+	args = parser.parse_args(argv)
+	try:
+		files = pairs(args.files)
+	except argparse.ArgumentTypeError as e:
+		parser.error(str(e))
+
+	# Progress goes to stderr so exports can go to stdout.
+	for kind, path in files:
+		format = file_format(path, args.format)
+		before = default_timer()
+		if args.command == 'import':
+			file = sys.stdin if path == '-' else open(path, 'rb')
+			count = import_records(kind, read_records(file, format), args.batch_size)
+		else:
+			file = sys.stdout if path == '-' else open(path, 'wb')
+			count = write_records(file, format, KINDS[kind][1], export_records(kind, args.batch_size))
+		if file not in (sys.stdin, sys.stdout):
+			file.close()
+		print >> sys.stderr, '%sed %d %s in %.1fs' % (args.command, count, kind, default_timer() - before)
+
+	if args.command == 'import':
+		print >> sys.stderr, 'updating counters, timelines and search index'
+		finish_import()
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
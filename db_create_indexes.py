@@ -0,0 +1,30 @@
+#!flask/bin/python
+
+### Add indexes the models declare to an existing database. ###
+# db.create_all() only creates indexes along w/ new tables.
+
+from sqlalchemy import inspect
+from app import db
+from app.models import followers
+
+inspector = inspect(db.engine)
+
+# The unique follow index can't be built while duplicate follows exist.
+duplicates = db.session.query(followers.c.follower_id, followers.c.followed_id).group_by(
+	followers.c.follower_id, followers.c.followed_id).having(db.func.count() > 1).all()
+for follower_id, followed_id in duplicates:
+	print "removing duplicate follow %d -> %d" % (follower_id, followed_id)
+	pair = db.and_(followers.c.follower_id == follower_id, followers.c.followed_id == followed_id)
+	db.session.execute(followers.delete().where(pair))
+	db.session.execute(followers.insert().values(follower_id=follower_id, followed_id=followed_id))
+db.session.commit()
+
+tables = set(inspector.get_table_names())
+for table in db.metadata.sorted_tables:
+	if table.name not in tables:
+		continue
+	existing = set(index['name'] for index in inspector.get_indexes(table.name))
+	for index in table.indexes:
+		if index.name not in existing:
+			print "creating index %s on %s" % (index.name, table.name)
+			index.create(db.engine)
@@ -0,0 +1,11 @@
+#!flask/bin/python
+
+### Rebuild every user's materialized timeline from the followers table. ###
+# Run this before turning on TIMELINE_ENABLED, or if the timeline
+# ever drifts from the followers table.
+
+from app.models import rebuild_timelines
+
+print "rebuilding timelines"
+count = rebuild_timelines()
+print "%d timeline entries written" % count
@@ -0,0 +1,12 @@
+#!flask/bin/python
+
+### Recompute the denormalized follower/followed/post counts on user. ###
+# Run db_add_columns.py first to add the columns to an existing database.
+
+from app.models import reconcile_counters
+
+print "reconciling counters"
+drift = reconcile_counters()
+for id, name, stored, actual in drift:
+	print "user %d: %s was %s, should be %d" % (id, name, stored, actual)
+print "%d counters fixed" % len(drift)
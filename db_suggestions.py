@@ -0,0 +1,33 @@
+#!flask/bin/python
+
+### Recompute every user's who-to-follow suggestions. ###
+# Once - from cron, or to fill them in the first time - or w/ --loop
+# every SUGGESTIONS_INTERVAL seconds, in a process of its own. Not in
+# the web server - see recommend.SuggestionJob.
+#
+# ./db_suggestions.py
+# ./db_suggestions.py --loop
+
+import argparse
+import sys
+from timeit import default_timer
+
+from app import app
+from app.recommend import refresh_suggestions, suggestion_job
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Recompute the who-to-follow suggestions.')
+	parser.add_argument('--loop', action='store_true', help='keep refreshing them every SUGGESTIONS_INTERVAL seconds')
+	args = parser.parse_args(argv)
+
+	if args.loop:
+		print "refreshing suggestions every %ds" % app.config.get('SUGGESTIONS_INTERVAL', 3600)
+		suggestion_job.run_forever()
+
+	print "computing suggestions"
+	before = default_timer()
+	count = refresh_suggestions()
+	print "%d suggestions written in %.1fs" % (count, default_timer() - before)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,11 @@
+#!flask/bin/python
+
+### Rebuild the configured search backend's post index from the database. ###
+# Also creates the FTS5 table and triggers in a database made before
+# SEARCH_BACKEND was set to fts5.
+
+from app.search import backend_name, search_backend
+
+print "reindexing posts into %s" % backend_name()
+count = search_backend().setup()
+print "%d posts indexed" % count
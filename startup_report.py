@@ -0,0 +1,161 @@
+#!flask/bin/python
+
+### Report how long a new process takes to import the app and serve. ###
+# Fills a scratch database like benchmark.py, then for each mode starts
+# fresh interpreters - nothing imported or compiled yet, as in a newly
+# scaled up worker - and times importing the app, the slowest imports
+# within that, and the first and second request to each page:
+#
+#   lazy         templates compiled by the first request to render them
+#   precompiled  TEMPLATE_PRECOMPILE - all compiled during the import
+#   cached       TEMPLATE_PRECOMPILE w/ TEMPLATE_CACHE_DIR, filled by an
+#                earlier process, so they're loaded rather than compiled
+#
+# Medians of --runs processes per mode are printed.
+#
+# ./startup_report.py --runs 5
+
+import __builtin__
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# page name -> url, given a user's nickname
+PAGES = [
+	('index', lambda nickname: '/index'),
+	('user', lambda nickname: '/user/%s' % nickname),
+	('search', lambda nickname: '/search_results/post'),
+]
+
+MODES = ['lazy', 'precompiled', 'cached']
+
+class ImportTimer(object):
+	"""Wraps __import__ to time each module's first import, less the
+	   modules it imports in turn, summed by top level package."""
+
+	def __init__(self):
+		self.seconds = {}
+		self._stack = []
+		self._import = __builtin__.__import__
+
+	def __call__(self, name, globals=None, locals=None, fromlist=None, level=-1):
+		started = time.time()
+		self._stack.append(0.0)
+		module = None
+		try:
+			module = self._import(name, globals, locals, fromlist, level)
+			return module
+		finally:
+			elapsed = time.time() - started
+			nested = self._stack.pop()
+			if self._stack:
+				self._stack[-1] += elapsed
+			# By the module's real name - relative imports only give part of it.
+			package = getattr(module, '__name__', name).split('.')[0]
+			self.seconds[package] = self.seconds.get(package, 0.0) + elapsed - nested
+
+	def install(self):
+		__builtin__.__import__ = self
+
+	def uninstall(self):
+		__builtin__.__import__ = self._import
+
+def child(mode, cache_dir):
+	"""Runs in the fresh interpreter - prints the timings as json."""
+	timer = ImportTimer()
+	timer.install()
+	started = time.time()
+	# Settings go on the config module, as the app reads it on import.
+	import config
+	config.TEMPLATE_PRECOMPILE = mode != 'lazy'
+	config.TEMPLATE_CACHE_DIR = cache_dir if mode == 'cached' else None
+	config.TESTING = True
+	config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(config.basedir, 'tmp', 'benchmark.db')
+	config.WHOOSH_BASE = os.path.join(config.basedir, 'tmp', 'benchmark_search.db')
+	from app import app, oid, startup_timer
+	imported = time.time() - started
+	timer.uninstall()
+	deferred = dict((name, name not in sys.modules) for name in ('whoosh', 'openid'))
+
+	client = app.test_client()
+	with client.session_transaction() as session:
+		session['user_id'] = u'1'
+	requests = {}
+	for page, url in PAGES:
+		for attempt in ('first', 'second'):
+			before = time.time()
+			response = client.get(url('user1'))
+			requests['%s %s' % (page, attempt)] = time.time() - before
+			assert response.status_code == 200, (url('user1'), response.status_code)
+	print json.dumps({
+		'import': imported,
+		'templates': startup_timer.timings.get('templates', 0.0),
+		'requests': requests,
+		'imports': timer.seconds,
+		'deferred': deferred,
+	})
+
+def run_child(mode, cache_dir):
+	output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', mode, '--cache-dir', cache_dir])
+	return json.loads(output.splitlines()[-1])
+
+def median(values):
+	values = sorted(values)
+	return values[len(values) // 2]
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Report the app's import and first request times.")
+	parser.add_argument('--runs', type=int, default=5, help='processes per mode')
+	parser.add_argument('--users', type=int, default=100)
+	parser.add_argument('--posts', type=int, default=2000)
+	parser.add_argument('--follows', type=int, default=10, help='mean follows per user')
+	parser.add_argument('--top', type=int, default=10, help='slowest imports to list')
+	parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+	parser.add_argument('--cache-dir', help=argparse.SUPPRESS)
+	args = parser.parse_args(argv)
+	if args.child:
+		return child(args.child, args.cache_dir)
+
+	from app import db
+	from app.search import search_backend
+	from benchmark import setup_database, generate
+	setup_database()
+	generate(args.users, args.posts, args.follows)
+	search_backend().setup()
+	db.session.remove()
+
+	# A throwaway bytecode cache, so runs never leave files in the tree.
+	cache_dir = tempfile.mkdtemp(prefix='startup_templates')
+	try:
+		# One process to fill the cache for the cached mode.
+		run_child('cached', cache_dir)
+		results = dict((mode, [run_child(mode, cache_dir) for i in range(args.runs)]) for mode in MODES)
+	finally:
+		shutil.rmtree(cache_dir, ignore_errors=True)
+
+	print 'median of %d processes, ms' % args.runs
+	print '  %-20s' % '' + ''.join('%12s' % mode for mode in MODES)
+	rows = [('import', lambda result: result['import']), ('  templates', lambda result: result['templates'])]
+	rows += [(name, lambda result, name=name: result['requests'][name])
+			 for name in ['%s %s' % (page, attempt) for page, url in PAGES for attempt in ('first', 'second')]]
+	for name, value in rows:
+		print '  %-20s' % name + ''.join('%12.1f' % (median([value(result) for result in results[mode]]) * 1000)
+										 for mode in MODES)
+
+	lazy = results['lazy']
+	print 'slowest imports (lazy, ms, less their own imports)'
+	packages = set(package for result in lazy for package in result['imports'])
+	seconds = sorted(((median([result['imports'].get(package, 0.0) for result in lazy]), package)
+					  for package in packages), reverse=True)
+	for elapsed, package in seconds[:args.top]:
+		print '  %-20s %8.1f' % (package, elapsed * 1000)
+	deferred = sorted(name for name, deferred in lazy[0]['deferred'].items() if deferred)
+	print 'not imported until used: %s' % (', '.join(deferred) or 'none')
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -1,9 +1,39 @@
 import os
+import shutil
+import logging
+import tempfile
+import threading
+import time
 import unittest
+import json
+import re
+from StringIO import StringIO
+from contextlib import contextmanager
 
 from config import basedir
-from app import app, db
-from app.models import User, Post
+from app import app, db, startup_timer
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from flask.ext.sqlalchemy import models_committed
+from app.models import User, Post, followers, suggestion, follow_graph, enable_search, rebuild_timelines, backfill_email_hashes, reconcile_counters, hash_email
+from app.pagination import decode_cursor
+from app.last_seen import LastSeenTracker, last_seen_tracker
+from app.user_cache import user_cache, session_user, SessionUser
+from app.views import load_user
+from app.profiling import RequestProfiler, TimedTemplate
+from app.fragments import PostFragmentCache, post_fragments
+from app.engine import after_fork
+from app.startup import LazyOpenID, template_bytecode_cache, precompile_templates
+from app.graph import GraphIndex, follow_graph_index
+from app.recommend import refresh_suggestions
+from app.post_writer import post_writer
+from app.bulk import KINDS, read_records, import_records, finish_import, export_records, write_records
+from app.search import search_backend, search_cache, cached_search
+from benchmark import generate
+if enable_search:
+	from app.models import whoosh_index
+	from app.search_index import IndexQueue, reindex_all
 from datetime import datetime, timedelta
 
 class TestCase(unittest.TestCase):
@@ -14,16 +44,50 @@ class TestCase(unittest.TestCase):
 		app.config['TESTING'] = True
 		app.config['WTF_CSRF_ENABLED'] = False
 		app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'test.db')
+		app.config['TIMELINE_ENABLED'] = False
+		app.config['SEARCH_BACKEND'] = None
+		app.config['FOLLOW_GRAPH_ENABLED'] = False
+		follow_graph_index.reset()
+		app.config['POST_WRITER_ENABLED'] = False
+		app.config['SUGGESTIONS_PER_USER'] = 10
+		app.config['POST_WRITER_DELAY'] = 0.005
+		app.config['POST_WRITER_TIMEOUT'] = 10
+		app.config['LAST_SEEN_FLUSH_INTERVAL'] = 30
+		if enable_search:
+			# Keep test posts out of the real search index.
+			app.config['WHOOSH_BASE'] = os.path.join(basedir, 'test_search.db')
+			whoosh_index(reopen=True)
 		self.app = app.test_client()
 		db.create_all()
+		user_cache.clear()
+		search_cache.clear()
+		# Post ids are reused from test to test.
+		post_fragments.backend.clear()
 
 	def tearDown(self):
 		"""Required teardown for the tests.
 		   Removes the session and drops the test db."""
 		   
+		last_seen_tracker.flush()
 		db.session.remove()
 		db.drop_all()
 
+	@contextmanager
+	def assert_max_queries(self, expected):
+		"""Fails the test if the with block runs more than
+		   the expected number of SQL statements."""
+
+		statements = []
+		def count(conn, cursor, statement, parameters, context, executemany):
+			statements.append(statement)
+		event.listen(db.engine, 'before_cursor_execute', count)
+		try:
+			yield statements
+		finally:
+			event.remove(db.engine, 'before_cursor_execute', count)
+		assert len(statements) <= expected, \
+			'%d queries run, expected at most %d:\n%s' % (len(statements), expected, '\n'.join(statements))
+
 	def test_avatar(self):
 		"""Test that the avatar url created for a test user is as expected."""
 
@@ -32,6 +96,29 @@ class TestCase(unittest.TestCase):
 		expected = 'http://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6'
 		assert avatar[0:len(expected)] == expected
 
+		# The hash is stored, and follows changes to the email.
+		assert u.email_hash == 'd4c74594d841139328695756648b6bd6'
+		u.email = 'susan@example.com'
+		assert u.email_hash != 'd4c74594d841139328695756648b6bd6'
+		assert u.avatar(128) != avatar
+
+	def test_backfill_email_hashes(self):
+		"""Test that users saved without an email hash get one."""
+
+		db.session.add(User(nickname='john', email='john@example.com'))
+		db.session.add(User(nickname='susan', email='susan@example.com'))
+		db.session.commit()
+		db.session.execute(User.__table__.update().values(email_hash=None))
+		db.session.commit()
+		db.session.expire_all()
+		u = User.query.filter_by(nickname='john').first()
+		assert u.email_hash is None
+		assert u.avatar(128).startswith('http://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6')
+
+		assert backfill_email_hashes(batch_size=1) == 2
+		db.session.expire_all()
+		assert User.query.filter_by(nickname='john').first().email_hash == 'd4c74594d841139328695756648b6bd6'
+
 	def test_make_unique_nickname(self):
 		"""Test that the function for creating unique usernames works as expected."""
 
@@ -47,6 +134,58 @@ class TestCase(unittest.TestCase):
 		assert nickname2 != 'john'
 		assert nickname2 != nickname
 
+	def test_make_unique_nickname_many_collisions(self):
+		"""Test that a heavily taken nickname resolves in two queries."""
+
+		db.session.execute(User.__table__.insert(), [{'nickname': 'john'}] +
+			[{'nickname': 'john%d' % i} for i in range(2, 3002)] +
+			[{'nickname': 'johnny'}, {'nickname': 'johnny9999'}, {'nickname': 'john-5000'}])
+		db.session.commit()
+		with self.assert_max_queries(2):
+			assert User.make_unique_nickname('john') == 'john3002'
+		with self.assert_max_queries(1):
+			assert User.make_unique_nickname('jo') == 'jo'
+		assert User.make_unique_nickname('johnny') == 'johnny10000'
+
+		# A db w/o a pattern match gets the same answer from the rows.
+		dialect = db.engine.dialect.name
+		db.engine.dialect.name = 'other'
+		try:
+			assert User.make_unique_nickname('john') == 'john3002'
+			assert User.make_unique_nickname('johnny') == 'johnny10000'
+		finally:
+			db.engine.dialect.name = dialect
+
+	def test_create_with_unique_nickname_retries(self):
+		"""Test that losing a race for a nickname retries w/ the next one."""
+
+		db.session.add(User(nickname='john', email='john@example.com'))
+		db.session.add(User(nickname='john2', email='john2@example.com'))
+		db.session.commit()
+
+		# The first guess is stale, as if another sign-up just took it.
+		make_unique_nickname = User.make_unique_nickname
+		guesses = ['john2']
+		User.make_unique_nickname = staticmethod(lambda nickname:
+			guesses.pop() if guesses else make_unique_nickname(nickname))
+		try:
+			u = User.create_with_unique_nickname('john', 'susan@example.com')
+		finally:
+			User.make_unique_nickname = staticmethod(make_unique_nickname)
+		assert u.nickname == 'john3'
+		assert User.query.count() == 3
+
+		# A taken email isn't fixed by another nickname, so it's not retried.
+		guesses = []
+		User.make_unique_nickname = staticmethod(lambda nickname:
+			guesses.append(nickname) or make_unique_nickname(nickname))
+		try:
+			self.assertRaises(IntegrityError, User.create_with_unique_nickname, 'susan', 'susan@example.com')
+		finally:
+			User.make_unique_nickname = staticmethod(make_unique_nickname)
+		assert guesses == ['susan']
+		assert User.query.count() == 3
+
 	def test_follow(self):
 		u1 = User(nickname='john', email='john@example.com')
 		u2 = User(nickname='susan', email='susan@example.com')
@@ -83,6 +222,446 @@ class TestCase(unittest.TestCase):
 		assert u1.followed.count() == 0
 		assert u2.followers.count() == 0
 
+	def test_follow_many(self):
+		"""Test that bulk follow/unfollow and follow checks run one query each."""
+
+		users = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(5)]
+		for u in users:
+			db.session.add(u)
+		db.session.commit()
+		u = users[0]
+		db.session.add(u.follow(users[1]))
+		db.session.commit()
+
+		# Only the users not already followed are added.
+		assert u.follow_many(users[1:4] + [users[3]]) == [users[2], users[3]]
+		db.session.commit()
+		ids = [x.id for x in users]
+		with self.assert_max_queries(1):
+			assert u.is_following_many(ids) == set(ids[1:4])
+		assert u.followed.count() == 3
+		assert not u.is_following(users[4])
+
+		assert u.unfollow_many([users[1], users[4]]) == [users[1]]
+		db.session.commit()
+		assert u.is_following_many([x.id for x in users]) == set([users[2].id, users[3].id])
+		assert u.is_following_many([]) == set()
+
+		# A user listed twice is unfollowed, and counted, once.
+		assert u.unfollow_many([users[2], users[2]]) == [users[2]]
+		db.session.commit()
+		assert User.query.get(u.id).followed_count == 1
+		assert User.query.get(users[2].id).followers_count == 0
+		assert reconcile_counters() == []
+
+	def test_counters(self):
+		"""Test that follower/followed/post counts follow the changes
+		   and that reconciling fixes any drift."""
+
+		u1 = User(nickname='john', email='john@example.com')
+		u2 = User(nickname='susan', email='susan@example.com')
+		u3 = User(nickname='mary', email='mary@example.com')
+		db.session.add(u1)
+		db.session.add(u2)
+		db.session.add(u3)
+		db.session.commit()
+
+		db.session.add(u1.follow(u2))
+		u1.follow_many([u1, u3])
+		u3.follow(u2)
+		db.session.add(Post(body='post from susan', author=u2, timestamp=datetime.utcnow()))
+		db.session.commit()
+		assert (u1.followers_count, u1.followed_count, u1.posts_count) == (1, 3, 0)
+		assert (u2.followers_count, u2.followed_count, u2.posts_count) == (2, 0, 1)
+
+		db.session.add(u1.unfollow(u2))
+		u1.unfollow_many([u3])
+		db.session.commit()
+		assert (u1.followed_count, u2.followers_count, u3.followers_count) == (1, 1, 0)
+		assert reconcile_counters() == []
+
+		# Drift gets reported and fixed.
+		db.session.execute(User.__table__.update().where(User.id == u2.id).values(
+			followers_count=7, posts_count=None))
+		db.session.commit()
+		assert reconcile_counters() == [(u2.id, 'followers_count', 7, 1), (u2.id, 'posts_count', None, 1)]
+		assert (u2.followers_count, u2.posts_count) == (1, 1)
+
+	def test_request_profiler(self):
+		"""Test that slow requests are logged w/ their query and render
+		   times and sampled requests get a cProfile dump."""
+
+		u = User(nickname='john', email='john@example.com')
+		db.session.add(u)
+		db.session.add(Post(body='post from john', author=u, timestamp=datetime.utcnow()))
+		db.session.commit()
+		db.session.add(u.follow(u))
+		db.session.commit()
+
+		directory = tempfile.mkdtemp()
+		app.config['PROFILING_SLOW_REQUEST'] = 0
+		app.config['PROFILING_SAMPLE_RATE'] = 1.0
+		app.config['PROFILING_DIR'] = directory
+		profiler = RequestProfiler(app)
+		messages = []
+		class Capture(logging.Handler):
+			def emit(self, record):
+				messages.append(record.getMessage())
+		handler = Capture()
+		app.logger.addHandler(handler)
+		try:
+			with self.app.session_transaction() as session:
+				session['user_id'] = unicode(u.id)
+				session['_fresh'] = True
+			response = self.app.get('/user/john')
+			assert response.status_code == 200
+			assert len(messages) == 1
+			assert messages[0].startswith('slow request: GET /user/john ')
+			assert ' 0 queries' not in messages[0] and '0.000s rendering' not in messages[0]
+			assert [name.endswith('-user.prof') for name in os.listdir(directory)] == [True]
+		finally:
+			# Leave the shared app unprofiled for the other tests.
+			profiler.remove()
+			app.logger.removeHandler(handler)
+			app.config['PROFILING_SLOW_REQUEST'] = 3600
+			app.config['PROFILING_SAMPLE_RATE'] = 0.0
+			shutil.rmtree(directory)
+		assert app.jinja_env.template_class is not TimedTemplate
+		assert not event.contains(Engine, 'before_cursor_execute', profiler.before_cursor_execute)
+		# Statements begun before the listeners were added are skipped.
+		with db.engine.connect() as connection:
+			connection.info.pop('profiling_started', None)
+			profiler.after_cursor_execute(connection, None, 'SELECT 1', (), None, False)
+
+	def test_post_fragment_cache(self):
+		"""Test that rendered posts are reused until the author's nickname changes."""
+
+		u = User(nickname='john', email='john@example.com')
+		p = Post(body='post from john', author=u, timestamp=datetime.utcnow())
+		db.session.add(u)
+		db.session.add(p)
+		db.session.commit()
+
+		cache = PostFragmentCache()
+		with app.test_request_context():
+			html = cache.render(p)
+			assert 'john says:' in html and 'post from john' in html
+			# A hit comes back from the backend, not a fresh render.
+			cache.backend.set(('post', p.id, cache.author_version(u)), 'cached')
+			assert cache.render(p) == 'cached'
+
+			cache.invalidate_author(u)
+			assert cache.render(p) == html
+			# Evicting every fragment doesn't take the generation w/ it.
+			version = cache.author_version(u)
+			cache.backend.clear()
+			assert cache.author_version(u) == version
+
+			# Neither does a new avatar.
+			u.email_hash = hash_email(u'john@example.org')
+			assert u.email_hash in cache.render(p)
+
+			# A new nickname misses even w/o an invalidation.
+			u.nickname = 'johnny'
+			assert 'johnny says:' in cache.render(p)
+
+	def test_conditional_get(self):
+		"""Test that unchanged feed pages get a 304 and changes give a new ETag."""
+
+		u1 = User(nickname='john', email='john@example.com')
+		u2 = User(nickname='susan', email='susan@example.com')
+		db.session.add(u1)
+		db.session.add(u2)
+		db.session.commit()
+		db.session.add(u1.follow(u1))
+		db.session.add(Post(body='post from susan', author=u2, timestamp=datetime.utcnow()))
+		db.session.commit()
+		with self.app.session_transaction() as session:
+			session['user_id'] = unicode(u1.id)
+			session['_fresh'] = True
+
+		for url in ('/index', '/user/susan'):
+			response = self.app.get(url)
+			etag = response.headers['ETag']
+			assert response.status_code == 200
+			assert response.headers['Cache-Control'] == 'private, no-cache'
+			# Profile edits leave no time behind, so profiles go by the ETag alone.
+			assert ('Last-Modified' in response.headers) == (url == '/index')
+			assert self.app.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+			# Following susan changes both her profile and john's feed.
+			self.app.get('/follow/susan')
+			self.app.get('/index')  # show the flashed message
+			response = self.app.get(url, headers={'If-None-Match': etag})
+			assert response.status_code == 200
+			assert response.headers['ETag'] != etag
+			self.app.get('/unfollow/susan')
+			self.app.get('/index')
+
+		# A renamed user's profile isn't a 304 for If-Modified-Since alone.
+		susan = User.query.filter_by(nickname='susan').first()
+		susan.nickname = 'susanna'
+		db.session.commit()
+		response = self.app.get('/user/susanna', headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+		assert response.status_code == 200 and 'susanna' in response.data
+
+		# Search results are revalidated against the search index, which
+		# edits change too.
+		app.config['SEARCH_BACKEND'] = 'fts5'
+		search_backend().setup()
+		response = self.app.get('/search_results/susan')
+		etag = response.headers['ETag']
+		assert 'Last-Modified' not in response.headers
+		assert self.app.get('/search_results/susan', headers={'If-None-Match': etag}).status_code == 304
+		post = Post.query.first()
+		post.body = 'edited post from susan'
+		db.session.commit()
+		response = self.app.get('/search_results/susan', headers={'If-None-Match': etag})
+		assert response.status_code == 200
+		assert response.headers['ETag'] != etag
+
+	def test_async_search_indexing(self):
+		"""Test that queued posts are indexed in a batch and that a
+		   full reindex rebuilds the search index."""
+
+		if not enable_search:
+			return
+		u = User(nickname='john', email='john@example.com')
+		p1 = Post(body='first asynchronous post', author=u, timestamp=datetime.utcnow())
+		p2 = Post(body='second asynchronous post', author=u, timestamp=datetime.utcnow())
+		db.session.add(u)
+		db.session.add(p1)
+		db.session.add(p2)
+		db.session.commit()
+
+		queue = IndexQueue()
+		queue.on_commit(app, [(p1, 'insert'), (p2, 'insert'), (u, 'insert')])
+		queue.wait()
+		status = queue.status()
+		assert (status['indexed'], status['batches'], status['pending']) == (2, 1, 0)
+		assert set(Post.query.whoosh_search('asynchronous').all()) == set([p1, p2])
+
+		# Cached searches last until the index changes - a delete too.
+		assert sorted(cached_search('asynchronous', 10)) == sorted([p1.id, p2.id])
+		queue.enqueue('delete', p1.id)
+		queue.wait()
+		assert Post.query.whoosh_search('asynchronous').all() == [p2]
+		assert cached_search('asynchronous', 10) == [p2.id]
+
+		assert reindex_all() == 2
+		assert set(Post.query.whoosh_search('asynchronous').all()) == set([p1, p2])
+
+	def test_fts5_search(self):
+		"""Test that the FTS5 backend follows post changes and ranks matches."""
+
+		app.config['SEARCH_BACKEND'] = 'fts5'
+		u = User(nickname='john', email='john@example.com')
+		p1 = Post(body='the quick brown fox', author=u, timestamp=datetime.utcnow())
+		db.session.add(u)
+		db.session.add(p1)
+		db.session.commit()
+
+		# Existing posts are picked up by setup, new ones by the triggers.
+		backend = search_backend()
+		backend.setup()
+		p2 = Post(body='fox fox foxes everywhere', author=u, timestamp=datetime.utcnow())
+		p3 = Post(body='a lazy dog', author=u, timestamp=datetime.utcnow())
+		db.session.add(p2)
+		db.session.add(p3)
+		db.session.commit()
+		assert backend.search('fox', 10) == [p2.id, p1.id]
+		assert backend.search('fox', 1) == [p2.id]
+		assert backend.search('brown fox', 10) == [p1.id]
+		assert backend.search('NOT "fox* OR', 10) == []
+
+		p3.body = 'a lazy fox'
+		db.session.delete(p2)
+		db.session.commit()
+		assert sorted(backend.search('fox', 10)) == [p1.id, p3.id]
+
+		with self.app.session_transaction() as session:
+			session['user_id'] = unicode(u.id)
+			session['_fresh'] = True
+		response = self.app.get('/search_results/lazy')
+		assert 'a lazy fox' in response.data and 'quick brown' not in response.data
+
+		# Tables created while FTS5 is configured come w/ the index,
+		# so new posts are searchable w/o running setup.
+		db.session.remove()
+		db.drop_all()
+		db.create_all()
+		u = User(nickname='john', email='john@example.com')
+		p = Post(body='a new fox', author=u, timestamp=datetime.utcnow())
+		db.session.add(p)
+		db.session.commit()
+		assert backend.search('fox', 10) == [p.id]
+		assert backend.setup() == 1
+
+	def test_search_cache_and_pages(self):
+		"""Test that search ids are cached until the index changes and the results are paged."""
+
+		app.config['SEARCH_BACKEND'] = 'fts5'
+		search_backend().setup()
+		u = User(nickname='john', email='john@example.com')
+		db.session.add(u)
+		now = datetime.utcnow()
+		for i in range(5):
+			db.session.add(Post(body='fox number %d' % i, author=u, timestamp=now))
+		db.session.commit()
+
+		# Count the searches that reach the backend.
+		backend, searches = search_backend(), []
+		search = backend.search
+		backend.search = lambda query, limit: searches.append(query) or search(query, limit)
+		try:
+			ids = cached_search('fox', 50)
+			assert len(ids) == 5
+			assert cached_search('fox', 50) == ids
+			assert searches == ['fox']
+			p = Post(body='one more fox', author=u, timestamp=now)
+			db.session.add(p)
+			db.session.commit()
+			assert p.id in cached_search('fox', 50)
+			assert searches == ['fox', 'fox']
+			# Edits change the index too.
+			p.body = 'one more fox, edited'
+			db.session.commit()
+			assert p.id in cached_search('edited', 50)
+			assert p.id in cached_search('fox', 50)
+			assert searches == ['fox', 'fox', 'edited', 'fox']
+		finally:
+			del backend.search
+
+		with self.app.session_transaction() as session:
+			session['user_id'] = unicode(u.id)
+			session['_fresh'] = True
+		# 6 results over pages of 3 (POSTS_PER_PAGE)
+		first = self.app.get('/search_results/fox').data
+		second = self.app.get('/search_results/fox/2').data
+		assert first.count('fox number') + first.count('one more') == 3
+		assert second.count('fox number') + second.count('one more') == 3
+		assert '/search_results/fox/2' in first and '/search_results/fox/1' in second
+		assert self.app.get('/search_results/fox/3').status_code == 404
+		assert self.app.get('/search_results/nothing').status_code == 200
+
+	def test_engine_settings(self):
+		"""Test the SQLite pragmas, pre-ping and the engine reset after fork."""
+
+		app.config['SQLITE_JOURNAL_MODE'] = 'WAL'
+		app.config['SQLITE_BUSY_TIMEOUT'] = 1234
+		app.config['DATABASE_PRE_PING'] = True
+		try:
+			# Every checkout is a new connection w/ SQLite's NullPool.
+			with db.engine.connect() as connection:
+				assert connection.execute('PRAGMA journal_mode').scalar() == 'wal'
+				assert connection.execute('PRAGMA busy_timeout').scalar() == 1234
+			pool = db.engine.pool
+			after_fork()
+			assert db.engine.pool is not pool
+			assert User.query.count() == 0
+		finally:
+			for name in ('SQLITE_JOURNAL_MODE', 'SQLITE_BUSY_TIMEOUT', 'DATABASE_PRE_PING'):
+				app.config.pop(name)
+			# WAL is stored in the db file, so switch the test db back.
+			db.session.remove()
+			db.engine.execute('PRAGMA journal_mode = DELETE')
+
+	def test_replica_routing(self):
+		"""Test that replica views read from the replica until the user writes."""
+
+		app.config['SQLALCHEMY_BINDS'] = {'replica': 'sqlite:///' + os.path.join(basedir, 'test_replica.db')}
+		app.config['DATABASE_REPLICAS'] = ['replica']
+		replica = db.get_engine(app, 'replica')
+		db.Model.metadata.create_all(replica)
+		try:
+			john = User(nickname='john', email='john@example.com')
+			db.session.add(john)
+			db.session.commit()
+			# The replica lags behind - it has john but not susan yet.
+			john_id = john.id
+			replica.execute(User.__table__.insert(), id=john_id, nickname='john', email='john@example.com')
+			db.session.add(User(nickname='susan', email='susan@example.com'))
+			db.session.commit()
+			db.session.remove()
+
+			with app.test_request_context('/user/susan'):
+				assert User.query.count() == 1
+				# Once the session writes it reads the primary.
+				db.session.add(User(nickname='david', email='david@example.com'))
+				db.session.commit()
+				assert User.query.count() == 3
+				db.session.remove()
+			with app.test_request_context('/follow/susan'):
+				assert User.query.count() == 3
+				db.session.remove()
+
+			with self.app.session_transaction() as session:
+				session['user_id'] = unicode(john_id)
+				session['_fresh'] = True
+			assert self.app.get('/user/susan').status_code == 302
+			# After a write the user's pages stick to the primary.
+			self.app.get('/follow/susan')
+			response = self.app.get('/user/susan')
+			assert response.status_code == 200 and 'susan' in response.data
+
+			# Forked workers get their own replica connections too.
+			pool = replica.pool
+			after_fork()
+			assert db.get_engine(app, 'replica').pool is not pool
+		finally:
+			db.session.remove()
+			db.Model.metadata.drop_all(replica)
+			del app.config['DATABASE_REPLICAS']
+			app.config['SQLALCHEMY_BINDS'] = None
+
+	def test_bulk_import_export(self):
+		"""Test that NDJSON and CSV imports round trip through the exports."""
+
+		users = ''.join(json.dumps({'id': id, 'nickname': 'user%d' % id, 'email': 'user%d@example.com' % id,
+									'about_me': None, 'last_seen': '2015-01-0%dT12:00:00' % id}) + '\n'
+						for id in range(1, 4))
+		follows = 'follower_id,followed_id\n1,2\n1,3\n2,3\n'
+		posts = 'id,body,timestamp,user_id\n' + ''.join(
+			'%d,"post, number %d",2015-01-01T00:00:0%d.500000,%d\n' % (id, id, id, id % 3 + 1) for id in range(1, 8))
+
+		# Batches smaller than the data exercise the chunked commits.
+		assert import_records('users', read_records(StringIO(users), 'ndjson'), 2) == 3
+		assert import_records('follows', read_records(StringIO(follows), 'csv'), 2) == 3
+		assert import_records('posts', read_records(StringIO(posts), 'csv'), 2) == 7
+		finish_import()
+
+		u = User.query.get(3)
+		assert (u.nickname, u.email_hash, u.last_seen) == ('user3', hash_email('user3@example.com'), datetime(2015, 1, 3, 12))
+		assert (u.followers_count, u.posts_count) == (2, 2)
+		assert User.query.get(1).is_following(User.query.get(2))
+		assert Post.query.get(5).body == 'post, number 5'
+
+		for kind, data, format in (('users', users, 'ndjson'), ('follows', follows, 'csv'), ('posts', posts, 'csv')):
+			out = StringIO()
+			assert write_records(out, format, KINDS[kind][1], export_records(kind, 2)) == data.count('\n') - (format == 'csv')
+			assert list(read_records(StringIO(out.getvalue()), format)) == list(read_records(StringIO(data), format))
+
+		# Ragged rows - short ones' missing fields are missing values.
+		users = 'id,nickname,email,about_me\n4,user4\n5,user5,user5@example.com,hi,extra\n'
+		assert import_records('users', read_records(StringIO(users), 'csv')) == 2
+		assert (User.query.get(4).email, User.query.get(4).email_hash) == (None, None)
+		assert User.query.get(5).about_me == 'hi'
+
+	def test_benchmark_data(self):
+		"""Test that the benchmark generator builds a consistent data set."""
+
+		data = generate(users=50, posts=200, follows=5, seed=1)
+		assert User.query.count() == 50
+		assert Post.query.count() == 200
+		assert data['follows'] == db.session.query(followers).count()
+		assert data['max_followers'] > data['median_followers']
+
+		# Everyone follows themselves and the counters match the rows.
+		u = User.query.get(7)
+		assert u.is_following(u)
+		assert u.followers_count == u.followers.count()
+		assert u.posts_count == u.posts.count()
+
 	def test_follow_posts(self):
 		
 		# Make four users.
@@ -139,6 +718,541 @@ class TestCase(unittest.TestCase):
 		assert f3 == [p4, p3]
 		assert f4 == [p4]
 
+	def test_timeline(self):
+		"""Test that the materialized timeline matches the followers join."""
+
+		app.config['TIMELINE_ENABLED'] = True
+		u1 = User(nickname='john', email='john@example.com')
+		u2 = User(nickname='susan', email='susan@example.com')
+		u3 = User(nickname='mary', email='mary@example.com')
+		db.session.add(u1)
+		db.session.add(u2)
+		db.session.add(u3)
+		db.session.commit()
+
+		# A post made before the follow is backfilled by follow().
+		utcnow = datetime.utcnow()
+		p1 = Post(body='post from susan', author=u2, timestamp=utcnow + timedelta(seconds=1))
+		db.session.add(p1)
+		db.session.commit()
+		u1.follow(u1)
+		u1.follow(u2)
+		u1.follow(u3)
+		db.session.add(u1)
+		db.session.commit()
+
+		# Posts made after the follow are fanned out when written.
+		p2 = Post(body='post from mary', author=u3, timestamp=utcnow + timedelta(seconds=2))
+		p3 = Post(body='post from john', author=u1, timestamp=utcnow + timedelta(seconds=3))
+		db.session.add(p2)
+		db.session.add(p3)
+		db.session.flush()
+		p2.fan_out()
+		p3.fan_out()
+		db.session.commit()
+		assert u1.followed_posts().all() == [p3, p2, p1]
+
+		# Unfollowing prunes the unfollowed user's posts.
+		db.session.add(u1.unfollow(u3))
+		db.session.commit()
+		assert u1.followed_posts().all() == [p3, p1]
+
+		# A rebuild produces the same timeline as the join.
+		assert rebuild_timelines() == 2
+		app.config['TIMELINE_ENABLED'] = False
+		assert u1.timeline_posts().all() == u1.followed_posts().all()
+
+	def test_hybrid_timeline(self):
+		"""Test that pulled posts merge w/ the timeline to match the followers join."""
+
+		app.config['TIMELINE_ENABLED'] = True
+		app.config['TIMELINE_FANOUT_LIMIT'] = 1
+		try:
+			john, susan, mary, david = [User(nickname=name, email=name + '@example.com')
+										for name in ('john', 'susan', 'mary', 'david')]
+			db.session.add_all([john, susan, mary, david])
+			db.session.commit()
+			utcnow = datetime.utcnow()
+			def post(author, seconds):
+				p = Post(body='post from %s' % author.nickname, author=author,
+						 timestamp=utcnow + timedelta(seconds=seconds))
+				db.session.add(p)
+				db.session.flush()
+				p.fan_out()
+				db.session.commit()
+				return p
+
+			p1 = post(susan, 1)
+			db.session.add(john.follow(susan))
+			db.session.add(john.follow(david))
+			db.session.commit()
+			# susan's second follower takes her over the limit - from now
+			# on her posts are pulled, and p1 is in john's timeline as well.
+			db.session.add(mary.follow(susan))
+			db.session.commit()
+			assert not susan.fans_out() and john.pulled_authors() == [susan.id]
+			p2 = post(david, 2)
+			p3 = post(susan, 3)
+			p4 = post(susan, 4)
+			p5 = post(david, 5)
+			assert john.timeline_posts().all() == [p5, p2, p1]
+
+			# Paging through the merged pages gives each post once, in order.
+			posts, before = [], None
+			with self.assert_max_queries(100) as statements:
+				while True:
+					page = john.followed_posts_page(before, 2)
+					posts.extend(page.items)
+					if not page.has_next:
+						break
+					before = decode_cursor(page.next_cursor)
+			assert posts == [p5, p4, p3, p2, p1]
+			# Every derived table is named, as Postgres and MySQL require.
+			unions = [statement for statement in statements if 'FROM (SELECT' in statement]
+			assert unions and all(statement.count('FROM (') == len(re.findall(r'\) AS \w+', statement))
+								  for statement in unions)
+			assert decode_cursor(john.followed_posts_page(decode_cursor('%s_%d' % (
+				p3.timestamp.strftime('%Y%m%d%H%M%S%f'), p3.id)), 2).prev_cursor)[1] == p5.id
+			assert john.followed_posts().all() == posts
+			assert john.newest_followed_post() == p5.timestamp
+
+			# Dropping back to the limit pushes susan's posts after all.
+			db.session.add(mary.unfollow(susan))
+			db.session.commit()
+			assert susan.fans_out() and john.pulled_authors() == []
+			assert john.timeline_posts().all() == posts
+			assert rebuild_timelines() == 5
+			app.config['TIMELINE_ENABLED'] = False
+			assert john.followed_posts().all() == posts
+		finally:
+			del app.config['TIMELINE_FANOUT_LIMIT']
+
+	def test_keyset_pagination(self):
+		"""Test that cursor pages walk the posts newest first and can walk back."""
+
+		u = User(nickname='john', email='john@example.com')
+		db.session.add(u)
+		db.session.add(u.follow(u))
+
+		# Two posts share a timestamp, so the id has to break the tie.
+		utcnow = datetime.utcnow()
+		posts = [Post(body='post %d' % i, author=u, timestamp=utcnow + timedelta(seconds=i // 2))
+				 for i in range(5)]
+		for p in posts:
+			db.session.add(p)
+		db.session.commit()
+		newest_first = sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)
+
+		page1 = u.followed_posts_page(None, 2)
+		assert page1.items == newest_first[0:2]
+		assert page1.has_next and not page1.has_prev
+		page2 = u.followed_posts_page(decode_cursor(page1.next_cursor), 2)
+		assert page2.items == newest_first[2:4]
+		assert page2.has_prev and page2.prev_cursor is None
+		page3 = u.posts_page(decode_cursor(page2.next_cursor), 2)
+		assert page3.items == newest_first[4:]
+		assert not page3.has_next
+		assert u.posts_page(decode_cursor(page3.prev_cursor), 2).items == page2.items
+
+		# Malformed cursors are rejected.
+		assert decode_cursor('nonsense') is None
+
+	def test_last_seen_tracker(self):
+		"""Test that last seen times are buffered, skipped inside the
+		   granularity window and written in one bulk update."""
+
+		app.config['LAST_SEEN_GRANULARITY'] = 60
+		app.config['LAST_SEEN_BATCH_SIZE'] = 2
+		app.config['LAST_SEEN_FLUSH_INTERVAL'] = 3600
+		u1 = User(nickname='john', email='john@example.com')
+		u2 = User(nickname='susan', email='susan@example.com')
+		db.session.add(u1)
+		db.session.add(u2)
+		db.session.commit()
+
+		tracker = LastSeenTracker()
+		utcnow = datetime.utcnow()
+		tracker.touch(u1, utcnow)
+		tracker.touch(u1, utcnow + timedelta(seconds=30))
+		assert tracker.metrics()['skipped'] == 1
+		assert tracker.metrics()['pending'] == 1
+		assert User.query.get(u1.id).last_seen is None
+
+		# The second user fills the batch and triggers the flush.
+		tracker.touch(u2, utcnow + timedelta(seconds=90))
+		metrics = tracker.metrics()
+		assert metrics['flushes'] == 1
+		assert metrics['rows_flushed'] == 2
+		assert metrics['pending'] == 0
+		db.session.expire_all()
+		assert User.query.get(u1.id).last_seen == utcnow
+		assert User.query.get(u2.id).last_seen == utcnow + timedelta(seconds=90)
+
+		# W/ no more visits, the background thread flushes on the interval.
+		app.config['LAST_SEEN_FLUSH_INTERVAL'] = 0.01
+		tracker = LastSeenTracker()
+		tracker.touch(u1, utcnow + timedelta(seconds=300))
+		for i in range(100):
+			if tracker.metrics()['flushes']:
+				break
+			time.sleep(0.01)
+		assert tracker.metrics()['rows_flushed'] == 1
+		db.session.expire_all()
+		assert User.query.get(u1.id).last_seen == utcnow + timedelta(seconds=300)
+
+		# The app's counters are served to logged in users.
+		with self.app.session_transaction() as session:
+			session['user_id'] = unicode(u1.id)
+		response = self.app.get('/last_seen/status')
+		assert set(json.loads(response.data)) == set(last_seen_tracker.metrics())
+
+	def test_session_user(self):
+		"""Test that users are served from the cache until evicted
+		   and that the snapshot hands off to the real row."""
+
+		u1 = User(nickname='john', email='john@example.com')
+		u2 = User(nickname='susan', email='susan@example.com')
+		db.session.add(u1)
+		db.session.add(u2)
+		db.session.commit()
+		db.session.add(u1.follow(u2))
+		db.session.commit()
+		user_cache.clear()
+
+		with app.test_request_context():
+			s = session_user(u1.id)
+			assert isinstance(s, SessionUser)
+			assert s.nickname == 'john'
+			assert s.avatar(128) == u1.avatar(128)
+			assert s == u1 and s != u2
+			assert s.is_following(u2)
+			assert session_user(u1.id) is s
+			try:
+				s.nickname = 'johnny'
+				assert False
+			except AttributeError:
+				pass
+			assert session_user(12345) is None
+
+		u1.nickname = 'johnny'
+		db.session.add(u1)
+		db.session.commit()
+
+		# A later request still sees the cached copy until it's evicted.
+		with app.test_request_context():
+			assert session_user(u1.id).nickname == 'john'
+		user_cache.evict(u1.id)
+		with app.test_request_context():
+			assert session_user(u1.id).nickname == 'johnny'
+
+		# The follow links write on a GET, so they get the real row.
+		with app.test_request_context('/follow/susan'):
+			assert isinstance(load_user(unicode(u1.id)), User)
+		with app.test_request_context('/user/susan'):
+			assert isinstance(load_user(unicode(u1.id)), SessionUser)
+
+		# Posting, directly or through the writer, evicts the stale count.
+		with self.app.session_transaction() as session:
+			session['user_id'] = unicode(u1.id)
+		for writer in (False, True):
+			app.config['POST_WRITER_ENABLED'] = writer
+			with app.test_request_context():
+				count = session_user(u1.id).posts_count
+			self.app.post('/index', data={'post': 'post'})
+			with app.test_request_context():
+				assert session_user(u1.id).posts_count == count + 1
+
+	def test_post_authors_loaded_eagerly(self):
+		"""Test that rendering a page of posts doesn't run a query per author."""
+
+		users = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(4)]
+		for u in users:
+			db.session.add(u)
+		db.session.commit()
+		utcnow = datetime.utcnow()
+		for i, u in enumerate(users):
+			db.session.add(users[0].follow(u))
+			db.session.add(Post(body='post %d' % i, author=u, timestamp=utcnow + timedelta(seconds=i)))
+		db.session.commit()
+		id = users[0].id
+
+		for timeline in (False, True):
+			app.config['TIMELINE_ENABLED'] = timeline
+			rebuild_timelines()
+			db.session.expire_all()
+			u = User.query.get(id)
+			with self.assert_max_queries(1):
+				page = u.followed_posts_page(None, 4)
+				assert [p.author.nickname for p in page.items] == ['user3', 'user2', 'user1', 'user0']
+
+		db.session.expire_all()
+		u = User.query.get(id)
+		with self.assert_max_queries(1):
+			page = u.posts_page(None, 4)
+			assert [p.author.nickname for p in page.items] == ['user0']
+
+	def test_api(self):
+		"""Test the json timeline, user posts, follow state and search."""
+
+		app.config['SEARCH_BACKEND'] = 'fts5'
+		search_backend().setup()
+		u1 = User(nickname='john', email='john@example.com')
+		u2 = User(nickname='susan', email='susan@example.com')
+		u3 = User(nickname='mary', email='mary@example.com')
+		db.session.add_all([u1, u2, u3])
+		db.session.commit()
+		db.session.add(u1.follow(u1))
+		db.session.add(u1.follow(u2))
+		utcnow = datetime.utcnow()
+		for i, u in enumerate([u1, u2, u3]):
+			db.session.add(Post(body='fox from %s' % u.nickname, author=u, timestamp=utcnow + timedelta(seconds=i)))
+		db.session.commit()
+		john_id = u1.id
+
+		assert self.app.get('/api/timeline').status_code == 401
+		with self.app.session_transaction() as session:
+			session['user_id'] = unicode(john_id)
+			session['_fresh'] = True
+
+		timeline = json.loads(self.app.get('/api/timeline').data)
+		assert [p['body'] for p in timeline['posts']] == ['fox from susan', 'fox from john']
+		assert timeline['posts'][0]['author']['nickname'] == 'susan'
+		assert timeline['posts'][0]['author']['following']
+
+		posts = json.loads(self.app.get('/api/users/mary/posts').data)
+		assert posts['user']['nickname'] == 'mary' and not posts['user']['following']
+		assert posts['user']['posts_count'] == 1
+		assert [p['body'] for p in posts['posts']] == ['fox from mary']
+		assert self.app.get('/api/users/nobody/posts').status_code == 404
+
+		state = json.loads(self.app.get('/api/following?users=susan,mary,nobody').data)
+		assert state['following'] == {'susan': True, 'mary': False}
+
+		results = json.loads(self.app.get('/api/search/fox').data)
+		assert results['total'] == 3
+		following = dict((p['author']['nickname'], p['author']['following']) for p in results['posts'])
+		assert following == {'john': True, 'susan': True, 'mary': False}
+
+	def test_follow_graph(self):
+		"""Test the in-memory follow graph and that commits and rollbacks reach it."""
+
+		app.config['FOLLOW_GRAPH_ENABLED'] = True
+		app.config['FOLLOW_GRAPH_COMPACT_AT'] = 3
+		users = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(5)]
+		db.session.add_all(users)
+		db.session.commit()
+		u0, u1, u2, u3, u4 = users
+		db.session.execute(followers.insert(), [{'follower_id': u0.id, 'followed_id': u1.id},
+												{'follower_id': u0.id, 'followed_id': u2.id},
+												{'follower_id': u1.id, 'followed_id': u3.id},
+												{'follower_id': u2.id, 'followed_id': u3.id}])
+		db.session.commit()
+
+		graph = follow_graph()
+		for u in users:
+			db.session.refresh(u)
+		with self.assert_max_queries(0):
+			assert u0.is_following(u1) and not u1.is_following(u0)
+			assert u0.is_following_many([u1.id, u2.id, u3.id]) == set([u1.id, u2.id])
+		assert list(graph.followers(u3.id)) == [u1.id, u2.id]
+		assert graph.followed_who_follow(u0.id, u3.id) == [u1.id, u2.id]
+		assert graph.common_followed(u1.id, u2.id) == [u3.id]
+
+		# Uncommitted follows are seen by their own transaction only,
+		# and rolled back ones never reach the graph.
+		u4.follow(u0)
+		assert u4.is_following(u0) and not graph.is_following(u4.id, u0.id)
+		db.session.rollback()
+		assert not u4.is_following(u0)
+
+		db.session.add(u4.follow(u0))
+		db.session.add(u0.unfollow(u1))
+		db.session.commit()
+		assert graph.is_following(u4.id, u0.id) and not graph.is_following(u0.id, u1.id)
+		assert graph.followed_who_follow(u0.id, u3.id) == [u2.id]
+		# A third change folds the changes into the arrays.
+		u4.follow_many([u1, u2])
+		db.session.commit()
+		assert list(graph.followed(u4.id)) == [u0.id, u1.id, u2.id]
+		assert graph.edges() == db.session.query(followers).count() == 6
+
+		# Reloaded from the table, it's the same graph.
+		follow_graph_index.reset()
+		assert list(follow_graph().followed(u4.id)) == [u0.id, u1.id, u2.id]
+		assert follow_graph().edges() == 6
+
+		# A follow made by another process isn't in this one's graph yet,
+		# but following again doesn't insert a duplicate.
+		db.session.execute(followers.insert(), [{'follower_id': u3.id, 'followed_id': u4.id}])
+		db.session.commit()
+		assert not u3.is_following(u4)
+		assert u3.follow(u4) is None and u3.follow_many([u4]) == []
+		# The graph catches up once it's due a reload, built in the
+		# background while the old one keeps answering.
+		follow_graph_index._loaded -= 61
+		assert not u3.is_following(u4)
+		follow_graph_index.wait()
+		assert u3.is_following(u4)
+
+		# Reads don't wait for a reload, and follows committed during one
+		# are carried over to the new graph.
+		index = GraphIndex()
+		release = threading.Event()
+		def load():
+			if index.loaded() is not None:
+				release.wait()
+			return [1], [2]
+		graph = index.graph(load)
+		index._loaded -= 61
+		assert index.graph(load) is graph
+		index.apply({(3, 4): True, (1, 2): False})
+		assert graph.is_following(3, 4) and not graph.is_following(1, 2)
+		release.set()
+		index.wait()
+		assert index.graph(load) is not graph
+		assert index.graph(load).is_following(3, 4) and not index.graph(load).is_following(1, 2)
+
+		# A load in the middle of a transaction leaves its follows out.
+		follow_graph_index.reset()
+		u3.follow(u0)
+		assert u3.is_following(u0)
+		db.session.rollback()
+		assert not follow_graph().is_following(u3.id, u0.id)
+
+	def test_suggestions(self):
+		"""Test that suggestions rank friends of friends by mutual follows and show on your page."""
+
+		users = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(6)]
+		db.session.add_all(users)
+		db.session.commit()
+		ids = [u.id for u in users]
+		# user0 follows user1 and user2; both follow user3, only user1
+		# follows user4 and user5, and user5 has the extra follower.
+		edges = [(0, 0), (0, 1), (0, 2), (1, 3), (2, 3), (1, 4), (1, 5), (3, 5), (2, 0)]
+		db.session.execute(followers.insert(), [{'follower_id': ids[a], 'followed_id': ids[b]} for a, b in edges])
+		db.session.commit()
+
+		app.config['SUGGESTIONS_PER_USER'] = 2
+		assert refresh_suggestions(batch_size=2) > 0
+		u0 = User.query.get(ids[0])
+		assert [(u.nickname, count) for u, count in u0.suggestions()] == [('user3', 2), ('user5', 1)]
+		# Ties go to the user w/ more followers.
+		assert [u.nickname for u, count in User.query.get(ids[2]).suggestions()] == ['user5', 'user1']
+
+		with self.app.session_transaction() as session:
+			session['user_id'] = unicode(ids[0])
+			session['_fresh'] = True
+		# Looked up once for both the ETag and the page.
+		with self.assert_max_queries(100) as statements:
+			page = self.app.get('/user/user0').data
+		assert 'Who to follow' in page and 'followed by 2 people you follow' in page
+		assert len([s for s in statements if 'JOIN suggestion' in s]) == 1
+		assert 'Who to follow' not in self.app.get('/user/user1').data
+
+		# Followed since the last refresh, so left out.
+		db.session.add(u0.follow(User.query.get(ids[3])))
+		db.session.commit()
+		assert [u.nickname for u, count in u0.suggestions()] == ['user5']
+
+		# A refresh replaces each batch's rows, including those of users
+		# who no longer have any.
+		db.session.execute(suggestion.insert(), [{'user_id': 999, 'rank': 0, 'suggested_id': ids[1], 'mutual_count': 1}])
+		db.session.commit()
+		refresh_suggestions(batch_size=2)
+		assert db.session.query(suggestion).filter(suggestion.c.user_id == 999).count() == 0
+		assert [u.nickname for u, count in u0.suggestions()] == ['user5', 'user4']
+
+	def test_post_writer(self):
+		"""Test that queued posts are committed together and the index view waits for them."""
+
+		app.config['TIMELINE_ENABLED'] = True
+		users = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(2)]
+		db.session.add_all(users)
+		db.session.commit()
+		db.session.add(users[1].follow(users[0]))
+		db.session.commit()
+		ids = [u.id for u in users]
+
+		# Posts submitted at once share a transaction.
+		app.config['POST_WRITER_DELAY'] = 0.05
+		batches = post_writer.status()['batches']
+		futures = [post_writer.submit(ids[0], u'post %d' % i, datetime.utcnow()) for i in range(5)]
+		post_ids = [future.result(5) for future in futures]
+		assert post_writer.status()['batches'] - batches < 5
+		assert sorted(post_ids) == sorted(p.id for p in Post.query.all())
+		db.session.expire_all()
+		assert User.query.get(ids[0]).posts_count == 5
+		assert len(User.query.get(ids[1]).followed_posts_page(None, 10).items) == 5
+
+		app.config['POST_WRITER_ENABLED'] = True
+		with self.app.session_transaction() as session:
+			session['user_id'] = unicode(ids[0])
+			session['_fresh'] = True
+		response = self.app.post('/index', data={'post': 'through the writer'})
+		assert response.status_code == 302
+		assert Post.query.filter_by(body='through the writer').one().user_id == ids[0]
+
+		# A commit hook failing after the posts were committed doesn't
+		# get them written again.
+		failures = []
+		def fail_once(sender, changes):
+			if not failures:
+				failures.append(True)
+				raise RuntimeError('index locked')
+		models_committed.connect(fail_once)
+		try:
+			futures = [post_writer.submit(ids[0], u'hooked %d' % i, datetime.utcnow()) for i in range(3)]
+			assert len(set(future.result(5) for future in futures)) == 3
+		finally:
+			models_committed.disconnect(fail_once)
+		assert failures
+		assert Post.query.filter(Post.body.startswith(u'hooked')).count() == 3
+
+		# A post still queued when the page gives up on it is saved later,
+		# w/o an error page.
+		app.config['POST_WRITER_DELAY'] = 0.2
+		app.config['POST_WRITER_TIMEOUT'] = 0.01
+		written = post_writer.status()['written']
+		response = self.app.post('/index', data={'post': 'slow post'}, follow_redirects=True)
+		assert response.status_code == 200
+		assert 'still being saved' in response.data
+		while post_writer.status()['written'] == written:
+			time.sleep(0.01)
+		db.session.expire_all()
+		assert Post.query.filter_by(body='slow post').count() == 1
+
+	def test_startup(self):
+		"""Test that templates are precompiled into the bytecode cache, that
+		   OpenID is loaded on first use and that first requests are timed."""
+
+		# Each template gets a bytecode file, which the next compile reads.
+		directory = tempfile.mkdtemp()
+		app.config['TEMPLATE_CACHE_DIR'] = os.path.join(directory, 'templates')
+		try:
+			app.jinja_env.bytecode_cache = template_bytecode_cache(app)
+			app.jinja_env.cache.clear()
+			names = precompile_templates(app)
+			assert 'index.html' in names and 'user.html' in names
+			cached = os.listdir(app.config['TEMPLATE_CACHE_DIR'])
+			assert len(cached) == len(names)
+			app.jinja_env.cache.clear()
+			assert precompile_templates(app) == names
+			assert os.listdir(app.config['TEMPLATE_CACHE_DIR']) == cached
+		finally:
+			app.jinja_env.bytecode_cache = None
+			app.config['TEMPLATE_CACHE_DIR'] = None
+			shutil.rmtree(directory)
+
+		oid = LazyOpenID(app)
+		after_login = oid.after_login(lambda response: None)
+		assert not oid.loaded()
+		assert oid.after_login_func is after_login
+		assert oid.loaded()
+
+		startup_timer._timed_pid = None
+		assert self.app.get('/search/status').status_code == 302
+		assert startup_timer.timings['first_request'] > 0
+
 
 
 if __name__ == '__main__':
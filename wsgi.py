@@ -0,0 +1,65 @@
+#!flask/bin/python
+
+### Run the application in production under gunicorn. ###
+# Pre-forks SERVER_WORKERS worker processes, each serving requests on
+# SERVER_THREADS threads, bound to SERVER_BIND. Command line options
+# override the config. The app is loaded once in the master and each
+# worker then resets the db engine, so no connections are shared.
+# SERVER_WORKER_CLASS picks an async worker (e.g. gevent) instead;
+# the /api routes hand their queries to a thread pool either way.
+#
+# W/ TEMPLATE_PRECOMPILE set, the master compiles every template while
+# loading the app, so new workers don't on their first requests, and
+# w/ TEMPLATE_CACHE_DIR the bytecode is kept on disk for the next
+# master. Each process logs how long the import and its first request
+# took - ./startup_report.py compares the modes.
+#
+# ./wsgi.py --workers 4 --threads 8 --bind 0.0.0.0:8000
+# ./wsgi.py --workers 4 --worker-class gevent
+# or straight from gunicorn: gunicorn -c wsgi.py wsgi:application
+
+import argparse
+import multiprocessing
+import sys
+
+# import the app object from the app module - gunicorn's wsgi callable
+from app import app as application
+from app.engine import after_fork
+
+### gunicorn settings - read by gunicorn -c wsgi.py too ###
+
+bind = application.config.get('SERVER_BIND', '127.0.0.1:8000')
+workers = application.config.get('SERVER_WORKERS') or multiprocessing.cpu_count() * 2 + 1
+threads = application.config.get('SERVER_THREADS', 1)
+# sync (threaded if threads > 1), or an async worker like gevent or eventlet
+worker_class = application.config.get('SERVER_WORKER_CLASS', 'sync')
+# load the app before forking so the workers share its memory
+preload_app = True
+
+def post_fork(server, worker):
+	after_fork()
+
+def main(argv):
+	from gunicorn.app.base import BaseApplication
+
+	parser = argparse.ArgumentParser(description='Run the microblog under gunicorn.')
+	parser.add_argument('--bind', default=bind)
+	parser.add_argument('--workers', type=int, default=workers)
+	parser.add_argument('--threads', type=int, default=threads)
+	parser.add_argument('--worker-class', default=worker_class)
+	args = parser.parse_args(argv)
+
+	class Server(BaseApplication):
+		def load_config(self):
+			settings = dict(vars(args), preload_app=preload_app, post_fork=post_fork)
+			for name, value in settings.items():
+				self.cfg.set(name, value)
+
+		def load(self):
+			return application
+
+	print 'serving on %s w/ %d %s workers x %d threads' % (args.bind, args.workers, args.worker_class, args.threads)
+	Server().run()
+
+if __name__ == '__main__':
+	main(sys.argv[1:])